@@ -1,6 +1,6 @@
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import itertools
-import json
 import os
 
 import torch
@@ -12,11 +12,17 @@ from models.InceptionV3Pretrained import InceptionV3Pretrained
 from models.ViTStandard import ViT_standard
 from models.ViTPretrained import ViT_pretrained
 from models.ViTEfficient import EfficientViT
-from config import BALANCE_DOWNSAMPLING, BATCH_SIZE, DYNAMIC_SEGMENTATION_STRATEGY, EMB_SIZE, IMAGE_SIZE, INPUT_SIZE, N_HEADS, N_LAYERS, NUM_CLASSES, HIDDEN_SIZE, N_EPOCHS, LR, PATCH_SIZE, REG, DATASET_LIMIT, DROPOUT_P, NORMALIZE, PATH_TO_SAVE_RESULTS, RESUME, RESUME_EPOCH, PATH_MODEL_TO_RESUME, RANDOM_SEED, SEGMENTATION_STRATEGY, OVERSAMPLE_TRAIN
+from config import BATCH_NORM_MODE, MICRO_BATCH_SIZE, BALANCE_DOWNSAMPLING, BATCH_SIZE, CHANNELS_LAST, DYNAMIC_SEGMENTATION_STRATEGY, EMB_SIZE, IMAGE_SIZE, INPUT_SIZE, LOAD_SYNTHETIC, N_HEADS, N_LAYERS, NUM_CLASSES, HIDDEN_SIZE, N_EPOCHS, LR, PATCH_SIZE, REG, DATASET_LIMIT, DROPOUT_P, NORMALIZE, PATH_TO_SAVE_RESULTS, PRECISION, RESUME, RESUME_EPOCH, PATH_MODEL_TO_RESUME, RANDOM_SEED, SEGMENTATION_STRATEGY, OVERSAMPLE_TRAIN
 from tests.opencv_segmentation_test import set_seed
 from train_loops.CNN_pretrained import get_normalization_statistics
 from train_loops.train_loop import train_eval_loop
+from utils.checkpoint import load_model_weights
 from utils.dataloader_utils import get_dataloder_from_strategy
+from utils.embedding_cache import build_embedding_dataloaders
+from utils.micro_batching import BATCH_NORM_MODES
+from utils.precision import PRECISIONS
+from utils.successive_halving import SuccessiveHalving
+from utils.trial_ledger import TrialLedger
 from utils.utils import select_device
 
 device = select_device()
@@ -55,6 +61,40 @@ def init_with_parsed_arguments():
     # If True, will reset the combinations tried for the current architecture
     parser.add_argument("--force-reset", action="store_true", default=False)
 
+    # If True, the frozen backbone runs once over the data and the classifier heads are trained on its cached embeddings
+    # (only for resnet34, densenet121 and inception_v3)
+    parser.add_argument("--embedding-cache",
+                        action="store_true", default=False)
+
+    # Number of augmented embeddings cached for each train image, used for the augmented draws of the balanced sampler
+    parser.add_argument("--num-augmented-embeddings", type=int, default=4)
+
+    # Number of trials run at the same time in worker processes, which share the loaded dataset
+    parser.add_argument("--parallel-trials", type=int, default=1)
+
+    # Number of threads used by each parallel trial (default: the cores divided by the parallel trials)
+    parser.add_argument("--threads-per-trial", type=int, default=None)
+
+    # Search strategy of the hparams tuning: "grid" trains every combination for all the epochs, "successive_halving"
+    # starts every combination with --min-epochs epochs and promotes only the top 1/--eta of them to eta times the epochs
+    parser.add_argument("--search", type=str, default="grid",
+                        choices=["grid", "successive_halving"])
+    parser.add_argument("--min-epochs", type=int, default=1)
+    parser.add_argument("--eta", type=int, default=3)
+
+    # Precision of the training loop (see utils.precision) and memory format of the CNN models
+    parser.add_argument("--precision", type=str,
+                        default=PRECISION, choices=PRECISIONS)
+    parser.add_argument("--channels-last", action="store_true",
+                        default=CHANNELS_LAST)
+
+    # Images per forward/backward pass ("auto" = largest micro-batch within MEMORY_BUDGET_GB): the --batch-size batches
+    # are split into micro-batches whose gradients are accumulated, so --batch-size stays the effective batch size
+    parser.add_argument("--micro-batch-size", type=lambda value: value if value == "auto" else int(value),
+                        default=MICRO_BATCH_SIZE)
+    parser.add_argument("--batch-norm-mode", type=str,
+                        default=BATCH_NORM_MODE, choices=BATCH_NORM_MODES)
+
     parser.add_argument("--message", type=str, default=None)
 
     args = parser.parse_args()
@@ -100,9 +140,23 @@ def init_with_parsed_arguments():
         "hparam_tuning": True if (kwargs.get("reg") is None and kwargs.get("dropout") is None) else False,
         "force_reset": kwargs.get("force_reset"),
         "message": kwargs.get("message") if kwargs.get("message") is not None else None,
+        "embedding_cache": kwargs.get("embedding_cache"),
+        "num_augmented_embeddings": kwargs.get("num_augmented_embeddings"),
+        "parallel_trials": kwargs.get("parallel_trials"),
+        "threads_per_trial": kwargs.get("threads_per_trial"),
+        "search": kwargs.get("search"),
+        "min_epochs": kwargs.get("min_epochs"),
+        "eta": kwargs.get("eta"),
+        "precision": kwargs.get("precision"),
+        "channels_last": kwargs.get("channels_last"),
+        "micro_batch_size": kwargs.get("micro_batch_size"),
+        "batch_norm_mode": kwargs.get("batch_norm_mode"),
     }
 
     train_loader, val_loader = build_dataloaders(**config)
+    if config["embedding_cache"]:
+        train_loader, val_loader = build_embedding_loaders(
+            train_loader, val_loader, **config)
     if args.reg is not None and args.dropout is not None:
         print(f"----REG AND DROPOUT_P ARE NOT NONE, NOT DOING HPARAMS TUNING----")
         init_run(train_loader=train_loader,
@@ -121,42 +175,122 @@ def hparams_tuning(train_loader, val_loader, **hparams):
     }
     combinations = list(itertools.product(*hparams_space.values()))
 
+    curr_architecture = f"{hparams['architecture']}_{hparams['segmentation_strategy']}_{hparams['multiple_loss']}_{hparams['keep_background']}"
+    if hparams.get("search") == "successive_halving":
+        # The search keeps its own state, independent from the combinations tried by the grid search
+        successive_halving(train_loader, val_loader, list(hparams_space.keys()),
+                           combinations, curr_architecture, **hparams)
+        return
+
+    ledger = TrialLedger("./results/combinations.json")
     if hparams["force_reset"]:
-        combinations_tried = {}
+        ledger.reset(curr_architecture)
     else:
         # Filter combinations that have already been tried
-        if os.path.exists("./results/combinations.json"):
-            with open("./results/combinations.json", "r") as f:
-                combinations_tried = json.load(f)
-        else:
-            combinations_tried = {}
-
+        combinations_tried = ledger.tried(curr_architecture)
         print(f"COMBINATIONS TRIED: {combinations_tried}")
-
-        curr_architecture = f"{hparams['architecture']}_{hparams['segmentation_strategy']}_{hparams['multiple_loss']}_{hparams['keep_background']}"
-        if curr_architecture in combinations_tried:
+        if len(combinations_tried) > 0:
             combinations = [
-                combination for combination in combinations if list(combination) not in combinations_tried[curr_architecture]]
+                combination for combination in combinations if list(combination) not in combinations_tried]
             print(
-                f"----Found {len(combinations_tried[curr_architecture])} combinations already tried for {curr_architecture}, excluding them from the run! ----")
-        else:
-            combinations_tried[curr_architecture] = []
+                f"----Found {len(combinations_tried)} combinations already tried for {curr_architecture}, excluding them from the run! ----")
 
     print(f"Combinations are {combinations}")
-    for combination in tqdm(combinations, "Hparams tuning"):
-        hparams.update(dict(zip(hparams_space.keys(), combination)))
-        # print(f"Hparams are {hparams}")
-        init_run(train_loader=train_loader,
-                 val_loader=val_loader,
-                 **hparams)
-
-        combinations_tried[curr_architecture].append(combination)
-        with open("./results/combinations.json", "w") as f:
-            json.dump(combinations_tried, f)
+    trials_hparams = [{**hparams, **dict(zip(hparams_space.keys(), combination))}
+                      for combination in combinations]
+    run_trials(train_loader, val_loader, trials_hparams,
+               on_trial_end=lambda i, _: ledger.add(
+                   curr_architecture, combinations[i]),
+               **hparams)
+
+
+def successive_halving(train_loader, val_loader, hparams_names, combinations, curr_architecture, **hparams):
+    """
+    Starts all the combinations with min_epochs epochs, and trains only the top 1/eta of them (by validation recall)
+    for eta times the epochs, until the full number of epochs is reached. The search can be resumed after an interruption.
+    """
+    state_path = f"./results/successive_halving_{curr_architecture}.json"
+    if hparams["force_reset"] and os.path.exists(state_path):
+        os.remove(state_path)
+    search = SuccessiveHalving(state_path, combinations,
+                               min_epochs=hparams["min_epochs"], max_epochs=hparams["epochs"], eta=hparams["eta"])
+    while not search.is_finished():
+        pending = search.pending()
+        print(
+            f"--Successive Halving-- Training {len(pending)} combinations for {pending[0][1]} epochs")
+        trials_hparams = [{**hparams, **dict(zip(hparams_names, combination)), "epochs": epochs}
+                          for combination, epochs in pending]
+        run_trials(train_loader, val_loader, trials_hparams,
+                   on_trial_end=lambda i, results: search.report(
+                       pending[i][0], results["validation_recall"]),
+                   **hparams)
+        if len(search.pending()) > 0:
+            print("--Successive Halving-- Some trials failed, run again to resume the search")
+            return
+        search.promote()
+    best_combination, best_recall = search.best()
+    print(
+        f"--Successive Halving-- Best combination: {dict(zip(hparams_names, best_combination))} with validation recall {best_recall:.4f}%")
+
+
+_trial_loaders = None
+
+
+def init_trial_worker(train_loader, val_loader, threads_per_trial: int):
+    # The loaders are received once per worker: their tensors are in shared memory, so the workers don't copy the decoded dataset
+    global _trial_loaders
+    _trial_loaders = (train_loader, val_loader)
+    torch.set_num_threads(threads_per_trial)
+
+
+def run_trial(trial_hparams):
+    train_loader, val_loader = _trial_loaders
+    return init_run(train_loader=train_loader, val_loader=val_loader, **trial_hparams)
+
+
+def run_trials(train_loader, val_loader, trials_hparams, on_trial_end, **hparams):
+    """
+    Runs the trials one after the other or, with parallel_trials > 1, in a pool of worker processes,
+    each one limited to threads_per_trial threads. on_trial_end(trial_index, results) is called as soon as each trial ends,
+    so the progress is recorded even if the sweep crashes. Failed parallel trials are skipped.
+    """
+    parallel_trials = hparams.get("parallel_trials") or 1
+    if parallel_trials <= 1:
+        for i, trial_hparams in enumerate(tqdm(trials_hparams, "Hparams tuning")):
+            results = init_run(train_loader=train_loader,
+                               val_loader=val_loader,
+                               **trial_hparams)
+            on_trial_end(i, results)
+        return
+
+    threads_per_trial = hparams.get("threads_per_trial") or max(
+        1, (os.cpu_count() or 1) // parallel_trials)
+    print(
+        f"--Hparams Tuning-- Running {len(trials_hparams)} trials, {parallel_trials} at a time with {threads_per_trial} threads each")
+    # NOTE: the workers are spawned, since forking a process that has initialized CUDA is not supported
+    context = torch.multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=parallel_trials,
+                             mp_context=context,
+                             initializer=init_trial_worker,
+                             initargs=(train_loader, val_loader, threads_per_trial)) as executor:
+        futures = {executor.submit(run_trial, trial_hparams): i
+                   for i, trial_hparams in enumerate(trials_hparams)}
+        for future in tqdm(as_completed(futures), "Hparams tuning", total=len(futures)):
+            i = futures[future]
+            try:
+                results = future.result()
+            except Exception as e:
+                print(
+                    f"--Hparams Tuning-- Trial {i} failed, it will be retried in the next run: {e}")
+                continue
+            on_trial_end(i, results)
 
 
 def init_run(train_loader, val_loader, **kwargs):
     model = get_model(**kwargs)
+    if kwargs.get("embedding_cache"):
+        # The loaders contain the embeddings of the frozen backbone, so only the classifier head is trained
+        model = model.classifier
 
     if kwargs["use_wandb"]:
         if wandb.run is not None:
@@ -167,10 +301,10 @@ def init_run(train_loader, val_loader, **kwargs):
             resume=False,
         )
 
-    run_train_eval_loop(model=model,
-                        train_loader=train_loader,
-                        val_loader=val_loader,
-                        **kwargs)
+    return run_train_eval_loop(model=model,
+                               train_loader=train_loader,
+                               val_loader=val_loader,
+                               **kwargs)
 
 
 def get_model(**kwargs):
@@ -209,8 +343,8 @@ def get_model(**kwargs):
         raise ValueError(f"Unknown architechture {architecture}")
 
     if RESUME:
-        model.load_state_dict(torch.load(
-            f"{PATH_TO_SAVE_RESULTS}/{PATH_MODEL_TO_RESUME}/models/melanoma_detection_{RESUME_EPOCH}.pt"))
+        model.load_state_dict(load_model_weights(
+            f"{PATH_TO_SAVE_RESULTS}/{PATH_MODEL_TO_RESUME}/models/melanoma_detection_{RESUME_EPOCH}.pt", base_model=model))
 
     if architecture in ["resnet34", "resnet50", "densenet121", "inception_v3"]:
         for p in model.parameters():
@@ -242,6 +376,25 @@ def build_dataloaders(**args):
     return train_loader, val_loader
 
 
+def build_embedding_loaders(train_loader, val_loader, **args):
+    if args["architecture"] not in ["resnet34", "densenet121", "inception_v3"]:
+        raise ValueError(
+            f"The embedding cache requires a frozen backbone, which {args['architecture']} doesn't have")
+    model = get_model(**args)
+    data_params = {key: args[key] for key in ["architecture", "segmentation_strategy", "dynamic_segmentation_strategy", "dataset_limit",
+                                              "oversample_train", "balance_downsampling", "normalize", "keep_background", "image_size"]}
+    # The seed selects the split and the oversampled rows, the synthetic images are part of the training set
+    data_params.update({"random_seed": RANDOM_SEED,
+                        "load_synthetic": LOAD_SYNTHETIC,
+                        "normalization_statistics": [statistic.view(-1).tolist() for statistic in get_normalization_statistics()] if args["normalize"] else None})
+    return build_embedding_dataloaders(model,
+                                       [("train", train_loader),
+                                        ("val", val_loader)],
+                                       params=data_params,
+                                       device=device,
+                                       num_augmented=args["num_augmented_embeddings"])
+
+
 def run_train_eval_loop(model, train_loader, val_loader, **kwargs):
     print(f"---CURRENT CONFIGURATION---\n{kwargs}")
 
@@ -250,8 +403,14 @@ def run_train_eval_loop(model, train_loader, val_loader, **kwargs):
     scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(
         optimizer, T_max=kwargs["epochs"], eta_min=1e-5, verbose=True)
 
-    train_eval_loop(device, train_loader=train_loader, val_loader=val_loader, model=model,
-                    config=kwargs, optimizer=optimizer, scheduler=scheduler, resume=RESUME)
+    return train_eval_loop(device, train_loader=train_loader, val_loader=val_loader, model=model,
+                           config=kwargs, optimizer=optimizer, scheduler=scheduler, resume=RESUME,
+                           precision=kwargs.get("precision", PRECISION),
+                           # The embeddings of the cache are not images, and the ViTs are not convolutional
+                           channels_last=kwargs.get("channels_last", False) and not kwargs.get("embedding_cache")
+                           and kwargs["architecture"] in ["resnet34", "resnet50", "densenet121", "inception_v3"],
+                           micro_batch_size=kwargs.get("micro_batch_size"),
+                           batch_norm_mode=kwargs.get("batch_norm_mode", BATCH_NORM_MODE))
 
 
 if __name__ == "__main__":
@@ -22,6 +22,14 @@ SYNTHETIC_METADATA_TRAIN_DIR = os.path.join(
 # DATA_DIR, 'HAM10000_metadata_train.csv')
 # METADATA_TEST_DIR = os.path.join(DATA_DIR, 'HAM10000_metadata_test.csv')
 DYNAMIC_LOAD = True  # True if you want to load images dynamically, False otherwise
+# Memory-mapped store of pre-decoded images (build it with `python -m scripts.build_image_store`)
+IMAGE_STORE_DIR = os.path.join(DATA_DIR, "HAM10000_image_store")
+USE_IMAGE_STORE = False  # True if images must be read from the image store instead of being decoded at every access
+CACHE_DIR = os.path.join(DATA_DIR, "cache")  # Directory where the values computed once on the data (e.g. normalization statistics) are cached
+SAM_MICRO_BATCH_SIZE = 16  # Number of images segmented together by SAM, after the batch is collated
+GRADCAM_LOW_THRESHOLD = 70  # Threshold (in [0, 255]) of the GradCAM crop used as the "low" view by MSLANet
+GRADCAM_HIGH_THRESHOLD = 110  # Threshold (in [0, 255]) of the GradCAM crop used as the "high" view by MSLANet
+USE_SAM_MASK_CACHE = True  # True if the SAM masks of the images without ground truth segmentation are cached on disk (precompute them with `python -m scripts.precompute_sam_masks`)
 
 # ---Library Configurations--- #
 USE_WANDB = True  # Use wandb for logging
@@ -42,11 +50,22 @@ REG = 0.06  # Weight decay
 # Architecture used for training: resnet34, densenet121, inception_v3, standard, pretrained, efficient
 ARCHITECTURE = "resnet50"
 DATASET_LIMIT = None  # Value (0, dataset_length) used to limit the dataset
+PRECISION = "fp32"  # Precision of the CNN training loops: "fp32", "bf16" (autocast, also on cpu) or "fp16" (autocast with a gradient scaler on gpu, bf16 on cpu)
+CHANNELS_LAST = False  # True if the CNN models (ResNet, DenseNet, InceptionV3, MSLANet) and their inputs use the channels_last (NHWC) memory format
+MICRO_BATCH_SIZE = None  # Images per forward/backward pass: the BATCH_SIZE batches are split into micro-batches whose gradients are accumulated (None = no split, "auto" = largest micro-batch within MEMORY_BUDGET_GB)
+MEMORY_BUDGET_GB = 8  # Memory available for the activations of a micro-batch, used by MICRO_BATCH_SIZE = "auto"
+BATCH_NORM_MODE = "micro_batch"  # How batch norm is trained on the micro-batches: "micro_batch" (statistics of each micro-batch) or "frozen" (running statistics, not updated)
+NUM_WORKERS = 0  # Number of worker processes used to load the data (0 = load in the main process). With workers, samples are loaded on the cpu
 DROPOUT_P = 0.3  # Dropout probability
 NUM_DROPOUT_LAYERS = 1 # Used in MSLANet to apply several parallel classification layers with a dropout in it. Predictions are averaged to get the final result.
+VIEW_FUSION = "mean"  # How MSLANet fuses the predictions of the three views (original image and GradCAM crops): "mean" or "learned" (softmax weights trained with the model)
+CACHE_LANET_ACTIVATIONS = False  # True if the activations of the frozen LANet backbone are cached on disk and reused for the samples that are not randomly augmented
+MSLANET_GRADCAM_VIEWS = False  # True if MSLANet is trained on the three views (original image and offline GradCAM crops) of MSLANetDataLoader, instead of the images of SEGMENTATION_STRATEGY
 NORMALIZE = True  # True if data must be normalized, False otherwise
 OVERSAMPLE_TRAIN = True # True if oversampling (with data augmentation) must be applied, False otherwise
 BALANCE_DOWNSAMPLING = 1 # Proporsion used to downsample the majority. Applied only if OVERSAMPLE_TRAIN=True (1=Do not remove any examples from majority class).
+BALANCED_SAMPLER = True  # True if the training data is balanced by drawing class-balanced indices at every epoch, False to materialize the oversampled dataset
+EPOCH_LENGTH = None  # Number of samples drawn per epoch by the balanced sampler (None = number of classes * samples kept from the majority class)
 
 # Use binary loss (benign/malign) and multiclassification loss if true, otherwise use only the multiclassification one
 USE_MULTIPLE_LOSS = False
@@ -77,6 +96,8 @@ EMB_SIZE = 800  # Final embedding size
 SAVE_RESULTS = True  # Save results in JSON locally
 SAVE_MODELS = True # Save models locally
 PRINT_MODEL_ARCHITECTURE = False  # Print the architecture of the model
+KEEP_LAST_CHECKPOINTS = 3  # Number of epoch checkpoints kept on disk while training (the best one is always kept)
+DELTA_CHECKPOINTS = True  # True if the checkpoints store only the trainable parameters and the buffers, on top of the hash of the frozen pretrained base
 
 # ---Resume Train Configurations--- #
 RESUME = False  # True if you have to keep training a model, False if the model must be trained from scratch
@@ -5,15 +5,17 @@ from typing import Optional
 import os
 import pandas as pd
 import torch
-from config import AUGMENTED_IMAGES_DIR, AUGMENTED_SEGMENTATION_DIR, IMAGE_SIZE, DATASET_TRAIN_DIR, METADATA_TRAIN_DIR, NORMALIZE, SEGMENTATION_DIR, BATCH_SIZE, RANDOM_SEED, SYNTHETIC_METADATA_TRAIN_DIR
+from PIL import Image
+from config import AUGMENTED_IMAGES_DIR, AUGMENTED_SEGMENTATION_DIR, IMAGE_SIZE, DATASET_TRAIN_DIR, IMAGE_STORE_DIR, METADATA_TRAIN_DIR, NORMALIZE, NUM_WORKERS, SEGMENTATION_DIR, BATCH_SIZE, RANDOM_SEED, SYNTHETIC_METADATA_TRAIN_DIR, USE_IMAGE_STORE
 from shared.constants import DEFAULT_STATISTICS
-from typing import Optional, Tuple
+from typing import Callable, Optional, Tuple
 from sklearn.model_selection import train_test_split
 from utils.utils import calculate_normalization_statistics
 from torchvision import transforms
 
 from datasets.HAM10K import HAM10K
-from utils.utils import select_device
+from utils.image_store import ImageStore
+from utils.utils import seed_worker, select_device
 
 
 class DataLoader(ABC):
@@ -27,8 +29,13 @@ class DataLoader(ABC):
                  batch_size: int = BATCH_SIZE,
                  always_rotate: bool = False,
                  data_dir: str = DATASET_TRAIN_DIR,
-                 load_synthetic: bool = False):
+                 load_synthetic: bool = False,
+                 use_image_store: bool = USE_IMAGE_STORE,
+                 num_workers: int = NUM_WORKERS,
+                 # If True, the batches contain the LANet activation cache keys of the images too (see activation_key)
+                 return_activation_keys: bool = False):
         super().__init__()
+        self.return_activation_keys = return_activation_keys
         self.limit = limit
         self.transform = transform
         self.dynamic_load = dynamic_load
@@ -40,11 +47,16 @@ class DataLoader(ABC):
         self.synthetic_data_dir = AUGMENTED_IMAGES_DIR
         self.synthetic_segmentation_dir = AUGMENTED_SEGMENTATION_DIR
         self.load_synthetic = load_synthetic
+        self.image_store = ImageStore(
+            IMAGE_STORE_DIR) if use_image_store else None
         if self.transform is None:
             self.transform = transforms.Compose([
                 transforms.ToTensor()
             ])
-        self.device = select_device()
+        self.num_workers = num_workers
+        # NOTE: with workers, everything done while loading a sample (e.g. SAM segmentation) runs on the cpu inside the workers,
+        # and the batches are moved to the device by the train loop.
+        self.device = select_device() if num_workers == 0 else torch.device('cpu')
         self.train_df, self.val_df, self.test_df = self._init_metadata(
             limit=limit)
         self.always_rotate = always_rotate
@@ -57,6 +69,47 @@ class DataLoader(ABC):
     def load_images_and_labels(self, metadata: pd.DataFrame):
         pass
 
+    def open_image(self, img: pd.Series) -> Image.Image:
+        """
+        Returns the image of the metadata row, reading it from the image store if available,
+        otherwise decoding it from the image path.
+        """
+        if self.image_store is not None and img['image_id'] in self.image_store:
+            return self.image_store.get_image(img['image_id'])
+        return Image.open(img['image_path'])
+
+    def activation_key(self, img: pd.Series) -> str:
+        """
+        Returns the LANet activation cache key of the metadata row: its image path,
+        or an empty key (never cached) if the image is randomly augmented every time it is loaded.
+        """
+        return "" if img["augmented"] else img["image_path"]
+
+    def get_activation_key_fn(self) -> Optional[Callable]:
+        return self.activation_key if self.return_activation_keys else None
+
+    def build_dataloader(self, dataset: torch.utils.data.Dataset, shuffle: bool, collate_fn: Optional[Callable] = None) -> torch.utils.data.DataLoader:
+        """
+        Wraps the dataset into a torch DataLoader. If the dataset is balanced by a sampler, the sampler replaces the shuffling.
+        With num_workers > 0, samples are loaded by persistent workers (each with its own seed)
+        and batches are collated into pinned memory, so that they can be moved to the device with non_blocking=True.
+        """
+        use_workers = self.num_workers > 0
+        sampler = getattr(dataset, "sampler", None)
+        return torch.utils.data.DataLoader(
+            dataset,
+            batch_size=self.batch_size,
+            shuffle=shuffle if sampler is None else False,
+            sampler=sampler,
+            collate_fn=collate_fn,
+            num_workers=self.num_workers,
+            pin_memory=use_workers and torch.cuda.is_available(),
+            persistent_workers=use_workers,
+            worker_init_fn=seed_worker if use_workers else None,
+            generator=torch.Generator().manual_seed(
+                RANDOM_SEED) if use_workers else None,
+        )
+
     def _init_metadata(self,
                        limit: Optional[int] = None):
 
@@ -164,13 +217,11 @@ class DataLoader(ABC):
             std=self.normalization_statistics[1] if self.normalize else None,
             balance_data=self.upscale_train,
             resize_dims=IMAGE_SIZE,
-            dynamic_load=self.dynamic_load)
-        train_dataloader = torch.utils.data.DataLoader(
-            train_dataset,
-            batch_size=self.batch_size,
-            shuffle=True,
-            pin_memory=False,
-        )
+            dynamic_load=self.dynamic_load,
+            load_on_cpu=self.num_workers > 0,
+            activation_key_fn=self.get_activation_key_fn())
+        train_dataloader = self.build_dataloader(
+            train_dataset, shuffle=True)
         return train_dataloader
 
     def get_val_dataloader(self) -> torch.utils.data.DataLoader:
@@ -189,13 +240,11 @@ class DataLoader(ABC):
             std=self.normalization_statistics[1] if self.normalize else None,
             balance_data=False,
             resize_dims=IMAGE_SIZE,
-            dynamic_load=self.dynamic_load)
-        val_dataloader = torch.utils.data.DataLoader(
-            val_dataset,
-            batch_size=self.batch_size,
-            shuffle=False,
-            pin_memory=False,
-        )
+            dynamic_load=self.dynamic_load,
+            load_on_cpu=self.num_workers > 0,
+            activation_key_fn=self.get_activation_key_fn())
+        val_dataloader = self.build_dataloader(
+            val_dataset, shuffle=False)
         return val_dataloader
 
     def get_test_dataloader(self):
@@ -214,11 +263,9 @@ class DataLoader(ABC):
             std=self.normalization_statistics[1] if self.normalize else None,
             balance_data=False,
             resize_dims=IMAGE_SIZE,
-            dynamic_load=self.dynamic_load)
-        test_dataloader = torch.utils.data.DataLoader(
-            test_dataset,
-            batch_size=self.batch_size,
-            shuffle=False,
-            pin_memory=False,
-        )
+            dynamic_load=self.dynamic_load,
+            load_on_cpu=self.num_workers > 0,
+            activation_key_fn=self.get_activation_key_fn())
+        test_dataloader = self.build_dataloader(
+            test_dataset, shuffle=False)
         return test_dataloader
@@ -1,13 +1,12 @@
+from functools import partial
 import os
 
 from augmentation.StatefulTransform import StatefulTransform
-from config import AUGMENTED_SEGMENTATION_DIR, BATCH_SIZE, DATA_DIR, IMAGE_SIZE, KEEP_BACKGROUND, NORMALIZE
+from config import AUGMENTED_SEGMENTATION_DIR, BATCH_SIZE, DATA_DIR, IMAGE_SIZE, KEEP_BACKGROUND, NORMALIZE, NUM_WORKERS, SAM_MICRO_BATCH_SIZE, USE_IMAGE_STORE, USE_SAM_MASK_CACHE
 from dataloaders.DataLoader import DataLoader
-from typing import Optional
+from typing import Callable, List, Optional
 import torch
 
-from typing import Optional
-
 from PIL import Image
 from tqdm import tqdm
 from torchvision import transforms
@@ -17,8 +16,9 @@ from models.SAM import SAM
 from shared.enums import DynamicSegmentationStrategy
 from train_loops.SAM_pretrained import preprocess_images
 from utils.opencv_segmentation import bounding_box_pipeline
+from utils.sam_mask_cache import SAMMaskCache
 from torchvision.transforms import functional as TF
-from utils.utils import approximate_bounding_box_to_square, crop_image_from_box, get_bounding_boxes_from_segmentation, resize_images, resize_segmentations
+from utils.utils import crop_to_background, resize_images
 
 # NOTE: This has to be set to True only to execute the script.generate_synthetic_segmentation_masks, which will not return valid segmentations, but will
 # save the synthetic segmentation masks on the disk.
@@ -42,7 +42,12 @@ class DynamicSegmentationDataLoader(DataLoader):
                  keep_background: Optional[bool] = KEEP_BACKGROUND,
                  normalization_statistics: tuple = None,
                  batch_size: int = BATCH_SIZE,
-                 load_synthetic: bool = False):
+                 load_synthetic: bool = False,
+                 use_image_store: bool = USE_IMAGE_STORE,
+                 num_workers: int = NUM_WORKERS,
+                 use_sam_mask_cache: bool = USE_SAM_MASK_CACHE,
+                 sam_micro_batch_size: int = SAM_MICRO_BATCH_SIZE,
+                 return_activation_keys: bool = False):
         super().__init__(limit=limit,
                          transform=transform,
                          dynamic_load=dynamic_load,
@@ -51,7 +56,10 @@ class DynamicSegmentationDataLoader(DataLoader):
                          normalization_statistics=normalization_statistics,
                          batch_size=batch_size,
                          always_rotate=False,
-                         load_synthetic=load_synthetic)
+                         load_synthetic=load_synthetic,
+                         use_image_store=use_image_store,
+                         num_workers=num_workers,
+                         return_activation_keys=return_activation_keys)
         self.segmentation_strategy = segmentation_strategy
         self.load_synthetic = load_synthetic
         if SAVE_SYNTH_SEGMENTATION_MASKS:
@@ -61,6 +69,7 @@ class DynamicSegmentationDataLoader(DataLoader):
         if self.segmentation_strategy == DynamicSegmentationStrategy.OPENCV.value:
             print(f"NOOOOOO, DON'T USE OPEN_CV AS A STRATEGY, IT'S DEPRECATED!! ò_ó")
         self.keep_background = keep_background
+        self.sam_micro_batch_size = sam_micro_batch_size
         if segmentation_strategy == DynamicSegmentationStrategy.SAM.value:
             sam_checkpoint_path = "checkpoints/sam_checkpoint.pt"
             SAM_IMG_SIZE = 128
@@ -77,13 +86,21 @@ class DynamicSegmentationDataLoader(DataLoader):
                 'adjust_gamma': 1.5,
                 'gaussian_blur': 5}
 
+            self.sam_mask_cache = SAMMaskCache(
+                checkpoint_path=sam_checkpoint_path,
+                params={"img_size": SAM_IMG_SIZE, "preprocess_params": self.preprocess_params}) if use_sam_mask_cache else None
+
+    def activation_key(self, img: pd.Series) -> str:
+        # The training images (the ones with a ground truth segmentation) always go through the random stateful_transform
+        return "" if img["train"] else img["image_path"]
+
     def load_images_and_labels_at_idx(self, metadata: pd.DataFrame, idx: int, transform: transforms.Compose = None):
         img = metadata.iloc[idx]
         label = img['label']
         segmentation_available = img['train']
 
         if not segmentation_available:
-            image = Image.open(img['image_path'])
+            image = self.open_image(img)
 
             if img["synthetic"]:
                 image = TF.resize(image, (450, 600))
@@ -100,8 +117,8 @@ class DynamicSegmentationDataLoader(DataLoader):
                         self.save_synthetic_binary_mask(image, img['image_id'])
                     else:
                         return
-                segmented_image = self.sam_segmentation_pipeline(
-                    image).squeeze(0)
+                # NOTE: the image is segmented later, together with the other images of the batch (see collate_and_segment)
+                return image, label, True, img['image_path']
 
             else:
                 raise NotImplementedError(
@@ -115,7 +132,7 @@ class DynamicSegmentationDataLoader(DataLoader):
         if SAVE_SYNTH_SEGMENTATION_MASKS:
             return
 
-        ti, ts = Image.open(img['image_path']), Image.open(
+        ti, ts = self.open_image(img), Image.open(
             img['segmentation_path']).convert('1')
 
         ti, ts = self.stateful_transform(ti, ts)
@@ -134,17 +151,23 @@ class DynamicSegmentationDataLoader(DataLoader):
         assert image.shape[-2:
                            ] == IMAGE_SIZE, f"Image shape is {image.shape[-2:]}, expected {IMAGE_SIZE}"
 
+        if self.segmentation_strategy == DynamicSegmentationStrategy.SAM.value:
+            return image, label, False, img['image_path']
         return image, label
 
     def load_images_and_labels(self, metadata: pd.DataFrame):
         not_found_files = []
         images = []
         labels = []
+        samples = []
         for index, (row_index, img) in tqdm(enumerate(metadata.iterrows()), desc=f'Loading images'):
-            image, label = self.load_images_and_labels_at_idx(
-                idx=index, metadata=metadata)
-            images.append(image)
-            labels.append(label)
+            samples.append(self.load_images_and_labels_at_idx(
+                idx=index, metadata=metadata))
+            if len(samples) == self.sam_micro_batch_size or index == len(metadata) - 1:
+                batch_images, batch_labels = self.collate_and_segment(samples)
+                images.extend(batch_images)
+                labels.extend(batch_labels)
+                samples = []
         images = torch.stack(images)
         labels = torch.tensor(labels, dtype=torch.long)
 
@@ -157,22 +180,7 @@ class DynamicSegmentationDataLoader(DataLoader):
     def crop_to_background(self, images: torch.Tensor,
                            segmentations: torch.Tensor,
                            resize: bool = True):
-        if segmentations.ndim == 4:
-            segmentations = segmentations.squeeze(0)
-        bboxes = [get_bounding_boxes_from_segmentation(
-            mask)[0] for mask in segmentations]
-
-        cropped_images = []
-        for image, bbox in zip(images, bboxes):
-            bbox = approximate_bounding_box_to_square(bbox)
-            cropped_image = crop_image_from_box(
-                image, bbox, size=IMAGE_SIZE if resize else None)
-            cropped_image = torch.from_numpy(cropped_image).permute(2, 0, 1)
-            cropped_images.append(cropped_image)
-
-        cropped_images = torch.stack(cropped_images)
-
-        return cropped_images
+        return crop_to_background(images, segmentations, size=IMAGE_SIZE if resize else None)
 
     def get_segmentation_with_sam(self, images: torch.Tensor):
         if len(images.shape) == 3:
@@ -182,20 +190,100 @@ class DynamicSegmentationDataLoader(DataLoader):
             self.sam_model.get_img_size(), self.sam_model.get_img_size())).to(self.device)
 
         resized_images = preprocess_images(
-            resized_images, params=self.preprocess_params)
+            resized_images, params=self.preprocess_params, fused=True)
 
-        upscaled_masks = self.sam_model(resized_images)
+        upscaled_masks = self.sam_model(resized_images, output_size=(450, 600))
         binary_masks = torch.sigmoid(upscaled_masks)
-        binary_masks = (binary_masks > THRESHOLD).float()
-        binary_masks = resize_segmentations(
-            binary_masks, new_size=(600, 450)).to(self.device)
+        binary_masks = (binary_masks > THRESHOLD).float().to(self.device)
 
         return binary_masks
 
-    def sam_segmentation_pipeline(self, images: torch.Tensor):
+    def get_sam_masks(self, images: torch.Tensor, image_paths: List[str]) -> torch.Tensor:
+        """
+        Returns the (B, 1, H, W) SAM masks of the images. Masks found in the mask cache are read from disk,
+        the missing ones are computed by SAM in a single forward pass (and cached, if the cache is enabled).
+        """
+        if self.sam_mask_cache is None:
+            return self.get_segmentation_with_sam(images)
+        binary_masks = [self.sam_mask_cache.get(image_path)
+                        for image_path in image_paths]
+        missing = [i for i, mask in enumerate(binary_masks) if mask is None]
+        if missing:
+            computed_masks = self.get_segmentation_with_sam(images[missing])
+            for i, binary_mask in zip(missing, computed_masks):
+                self.sam_mask_cache.put(image_paths[i], binary_mask)
+                binary_masks[i] = binary_mask
+        return torch.stack([binary_mask.to(self.device) for binary_mask in binary_masks])
+
+    def collate_and_segment(self, batch: list, mean: Optional[torch.Tensor] = None, std: Optional[torch.Tensor] = None):
+        """
+        Collate function used with the SAM strategy. The samples that need a segmentation (no ground truth available) contain the
+        raw image, which is segmented and cropped by SAM in micro-batches of sam_micro_batch_size images.
+        Since the cropping must happen on the raw images, the normalization is applied here, after the segmentation.
+        With return_activation_keys, the keys (the last element of the samples) are returned as the third element of the batch.
+        """
+        keys = None
+        if self.return_activation_keys:
+            keys = [sample[-1] for sample in batch]
+            batch = [sample[:-1] for sample in batch]
+        images, labels = [], []
+        to_segment = []
+        for i, sample in enumerate(batch):
+            images.append(sample[0])
+            labels.append(torch.as_tensor(sample[1], dtype=torch.long))
+            if len(sample) == 4 and sample[2]:
+                to_segment.append((i, sample[3]))
+
+        for start in range(0, len(to_segment), self.sam_micro_batch_size):
+            micro_batch = to_segment[start:start + self.sam_micro_batch_size]
+            raw_images = torch.stack([images[i] for i, _ in micro_batch])
+            binary_masks = self.get_sam_masks(
+                raw_images, [image_path for _, image_path in micro_batch])
+            segmented_images = self.sam_segmentation_pipeline(
+                raw_images, binary_masks=binary_masks)
+            for (i, _), segmented_image in zip(micro_batch, segmented_images):
+                images[i] = segmented_image
+
+        images = torch.stack([image.to(self.device) for image in images])
+        assert images.shape[-2:
+                            ] == IMAGE_SIZE, f"Image shape is {images.shape}, expected last two dimensions to be {IMAGE_SIZE}"
+        if mean is not None:
+            images = (images - mean.to(self.device)) / std.to(self.device)
+        if keys is not None:
+            return images, torch.stack(labels), keys
+        return images, torch.stack(labels)
+
+    def build_dataloader(self, dataset: torch.utils.data.Dataset, shuffle: bool, collate_fn: Optional[Callable] = None) -> torch.utils.data.DataLoader:
+        if self.segmentation_strategy != DynamicSegmentationStrategy.SAM.value:
+            return super().build_dataloader(dataset, shuffle, collate_fn)
+        # The images are normalized by collate_and_segment, after the segmentation
+        mean, std = (dataset.mean, dataset.std) if dataset.normalize else (None, None)
+        dataset.normalize = False
+        return super().build_dataloader(dataset, shuffle, collate_fn=partial(
+            self.collate_and_segment, mean=mean, std=std))
+
+    def precompute_sam_masks(self, metadata: pd.DataFrame):
+        """
+        Fills the mask cache for all the images of the metadata that have no ground truth segmentation.
+        """
+        metadata = metadata[~metadata['train']]
+        metadata = metadata[[image_path not in self.sam_mask_cache
+                             for image_path in metadata['image_path']]]
+        for start in tqdm(range(0, len(metadata), self.sam_micro_batch_size), desc="Computing SAM masks"):
+            images, image_paths = [], []
+            for _, img in metadata.iloc[start:start + self.sam_micro_batch_size].iterrows():
+                image = self.open_image(img)
+                if img["synthetic"]:
+                    image = TF.resize(image, (450, 600))
+                images.append(TF.to_tensor(image))
+                image_paths.append(img['image_path'])
+            self.get_sam_masks(torch.stack(images), image_paths)
+
+    def sam_segmentation_pipeline(self, images: torch.Tensor, binary_masks: Optional[torch.Tensor] = None):
         if len(images.shape) == 3:
             images = images.unsqueeze(0)
-        binary_masks = self.get_segmentation_with_sam(images)
+        if binary_masks is None:
+            binary_masks = self.get_segmentation_with_sam(images)
         images = images.to(self.device)
         if not self.keep_background:
             images = binary_masks * images
@@ -11,7 +11,7 @@ from PIL import Image
 from tqdm import tqdm
 from torchvision import transforms
 import pandas as pd
-from config import BATCH_SIZE, IMAGE_SIZE, NORMALIZE, RANDOM_SEED
+from config import BATCH_SIZE, IMAGE_SIZE, NORMALIZE, NUM_WORKERS, RANDOM_SEED, USE_IMAGE_STORE
 import random
 from datasets.HAM10K import HAM10K
 
@@ -40,7 +40,10 @@ class ImagesAndSegmentationDataLoader(DataLoader):
                  load_segmentations: bool = True,
                  load_synthetic: bool = False,
                  return_image_name: bool = False,
-                 shuffle_train: bool = True):
+                 shuffle_train: bool = True,
+                 use_image_store: bool = USE_IMAGE_STORE,
+                 num_workers: int = NUM_WORKERS,
+                 return_activation_keys: bool = False):
         super().__init__(limit=limit,
                          transform=transform,
                          dynamic_load=dynamic_load,
@@ -49,7 +52,10 @@ class ImagesAndSegmentationDataLoader(DataLoader):
                          normalization_statistics=normalization_statistics,
                          batch_size=batch_size,
                          always_rotate=False,
-                         load_synthetic=False)
+                         load_synthetic=False,
+                         use_image_store=use_image_store,
+                         num_workers=num_workers,
+                         return_activation_keys=return_activation_keys)
         self.resize_dim = resize_dim
         self.load_segmentations = load_segmentations
         self.return_image_name = return_image_name
@@ -77,7 +83,7 @@ class ImagesAndSegmentationDataLoader(DataLoader):
         img = metadata.iloc[idx]
         load_segmentations = "train" in img and self.load_segmentations
         label = img['label']
-        image = Image.open(img['image_path'])
+        image = self.open_image(img)
         if load_segmentations:
             segmentation = Image.open(img['segmentation_path']).convert('1')
             if img["augmented"]:
@@ -147,12 +153,10 @@ class ImagesAndSegmentationDataLoader(DataLoader):
             std=self.normalization_statistics[1] if self.normalize else None,
             balance_data=self.upscale_train,
             resize_dims=IMAGE_SIZE,
-            dynamic_load=self.dynamic_load)
-        train_dataloader = torch.utils.data.DataLoader(
-            train_dataset,
-            batch_size=self.batch_size,
-            shuffle=self.shuffle_train,
-            pin_memory=False,
-        )
+            dynamic_load=self.dynamic_load,
+            load_on_cpu=self.num_workers > 0,
+            activation_key_fn=self.get_activation_key_fn())
+        train_dataloader = self.build_dataloader(
+            train_dataset, shuffle=self.shuffle_train)
         print(f"Train dataloader has shuffle train on? {self.shuffle_train}")
         return train_dataloader
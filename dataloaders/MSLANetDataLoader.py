@@ -13,13 +13,14 @@ from torchvision import transforms
 import pandas as pd
 import torchvision.transforms.functional as TF
 from augmentation.Augmentations import Augmentations
-from config import BATCH_SIZE, DATA_DIR, DATASET_TRAIN_DIR, IMAGE_SIZE, METADATA_TRAIN_DIR, NORMALIZE, NUM_CLASSES, RANDOM_SEED, SYNTHETIC_METADATA_TRAIN_DIR
+from config import BATCH_SIZE, CACHE_LANET_ACTIVATIONS, DATA_DIR, DATASET_TRAIN_DIR, GRADCAM_HIGH_THRESHOLD, GRADCAM_LOW_THRESHOLD, IMAGE_SIZE, METADATA_TRAIN_DIR, NORMALIZE, NUM_CLASSES, NUM_WORKERS, RANDOM_SEED, SYNTHETIC_METADATA_TRAIN_DIR
 import random
 
 from dataloaders.DataLoader import DataLoader
 from datasets.MSLANetDataset import MSLANetDataset
-from models.GradCAM import GradCAM
+from models.GradCAM import GradCAM, crops_from_raw_cams
 from shared.constants import IMAGENET_STATISTICS
+from utils.array_store import ArrayStore
 
 random.seed(RANDOM_SEED)
 
@@ -35,8 +36,16 @@ class MSLANetDataLoader(DataLoader):
                  normalization_statistics: tuple = None,
                  batch_size: int = BATCH_SIZE,
                  load_synthetic: bool = False,
-                 online_gradcam: bool = False):
+                 online_gradcam: bool = False,
+                 num_workers: int = NUM_WORKERS,
+                 low_threshold: int = GRADCAM_LOW_THRESHOLD,
+                 high_threshold: int = GRADCAM_HIGH_THRESHOLD,
+                 return_activation_keys: bool = CACHE_LANET_ACTIVATIONS):
         self.online_gradcam = online_gradcam
+        self.low_threshold = low_threshold
+        self.high_threshold = high_threshold
+        # Stores of the raw CAMs of the offline dataset (one per split), set by offline_init_metadata if they have been generated
+        self.raw_cams_stores = None
         super().__init__(limit=limit,
                          transform=transform,
                          dynamic_load=dynamic_load,
@@ -46,7 +55,9 @@ class MSLANetDataLoader(DataLoader):
                          batch_size=batch_size,
                          always_rotate=False,
                          data_dir=os.path.join(DATA_DIR, "gradcam_output"),
-                         load_synthetic=load_synthetic)
+                         load_synthetic=load_synthetic,
+                         num_workers=num_workers,
+                         return_activation_keys=return_activation_keys)
         self.resize_dim = resize_dim
         self.load_synthetic = load_synthetic
         self.mslanet_transform = MSLANetAugmentation(
@@ -56,7 +67,7 @@ class MSLANetDataLoader(DataLoader):
                               interpolation=Image.BILINEAR),
             transforms.ToTensor()
         ])
-        self.gradcam = GradCAM()
+        self.gradcam = GradCAM(device=self.device)
 
         if not self.online_gradcam:
             if self.upscale_train:
@@ -76,6 +87,14 @@ class MSLANetDataLoader(DataLoader):
     def offline_load_images_and_labels_at_idx(self, metadata: pd.DataFrame, idx: int):
         img = metadata.iloc[idx]
         label = img['label']
+        if self.raw_cams_stores is not None:
+            # The crops are derived from the stored CAM, so that any threshold can be used without regenerating the dataset
+            image_ori = self.transform(Image.open(img['image_path']))
+            cam = torch.from_numpy(
+                self.raw_cams_stores[img['split']].get(img['image_id']).copy())
+            image_low, image_high = crops_from_raw_cams(image_ori.unsqueeze(0), cam.unsqueeze(0),
+                                                        thresholds=[self.low_threshold, self.high_threshold])
+            return (image_ori, image_low[0], image_high[0]), label
         image_ori = Image.open(img['image_path'])
         image_low = Image.open(img['image_path_low'])
         image_high = Image.open(img['image_path_high'])
@@ -87,8 +106,6 @@ class MSLANetDataLoader(DataLoader):
         return (image_ori, image_low, image_high), label
 
     def online_load_images_and_labels_at_idx(self, metadata: pd.DataFrame, idx: int):
-        LOW_THRESHOLD = 70
-        HIGH_THRESHOLD = 110
         img = metadata.iloc[idx]
         label = img['label']
         image_ori = Image.open(img['image_path'])
@@ -98,11 +115,10 @@ class MSLANetDataLoader(DataLoader):
         else:
             image_ori = self.transform(image_ori)
 
-        _, image_low, _ = self.gradcam.generate_cam(
-            image=image_ori, threshold=LOW_THRESHOLD)
-        _, image_high, _ = self.gradcam.generate_cam(
-            image=image_ori, threshold=HIGH_THRESHOLD)
-        return (image_ori, image_low, image_high), label
+        # The CAM is computed once and used for both the thresholds
+        image_low, image_high = self.gradcam.generate_cams(
+            image_ori, thresholds=[self.low_threshold, self.high_threshold])
+        return (image_ori, image_low[0].to(image_ori.device), image_high[0].to(image_ori.device)), label
 
     def load_images_and_labels(self, metadata: pd.DataFrame):
         images = []
@@ -233,6 +249,18 @@ class MSLANetDataLoader(DataLoader):
         high_gradcam_val_path = os.path.join(high_threshold_dir, "val")
         high_gradcam_test_path = os.path.join(high_threshold_dir, "test")
 
+        df_train['split'] = "train"
+        df_val['split'] = "val"
+        df_test['split'] = "test"
+        raw_cams_dir = os.path.join(data_dir, "raw_cams")
+        if os.path.exists(raw_cams_dir):
+            print(f"--Data Loader-- Deriving the GradCAM crops from the raw CAMs in {raw_cams_dir}")
+            self.raw_cams_stores = {split: ArrayStore(os.path.join(raw_cams_dir, split))
+                                    for split in ["train", "val", "test"]}
+        elif (self.low_threshold, self.high_threshold) != (70, 110):
+            raise ValueError(
+                f"The offline GradCAM crops have been computed with thresholds (70, 110), generate the raw CAMs with scripts/generate_grad_cams.py to use the thresholds ({self.low_threshold}, {self.high_threshold})")
+
         if not self.synthetic_data_dir:
             raise Exception(
                 "Offline gradcam requires loading also synthetic data, please set load_synthetic=True")
@@ -323,6 +351,11 @@ class MSLANetDataLoader(DataLoader):
         print(f"---TEST---: {len(df_test)} entries")
         return df_train, df_val, df_test
 
+    def get_activation_views(self) -> Optional[Tuple[str, str, str]]:
+        if not self.return_activation_keys:
+            return None
+        return ("ori", f"gradcam_{self.low_threshold}", f"gradcam_{self.high_threshold}")
+
     def get_train_dataloder(self) -> Tuple[torch.utils.data.DataLoader, torch.utils.data.DataLoader]:
         if self.normalize:
             self.normalization_statistics = IMAGENET_STATISTICS
@@ -334,13 +367,12 @@ class MSLANetDataLoader(DataLoader):
             std=self.normalization_statistics[1] if self.normalize else None,
             balance_data=self.upscale_train,
             resize_dims=IMAGE_SIZE,
-            dynamic_load=self.dynamic_load)
-        train_dataloader = torch.utils.data.DataLoader(
-            train_dataset,
-            batch_size=self.batch_size,
-            shuffle=True,
-            pin_memory=False,
-        )
+            dynamic_load=self.dynamic_load,
+            load_on_cpu=self.num_workers > 0,
+            activation_views=self.get_activation_views(),
+            fixed_augmentations=not self.online_gradcam)
+        train_dataloader = self.build_dataloader(
+            train_dataset, shuffle=True)
         return train_dataloader
 
     def get_val_dataloader(self) -> torch.utils.data.DataLoader:
@@ -355,13 +387,12 @@ class MSLANetDataLoader(DataLoader):
             std=self.normalization_statistics[1] if self.normalize else None,
             balance_data=False,
             resize_dims=IMAGE_SIZE,
-            dynamic_load=self.dynamic_load)
-        val_dataloader = torch.utils.data.DataLoader(
-            val_dataset,
-            batch_size=self.batch_size,
-            shuffle=False,
-            pin_memory=False,
-        )
+            dynamic_load=self.dynamic_load,
+            load_on_cpu=self.num_workers > 0,
+            activation_views=self.get_activation_views(),
+            fixed_augmentations=not self.online_gradcam)
+        val_dataloader = self.build_dataloader(
+            val_dataset, shuffle=False)
         return val_dataloader
 
     def get_test_dataloader(self):
@@ -376,11 +407,10 @@ class MSLANetDataLoader(DataLoader):
             std=self.normalization_statistics[1] if self.normalize else None,
             balance_data=False,
             resize_dims=IMAGE_SIZE,
-            dynamic_load=self.dynamic_load)
-        test_dataloader = torch.utils.data.DataLoader(
-            test_dataset,
-            batch_size=self.batch_size,
-            shuffle=False,
-            pin_memory=False,
-        )
+            dynamic_load=self.dynamic_load,
+            load_on_cpu=self.num_workers > 0,
+            activation_views=self.get_activation_views(),
+            fixed_augmentations=not self.online_gradcam)
+        test_dataloader = self.build_dataloader(
+            test_dataset, shuffle=False)
         return test_dataloader
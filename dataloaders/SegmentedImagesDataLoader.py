@@ -1,4 +1,4 @@
-from config import BATCH_SIZE, IMAGE_SIZE, KEEP_BACKGROUND, NORMALIZE
+from config import BATCH_SIZE, IMAGE_SIZE, KEEP_BACKGROUND, NORMALIZE, NUM_WORKERS
 from dataloaders.DataLoader import DataLoader
 from typing import Optional
 import torch
@@ -12,7 +12,7 @@ import pandas as pd
 from dataloaders.ImagesAndSegmentationDataLoader import StatefulTransform
 from models.SAM import SAM
 from train_loops.SAM_pretrained import preprocess_images
-from utils.utils import approximate_bounding_box_to_square, crop_image_from_box, get_bounding_boxes_from_segmentation, resize_images, resize_segmentations
+from utils.utils import crop_to_background, resize_images
 
 
 class SegmentedImagesDataLoader(DataLoader):
@@ -24,7 +24,9 @@ class SegmentedImagesDataLoader(DataLoader):
                  normalize: bool = NORMALIZE,
                  keep_background: Optional[bool] = KEEP_BACKGROUND,
                  normalization_statistics: tuple = None,
-                 batch_size: int = BATCH_SIZE):
+                 batch_size: int = BATCH_SIZE,
+                 num_workers: int = NUM_WORKERS,
+                 return_activation_keys: bool = False):
         super().__init__(limit=limit,
                          transform=transform,
                          dynamic_load=dynamic_load,
@@ -32,7 +34,9 @@ class SegmentedImagesDataLoader(DataLoader):
                          normalize=normalize,
                          normalization_statistics=normalization_statistics,
                          batch_size=batch_size,
-                         always_rotate=False)
+                         always_rotate=False,
+                         num_workers=num_workers,
+                         return_activation_keys=return_activation_keys)
         self.segmentation_transform = transforms.Compose([
             transforms.ToTensor()
         ])
@@ -40,6 +44,10 @@ class SegmentedImagesDataLoader(DataLoader):
             always_rotate=self.always_rotate)
         self.keep_background = keep_background
 
+    def activation_key(self, img: pd.Series) -> str:
+        # Every image goes through the random stateful_transform, so no activation is cached
+        return ""
+
     def load_images_and_labels_at_idx(self, metadata: pd.DataFrame, idx: int, transform: transforms.Compose = None):
         img = metadata.iloc[idx]
         label = img['label']
@@ -105,20 +113,7 @@ class SegmentedImagesDataLoader(DataLoader):
     def crop_to_background(self, images: torch.Tensor,
                            segmentations: torch.Tensor,
                            resize: bool = True):
-        bboxes = [get_bounding_boxes_from_segmentation(
-            mask)[0] for mask in segmentations]
-
-        cropped_images = []
-        for image, bbox in zip(images, bboxes):
-            bbox = approximate_bounding_box_to_square(bbox)
-            cropped_image = crop_image_from_box(
-                image, bbox, size=IMAGE_SIZE if resize else None)
-            cropped_image = torch.from_numpy(cropped_image).permute(2, 0, 1)
-            cropped_images.append(cropped_image)
-
-        cropped_images = torch.stack(cropped_images)
-
-        return cropped_images
+        return crop_to_background(images, segmentations, size=IMAGE_SIZE if resize else None)
 
     def sam_segmentation_pipeline(self, images: torch.Tensor):
         if len(images.shape) == 3:
@@ -128,13 +123,11 @@ class SegmentedImagesDataLoader(DataLoader):
             self.sam_model.get_img_size(), self.sam_model.get_img_size())).to(self.device)
 
         resized_images = preprocess_images(
-            resized_images, params=self.preprocess_params)
+            resized_images, params=self.preprocess_params, fused=True)
 
-        upscaled_masks = self.sam_model(resized_images)
+        upscaled_masks = self.sam_model(resized_images, output_size=(450, 450))
         binary_masks = torch.sigmoid(upscaled_masks)
-        binary_masks = (binary_masks > THRESHOLD).float()
-        binary_masks = resize_segmentations(
-            binary_masks, new_size=(450, 450)).to(self.device)
+        binary_masks = (binary_masks > THRESHOLD).float().to(self.device)
 
         images = resize_images(images, new_size=(450, 450)).to(self.device)
         if not self.keep_background:
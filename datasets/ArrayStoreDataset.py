@@ -0,0 +1,24 @@
+from typing import List
+
+import torch
+from torch.utils.data import Dataset
+
+from utils.array_store import ArrayStore
+
+
+class ArrayStoreDataset(Dataset):
+    """
+    Dataset that reads precomputed arrays (e.g. image embeddings and masks) from one or more ArrayStore, sharing the same keys.
+    The i-th sample is the tuple of the arrays of the i-th key, one per store, read from the memory-mapped files.
+    """
+
+    def __init__(self, stores: List[ArrayStore], keys: List[str]):
+        self.stores = stores
+        self.keys = keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getitem__(self, idx):
+        key = self.keys[idx]
+        return tuple(torch.from_numpy(store.get(key).copy()) for store in self.stores)
@@ -0,0 +1,65 @@
+import math
+from typing import Iterator, List, Optional, Sequence
+
+import torch
+from torch.utils.data import Sampler
+
+from config import BALANCE_DOWNSAMPLING, RANDOM_SEED
+
+
+class ClassBalancedSampler(Sampler):
+    """
+    Sampler that draws a class-balanced set of indices at every epoch, without materializing the oversampled dataset.
+
+    The sampled dataset must expose 2N virtual samples: the index i < N refers to the i-th original sample,
+    while the index i + N refers to an augmented draw of the same sample.
+    Every class gets the same number of samples per epoch: the original samples are drawn first (without replacement),
+    and the remaining ones are augmented draws (with replacement) of the samples of that class.
+    """
+
+    def __init__(self,
+                 labels: Sequence[int],
+                 # Number of samples drawn per epoch. If None, it is the number of classes times the samples kept from the majority class
+                 epoch_length: Optional[int] = None,
+                 # Percentage of data to keep from the majority class
+                 balance_downsampling: float = BALANCE_DOWNSAMPLING,
+                 seed: int = RANDOM_SEED):
+        self.num_samples = len(labels)
+        labels = torch.as_tensor(labels, dtype=torch.long)
+        self.class_indices: List[torch.Tensor] = [torch.nonzero(labels == label).view(-1)
+                                                  for label in torch.unique(labels)]
+        counts = sorted([len(indices)
+                        for indices in self.class_indices], reverse=True)
+        second_max_count = counts[1] if len(counts) > 1 else counts[0]
+        samples_per_class = max(math.floor(
+            counts[0] * balance_downsampling), second_max_count)
+        if epoch_length is None:
+            epoch_length = samples_per_class * len(self.class_indices)
+        self.epoch_length = epoch_length
+        self.generator = torch.Generator().manual_seed(seed)
+        print(
+            f"--Data Balance (Sampler)-- Drawing {self.epoch_length} balanced samples per epoch from {self.num_samples} images")
+
+    def __len__(self) -> int:
+        return self.epoch_length
+
+    def __iter__(self) -> Iterator[int]:
+        num_classes = len(self.class_indices)
+        quotas = [self.epoch_length // num_classes] * num_classes
+        # The remainder is assigned to random classes
+        for label in torch.randperm(num_classes, generator=self.generator)[:self.epoch_length % num_classes]:
+            quotas[label] += 1
+
+        epoch_indices = []
+        for indices, quota in zip(self.class_indices, quotas):
+            permutation = indices[torch.randperm(
+                len(indices), generator=self.generator)]
+            epoch_indices.append(permutation[:quota])
+            if quota > len(indices):
+                augmented = indices[torch.randint(
+                    len(indices), (quota - len(indices),), generator=self.generator)]
+                epoch_indices.append(augmented + self.num_samples)
+        epoch_indices = torch.cat(epoch_indices)
+        epoch_indices = epoch_indices[torch.randperm(
+            len(epoch_indices), generator=self.generator)]
+        return iter(epoch_indices.tolist())
@@ -2,9 +2,11 @@ from abc import ABC
 from typing import Callable, Optional, Tuple
 import pandas as pd
 from torch.utils.data import Dataset
-from config import BALANCE_DOWNSAMPLING
+from config import BALANCE_DOWNSAMPLING, BALANCED_SAMPLER, EPOCH_LENGTH
 import torch
 
+from datasets.ClassBalancedSampler import ClassBalancedSampler
+
 from utils.utils import select_device
 
 
@@ -30,15 +32,29 @@ class CustomDataset(Dataset, ABC):
         std_epsilon: float = 0.01,
         # Sizes (height, width) for resize the images
         resize_dims: Tuple[int] = (224, 224),
-            dynamic_load: bool = False):
+            dynamic_load: bool = False,
+            # Keep the samples on the cpu (needed when the data is loaded by dataloader workers)
+            load_on_cpu: bool = False,
+            # Balance the data with a sampler drawing balanced indices at every epoch, instead of oversampling the metadata
+            balanced_sampler: bool = BALANCED_SAMPLER,
+            # Number of samples drawn per epoch by the balanced sampler
+            epoch_length: Optional[int] = EPOCH_LENGTH,
+            # If set, returns the LANet activation cache key of the metadata row, which is appended to the samples
+            activation_key_fn: Optional[Callable] = None):
         self.metadata = metadata
+        self.activation_key_fn = activation_key_fn
         self.dynamic_load = dynamic_load
         self.load_data_fn = load_data_fn
-        self.device = select_device()
+        self.device = torch.device('cpu') if load_on_cpu else select_device()
 
         self.metadata['augmented'] = False
         self.metadata = self.metadata
         self.balance_data = balance_data
+        self.balanced_sampler = balanced_sampler
+        self.epoch_length = epoch_length
+        # Number of samples that are preloaded when dynamic_load is False
+        self.num_original_samples = len(self.metadata)
+        self.sampler = None
         self.normalize = normalize
         if self.normalize:
             self.mean = mean.to(self.device)
@@ -60,8 +76,34 @@ class CustomDataset(Dataset, ABC):
     def __len__(self):
         return len(self.metadata)
 
+    def init_balanced_sampler(self):
+        """
+        Appends an augmented copy of every row to the metadata (so the dataset exposes 2N virtual samples) and creates
+        the sampler that draws the balanced indices. Only the N original samples are preloaded, the augmented draws are loaded on the fly.
+        """
+        print(
+            "--Data Balance-- balance_data set to True. Training data will be balanced by the sampler.")
+        self.metadata = self.metadata.reset_index(drop=True)
+        self.num_original_samples = len(self.metadata)
+        augmented_metadata = self.metadata.copy()
+        augmented_metadata['augmented'] = True
+        self.metadata = pd.concat(
+            [self.metadata, augmented_metadata], ignore_index=True)
+        self.sampler = ClassBalancedSampler(
+            self.metadata['label'].iloc[:self.num_original_samples].tolist(),
+            epoch_length=self.epoch_length,
+            balance_downsampling=self.balance_downsampling)
+
+    def is_loaded_on_the_fly(self, idx: int) -> bool:
+        return self.dynamic_load or idx >= self.num_original_samples
+
     def __getitem__(self, idx):
-        if self.dynamic_load:
+        if self.activation_key_fn is not None:
+            return (*self.get_sample(idx), self.activation_key_fn(self.metadata.iloc[idx]))
+        return self.get_sample(idx)
+
+    def get_sample(self, idx):
+        if self.is_loaded_on_the_fly(idx):
             result = self.load_data_fn(metadata=self.metadata, idx=idx)
             if len(result) == 3:
                 image, label, segmentation = result
@@ -96,7 +138,8 @@ class CustomDataset(Dataset, ABC):
                 return image, label
 
     def load_images_and_labels(self):
-        result = self.load_data_fn(metadata=self.metadata)
+        result = self.load_data_fn(
+            metadata=self.metadata.iloc[:self.num_original_samples])
         if len(result) == 3:
             self.images, self.labels, self.segmentations = result
         elif len(result) == 2:
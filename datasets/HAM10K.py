@@ -1,10 +1,10 @@
 from collections import Counter
 import math
 import random
-from typing import Callable
+from typing import Callable, Optional
 import pandas as pd
 import torch
-from config import BALANCE_DOWNSAMPLING
+from config import BALANCE_DOWNSAMPLING, BALANCED_SAMPLER, EPOCH_LENGTH
 from datasets.CustomDataset import CustomDataset
 import random
 import math
@@ -31,11 +31,22 @@ class HAM10K(CustomDataset):
                  std_epsilon: float = 0.01,
                  # Sizes (height, width) for resize the images
                  resize_dims=(224, 224),
-                 dynamic_load: bool = False):
+                 dynamic_load: bool = False,
+                 # Keep the samples on the cpu (needed when the data is loaded by dataloader workers)
+                 load_on_cpu: bool = False,
+                 # Balance the data with a sampler drawing balanced indices at every epoch, instead of oversampling the metadata
+                 balanced_sampler: bool = BALANCED_SAMPLER,
+                 # Number of samples drawn per epoch by the balanced sampler
+                 epoch_length: Optional[int] = EPOCH_LENGTH,
+                 # If set, returns the LANet activation cache key of the metadata row, which is appended to the samples
+                 activation_key_fn: Optional[Callable] = None):
         super().__init__(metadata, load_data_fn, balance_data, balance_downsampling,
-                         normalize, mean, std, std_epsilon, resize_dims, dynamic_load)
+                         normalize, mean, std, std_epsilon, resize_dims, dynamic_load, load_on_cpu,
+                         balanced_sampler, epoch_length, activation_key_fn)
 
-        if self.balance_data:
+        if self.balance_data and self.balanced_sampler:
+            self.init_balanced_sampler()
+        elif self.balance_data:
             self.balance_dataset()
 
         if not dynamic_load:
@@ -90,3 +101,4 @@ class HAM10K(CustomDataset):
                 self.metadata.loc[aug_indices, 'augmented'] = True
                 label_indices = self.metadata[self.metadata['label']
                                               == label].index
+        self.num_original_samples = len(self.metadata)
@@ -1,10 +1,10 @@
 from collections import Counter
 import math
 import random
-from typing import Callable
+from typing import Callable, Optional, Tuple
 import pandas as pd
 import torch
-from config import BALANCE_DOWNSAMPLING
+from config import BALANCE_DOWNSAMPLING, BALANCED_SAMPLER, EPOCH_LENGTH
 from datasets.CustomDataset import CustomDataset
 import random
 import math
@@ -31,18 +31,34 @@ class MSLANetDataset(CustomDataset):
                  std_epsilon: float = 0.01,
                  # Sizes (height, width) for resize the images
                  resize_dims=(224, 224),
-                 dynamic_load: bool = False):
+                 dynamic_load: bool = False,
+                 # Keep the samples on the cpu (needed when the data is loaded by dataloader workers)
+                 load_on_cpu: bool = False,
+                 # Balance the data with a sampler drawing balanced indices at every epoch, instead of oversampling the metadata
+                 balanced_sampler: bool = BALANCED_SAMPLER,
+                 # Number of samples drawn per epoch by the balanced sampler
+                 epoch_length: Optional[int] = EPOCH_LENGTH,
+                 # Names of the (original, low, high) views. If set, the LANet activation cache keys of the views are returned too
+                 activation_views: Optional[Tuple[str, str, str]] = None,
+                 # True if the augmented samples are fixed images computed offline, so their activations can be cached too
+                 fixed_augmentations: bool = False):
+        self.activation_views = activation_views
+        self.fixed_augmentations = fixed_augmentations
         super().__init__(metadata, load_data_fn, balance_data, balance_downsampling,
-                         normalize, mean, std, std_epsilon, resize_dims, dynamic_load)
+                         normalize, mean, std, std_epsilon, resize_dims, dynamic_load, load_on_cpu,
+                         balanced_sampler, epoch_length)
 
-        if self.balance_data:
+        if self.balance_data and self.balanced_sampler:
+            self.init_balanced_sampler()
+        elif self.balance_data:
             self.balance_dataset()
 
         if not dynamic_load:
             self.load_images_and_labels()
 
     def load_images_and_labels(self):
-        result = self.load_data_fn(metadata=self.metadata)
+        result = self.load_data_fn(
+            metadata=self.metadata.iloc[:self.num_original_samples])
         (images_ori, images_low, images_high), labels = result
         self.images_ori = images_ori
         self.images_low = images_low
@@ -98,9 +114,25 @@ class MSLANetDataset(CustomDataset):
                 self.metadata.loc[aug_indices, 'augmented'] = True
                 label_indices = self.metadata[self.metadata['label']
                                               == label].index
+        self.num_original_samples = len(self.metadata)
+
+    def activation_keys(self, idx) -> Tuple[str, str, str]:
+        """
+        Returns the activation cache keys of the views of the sample, which are empty if the sample is freshly augmented.
+        """
+        img = self.metadata.iloc[idx]
+        if img['augmented'] and not self.fixed_augmentations:
+            return ("", "", "")
+        return tuple(f"{img['image_path']}:{view}" for view in self.activation_views)
 
     def __getitem__(self, idx):
-        if self.dynamic_load:
+        if self.activation_views is not None:
+            images, label = self.get_views(idx)
+            return images, label, self.activation_keys(idx)
+        return self.get_views(idx)
+
+    def get_views(self, idx):
+        if self.is_loaded_on_the_fly(idx):
             result = self.load_data_fn(metadata=self.metadata, idx=idx)
             (image_ori, image_low, image_high), label = result
 
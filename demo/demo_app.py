@@ -10,10 +10,11 @@ from PIL import Image, ImageTk
 import torch
 from torchvision import transforms
 import os
-from config import PATH_TO_SAVE_RESULTS, HIDDEN_SIZE, NUM_CLASSES, IMAGE_SIZE, DROPOUT_P, INPUT_SIZE, EMB_SIZE, PATCH_SIZE, N_HEADS, N_LAYERS, HIDDEN_SIZE
+from config import PATH_TO_SAVE_RESULTS, SAM_MICRO_BATCH_SIZE, HIDDEN_SIZE, NUM_CLASSES, IMAGE_SIZE, DROPOUT_P, INPUT_SIZE, EMB_SIZE, PATCH_SIZE, N_HEADS, N_LAYERS, HIDDEN_SIZE
 from shared.constants import DEFAULT_STATISTICS, IMAGENET_STATISTICS
 from train_loops.SAM_pretrained import preprocess_images
-from utils.utils import approximate_bounding_box_to_square, crop_image_from_box, get_bounding_boxes_from_segmentation, resize_images, resize_segmentations, select_device
+from utils.checkpoint import load_model_weights
+from utils.utils import crop_to_background, resize_images, select_device
 from models.SAM import SAM
 from models.ResNet34Pretrained import ResNet34Pretrained
 from models.DenseNetPretrained import DenseNetPretrained
@@ -78,8 +79,8 @@ def get_model(model_path, epoch, sam_checkpoint_path="checkpoints/sam_checkpoint
     else:
         raise ValueError(f"Unknown architecture {type}")
 
-    state_dict = torch.load(
-        f"{PATH_TO_SAVE_RESULTS}/{model_path}/models/melanoma_detection_{epoch}.pt")
+    state_dict = load_model_weights(
+        f"{PATH_TO_SAVE_RESULTS}/{model_path}/models/melanoma_detection_{epoch}.pt", base_model=model)
     model.load_state_dict(state_dict)
 
     sam_model = SAM(
@@ -89,27 +90,15 @@ def get_model(model_path, epoch, sam_checkpoint_path="checkpoints/sam_checkpoint
     
     return model, sam_model, normalization_stats
 
-def crop_to_background(images: torch.Tensor,
-                        segmentations: torch.Tensor,
-                        resize: bool = True):
-        bboxes = [get_bounding_boxes_from_segmentation(
-            mask)[0] for mask in segmentations]
-
-        cropped_images = []
-        for image, bbox in zip(images, bboxes):
-            bbox = approximate_bounding_box_to_square(bbox)
-            cropped_image = crop_image_from_box(
-                image, bbox, size=IMAGE_SIZE if resize else None)
-            cropped_image = torch.from_numpy(cropped_image).permute(2, 0, 1)
-            cropped_images.append(cropped_image)
-
-        cropped_images = torch.stack(cropped_images)
-
-        return cropped_images
-
-def sam_segmentation_pipeline(sam_model, images):
+def sam_segmentation_pipeline(sam_model, images, micro_batch_size=SAM_MICRO_BATCH_SIZE):
         if len(images.shape) == 3:
             images = images.unsqueeze(0)
+        if len(images) > micro_batch_size:
+            # SAM runs on micro-batches of images, to keep the memory bounded
+            results = [sam_segmentation_pipeline(sam_model, images[start:start + micro_batch_size], micro_batch_size)
+                       for start in range(0, len(images), micro_batch_size)]
+            cropped_images, binary_masks = zip(*results)
+            return torch.cat(cropped_images), torch.cat(binary_masks)
         THRESHOLD = 0.5
         resized_images = resize_images(images, new_size=(
             sam_model.get_img_size(), sam_model.get_img_size())).to(device)
@@ -123,13 +112,11 @@ def sam_segmentation_pipeline(sam_model, images):
         }
 
         resized_images = preprocess_images(
-            resized_images, params=preprocess_params)
+            resized_images, params=preprocess_params, fused=True)
 
-        upscaled_masks = sam_model(resized_images)
+        upscaled_masks = sam_model(resized_images, output_size=(450, 450))
         binary_masks = torch.sigmoid(upscaled_masks)
-        binary_masks = (binary_masks > THRESHOLD).float()
-        binary_masks = resize_segmentations(
-            binary_masks, new_size=(450, 450)).to(device)
+        binary_masks = (binary_masks > THRESHOLD).float().to(device)
 
         images = resize_images(images, new_size=(450, 450)).to(device)
         if not KEEP_BACKGROUND:
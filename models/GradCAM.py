@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import List, Optional, Tuple
 import PIL
 import torch
 from torch import nn
@@ -9,13 +9,13 @@ import numpy as np
 import cv2
 from torchvision.transforms import ToPILImage
 
-from utils.utils import select_device
+from utils.utils import crop_images_from_boxes, select_device
 
 
 class GradCAM(nn.Module):
-    def __init__(self):
+    def __init__(self, device: Optional[torch.device] = None):
         super(GradCAM, self).__init__()
-        self.device = select_device()
+        self.device = select_device() if device is None else device
         self.model = models.resnet50(
             weights=ResNet50_Weights.DEFAULT).to(self.device)
         self.target_layer = "layer4"
@@ -123,6 +123,68 @@ class GradCAM(nn.Module):
 
         return img_with_rect, cropped_img, cam_img
 
+    def compute_raw_cams(self, images: torch.Tensor) -> torch.Tensor:
+        """
+        Computes the CAMs of a (B, C, H, W) batch with a single forward and backward pass.
+        Returns the (B, 1, h, w) CAMs at the resolution of the target layer, before upsampling and normalization.
+        """
+        images = images.to(self.device)
+        self.model.zero_grad()
+        output = self.model(images)
+        # The score of each image depends only on that image (the model is in eval mode), so backpropagating
+        # the sum of the scores gives the gradients of every image with respect to its own predicted class
+        output.gather(1, output.argmax(dim=1, keepdim=True)).sum().backward()
+
+        weights = torch.mean(self.grads, dim=(2, 3), keepdim=True)
+        cams = torch.sum(weights * self.feature_maps, dim=1, keepdim=True)
+        return torch.relu(cams).detach()
+
+    def generate_cams(self, images: torch.Tensor, thresholds: List[int], size: Tuple[int, int] = (224, 224)) -> List[torch.Tensor]:
+        """
+        Batched version of generate_cam: the CAM of every image is computed once, and it is used to crop the images for all the thresholds.
+        Returns a (B, C, size[0], size[1]) tensor of crops for each threshold.
+        """
+        if len(images.shape) == 3:
+            images = images.unsqueeze(0)
+        images = images.to(self.device)
+        cams = self.compute_raw_cams(images)
+        return crops_from_raw_cams(images, cams, thresholds, size)
+
+
+def crops_from_raw_cams(images: torch.Tensor, cams: torch.Tensor, thresholds: List[int], size: Tuple[int, int] = (224, 224)) -> List[torch.Tensor]:
+    """
+    Crops the images to the bounding rectangle of the CAM pixels above each threshold (in [0, 255]), as done by GradCAM.generate_cam,
+    and resizes the crops to size. The CAMs are upsampled to the image size and min-max normalized per image.
+    If no pixel is above the threshold, the whole image is kept.
+    """
+    for threshold in thresholds:
+        if threshold < 0 or threshold > 255:
+            raise ValueError("Threshold must be a value between 0 and 255.")
+    height, width = images.shape[-2:]
+    cams = torch.nn.functional.interpolate(cams.to(images.device, torch.float32), size=(
+        height, width), mode='bilinear', align_corners=False)
+    cams = cams - cams.amin(dim=(1, 2, 3), keepdim=True)
+    cams = cams / cams.amax(dim=(1, 2, 3), keepdim=True).clamp(min=1e-12)
+    cams = cams[:, 0] * 255
+
+    rows = torch.arange(height, device=images.device)
+    cols = torch.arange(width, device=images.device)
+    crops = []
+    for threshold in thresholds:
+        masks = cams > threshold
+        rows_mask, cols_mask = masks.any(dim=2), masks.any(dim=1)
+        # Bounding rectangle of all the pixels above the threshold (end excluded)
+        boxes = torch.stack([
+            torch.where(rows_mask, rows, height).min(dim=1).values,
+            torch.where(cols_mask, cols, width).min(dim=1).values,
+            torch.where(rows_mask, rows, -1).max(dim=1).values + 1,
+            torch.where(cols_mask, cols, -1).max(dim=1).values + 1], dim=1)
+        empty = ~rows_mask.any(dim=1)
+        boxes[empty] = torch.tensor(
+            [0, 0, height, width], device=boxes.device, dtype=boxes.dtype)
+        crops.append(crop_images_from_boxes(images.float(), boxes, size))
+    return crops
+
 
 if __name__ == "__main__":
     cam_instance = GradCAM()
@@ -1,15 +1,16 @@
-from typing import List
+from typing import List, Optional, Tuple
 import torch
 from torch import nn
 from torchvision import models
 from torchvision.models import ResNet50_Weights
 from models.GradCAM import GradCAM
-from config import DROPOUT_P, HIDDEN_SIZE, NUM_CLASSES, INPUT_SIZE
+from config import DROPOUT_P, HIDDEN_SIZE, IMAGE_SIZE, NUM_CLASSES, INPUT_SIZE
+from utils.lanet_activation_cache import LANetActivationCache
 from utils.utils import select_device
 
 
 class LANet(nn.Module):
-    def __init__(self, dropout=DROPOUT_P):
+    def __init__(self, dropout=DROPOUT_P, activation_cache_params: Optional[dict] = None):
         super(LANet, self).__init__()
         self.device = select_device()
         self.model = models.resnet50(
@@ -39,6 +40,9 @@ class LANet(nn.Module):
             [nn.Conv2d(in_channels=2048, out_channels=i, kernel_size=1).to(self.device) for i in out_features])
 
         self.cnn_blocks = self.extract_cnn_blocks()
+        # Size of the flattened output: the final feature map and the weighted activation maps, pooled to the feature map size
+        self.num_output_features = (2048 + sum(out_features)) * \
+            NUM_CLASSES * NUM_CLASSES
 
         # Remove the final fully connected layer from the ResNet model
         self.model.fc = nn.Identity()
@@ -48,6 +52,22 @@ class LANet(nn.Module):
         # for param in self.model.fc.parameters():
         #     param.requires_grad = True
 
+        # The backbone activations are cached only if the preprocessing parameters of the images are given, since they are part of the cache key
+        self.activation_cache = None
+        if activation_cache_params is not None:
+            # NOTE: the backbone is kept in eval mode, otherwise its batch norm layers would change the activations at every step
+            self.model.eval()
+            self.split_sizes = [2048, *out_features]
+            self.activation_cache = LANetActivationCache(
+                self.model, activation_shape=(sum(self.split_sizes), NUM_CLASSES, NUM_CLASSES),
+                params={"image_size": IMAGE_SIZE, **activation_cache_params})
+
+    def train(self, mode: bool = True):
+        super().train(mode)
+        if self.activation_cache is not None:
+            self.model.eval()
+        return self
+
     def mixed_sigmoid(self, Y):
         M = self.sigmoid(Y) * Y
         return M
@@ -71,30 +91,74 @@ class LANet(nn.Module):
                     blocks.append(layer)
         return blocks
 
-    def forward(self, x):
-        resnet_feature_map = self.model_features(x)
-        cat_output = resnet_feature_map
-        C_x, H_x, W_x = x.shape[1:]
-        for index, cnn_block in enumerate(self.cnn_blocks):
-            if index == 0:
-                curr_activation_map = x
+    def extract_activations(self, x) -> Tuple[torch.Tensor, List[torch.Tensor]]:
+        """
+        Runs the ResNet trunk once, returning the final feature map and the pooled activation map of every CNN block.
+        The output of the last block is the same as model_features(x), so the trunk doesn't need to be run twice.
+        """
+        pooled_activation_maps = []
+        curr_activation_map = x
+        for cnn_block in self.cnn_blocks:
             curr_activation_map = cnn_block(curr_activation_map)
-            # NOTE: just for speed, skip some cnn blocks
-            #if index > 5:
-            #    continue
-            C_o, H_o, W_o = curr_activation_map.shape[1:]
-            # print(f"C_o: {C_o}, H_o: {H_o}, W_o: {W_o}")
-
-            avg_pool_feature_map = self.adaptive_avg_pool(
-                curr_activation_map)
+            pooled_activation_maps.append(
+                self.adaptive_avg_pool(curr_activation_map))
+        return curr_activation_map, pooled_activation_maps
+
+    def attention_head(self, resnet_feature_map: torch.Tensor, pooled_activation_maps: List[torch.Tensor]) -> torch.Tensor:
+        """
+        Weights the pooled activation maps with the attention computed on the final feature map,
+        writing them after the feature map in a preallocated output.
+        """
+        B, C, H, W = resnet_feature_map.shape
+        num_channels = C + sum(activation_map.shape[1]
+                               for activation_map in pooled_activation_maps)
+        cat_output = resnet_feature_map.new_empty((B, num_channels, H, W))
+        cat_output[:, :C] = resnet_feature_map
+        start = C
+        for index, avg_pool_feature_map in enumerate(pooled_activation_maps):
             conv1d_feature_map = self.conv1x1_layers[index](
                 resnet_feature_map)
             conv_1d_feature_map = self.mixed_sigmoid(conv1d_feature_map)
-            output = avg_pool_feature_map * conv_1d_feature_map
-            cat_output = torch.cat((cat_output, output), dim=1)
-        # print(f"Cat output shape is {cat_output.shape}")
+            end = start + conv_1d_feature_map.shape[1]
+            cat_output[:, start:end] = avg_pool_feature_map * \
+                conv_1d_feature_map
+            start = end
         return cat_output
 
+    def cached_activations(self, x, keys: List[str]) -> torch.Tensor:
+        """
+        Returns the backbone activations of the batch concatenated along the channels, reading them from the cache when possible.
+        The missing ones are computed and stored, except for the samples with an empty key (e.g. freshly augmented images).
+        """
+        activations = x.new_empty((len(x), *self.activation_cache.store.shape))
+        cached = [i for i, key in enumerate(keys)
+                  if key and key in self.activation_cache]
+        missing = [i for i, key in enumerate(keys)
+                   if not key or key not in self.activation_cache]
+        if cached:
+            activations[cached] = self.activation_cache.get_batch(
+                [keys[i] for i in cached], device=x.device).to(x.dtype)
+        if missing:
+            with torch.no_grad():
+                resnet_feature_map, pooled_activation_maps = self.extract_activations(
+                    x[missing])
+                missing_activations = torch.cat(
+                    (resnet_feature_map, *pooled_activation_maps), dim=1)
+            activations[missing] = missing_activations
+            to_store = [j for j, i in enumerate(missing) if keys[i]]
+            if to_store:
+                self.activation_cache.put_batch(
+                    [keys[missing[j]] for j in to_store], missing_activations[to_store])
+        return activations
+
+    def forward(self, x, keys: Optional[List[str]] = None):
+        if keys is None or self.activation_cache is None:
+            resnet_feature_map, pooled_activation_maps = self.extract_activations(
+                x)
+        else:
+            resnet_feature_map, *pooled_activation_maps = torch.split(
+                self.cached_activations(x, keys), self.split_sizes, dim=1)
+        return self.attention_head(resnet_feature_map, pooled_activation_maps)
 
 if __name__ == "__main__":
     cam_instance = GradCAM()
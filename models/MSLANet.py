@@ -2,65 +2,54 @@ import torch
 from torch import nn
 from models.LANet import LANet
 from models.GradCAM import GradCAM
+from models.MultiDropoutHead import MultiDropoutHead
 from utils.utils import select_device
-from config import DROPOUT_P, NUM_CLASSES, HIDDEN_SIZE, NUM_DROPOUT_LAYERS
+from config import DROPOUT_P, NUM_CLASSES, HIDDEN_SIZE, NUM_DROPOUT_LAYERS, VIEW_FUSION
 
 # Note: Our version of the model (MSLANet v2) exploits the same class structure as the original MSLANet, but we have made some changes to the data preprocessing part.
 class MSLANet(nn.Module):
-    def __init__(self, num_classes=NUM_CLASSES, hidden_layers=HIDDEN_SIZE, dropout_num=NUM_DROPOUT_LAYERS, dropout_p=DROPOUT_P):
+    def __init__(self, num_classes=NUM_CLASSES, hidden_layers=HIDDEN_SIZE, dropout_num=NUM_DROPOUT_LAYERS, dropout_p=DROPOUT_P, view_fusion=VIEW_FUSION, num_views=3, activation_cache_params=None):
         super(MSLANet, self).__init__()
+        if view_fusion not in ["mean", "learned"]:
+            raise ValueError(
+                f"View fusion {view_fusion} not implemented, use 'mean' or 'learned'")
+        self.view_fusion = view_fusion
+        self.num_views = num_views
+        # Logits of the weights of the views (original image, low and high GradCAM crops), used with the learned fusion
+        self.view_weights = nn.Parameter(torch.zeros(
+            num_views)) if view_fusion == "learned" else None
         self.device = select_device()
-        self.lanet_model = LANet().to(self.device)
-        self.dropout = nn.Dropout(p=DROPOUT_P)
-        self.relu = nn.ReLU()
-        self.flatten = nn.Flatten()
+        self.lanet_model = LANet(
+            activation_cache_params=activation_cache_params).to(self.device)
         self.dropout_num = dropout_num
         self.hidden_layers = hidden_layers
         self.dropout_p = dropout_p
-        self.first_fc_layers = [nn.Linear(1, num_classes).to(self.device) for _ in range(dropout_num)] if len(hidden_layers) == 0 else [nn.Linear(1, hidden_layers[0]).to(self.device) for _ in range(dropout_num)]
-        self.next_fc_layers = [[nn.Linear(hidden_layers[j-1], hidden_layers[j], bias=False).to(self.device) for j in range(1, len(hidden_layers))] for _ in range(dropout_num)] if len(hidden_layers) > 0 else []
-        self.final_fc_layers = [nn.Linear(hidden_layers[-1], num_classes, bias=False).to(self.device) for _ in range(dropout_num)] if len(hidden_layers) > 0 else []
-        self.first_batch_norm_layer = nn.BatchNorm1d(hidden_layers[0]).to(self.device) if len(hidden_layers) > 0 else nn.BatchNorm1d(num_classes).to(self.device)
-        self.next_batch_norm_layers = [nn.BatchNorm1d(hidden_layers[j]).to(self.device) for j in range(1, len(hidden_layers))] if len(hidden_layers) > 0 else []
-        self.final_batch_norm_layer = nn.BatchNorm1d(num_classes).to(self.device) if len(hidden_layers) > 0 else None
+        self.head = MultiDropoutHead(in_features=self.lanet_model.num_output_features, num_classes=num_classes,
+                                     hidden_layers=hidden_layers, dropout_num=dropout_num, dropout_p=dropout_p).to(self.device)
 
-    def forward(self, x):
-        lanet_output = self.lanet_model(x).to(self.device)
-        dropout_preds = []
+    def fuse_views(self, view_outputs):
+        """
+        Fuses the (V, B, C) logits of the views into the (B, C) logits of the images.
+        """
+        if self.view_fusion == "mean":
+            return view_outputs.mean(dim=0)
+        weights = torch.softmax(self.view_weights, dim=0)
+        return torch.einsum("v,vbc->bc", weights, view_outputs)
 
-        for i in range(self.dropout_num):
-            if len(self.hidden_layers) == 0:
-                if self.first_fc_layers[i].in_features == 1:
-                    lanet_shape = lanet_output.shape
-                    input_size = lanet_shape[1] * lanet_shape[2] * lanet_shape[3]
-                    self.first_fc_layers[i] = nn.Linear(input_size, NUM_CLASSES).to(self.device)
+    def forward(self, x, keys=None):
+        """
+        x is either a batch of images, or a list with the batches of the views of the images (original image and GradCAM crops).
+        The views are stacked into a single batch of V * B images, so the backbone runs only once, and their logits are fused.
+        keys are the activation cache keys of the images (see LANet.cached_activations), with one list per view when x is a list.
+        """
+        if not isinstance(x, (list, tuple)):
+            return self.classify(x, keys)
+        num_views, batch_size = len(x), len(x[0])
+        if keys is not None:
+            keys = [key for view_keys in keys for key in view_keys]
+        view_outputs = self.classify(torch.cat(list(x), dim=0), keys)
+        return self.fuse_views(view_outputs.view(num_views, batch_size, -1))
 
-                dropout_layer = self.flatten(lanet_output)
-                dropout_layer = self.dropout(dropout_layer)
-                dropout_layer = self.relu(dropout_layer)
-                dropout_layer = self.first_fc_layers[i](dropout_layer)
-                dropout_layer = self.first_batch_norm_layer(dropout_layer)
-                dropout_preds.append(dropout_layer)
-            else:
-                if self.first_fc_layers[i].in_features == 1:
-                    lanet_shape = lanet_output.shape
-                    input_size = lanet_shape[1] * lanet_shape[2] * lanet_shape[3]
-                    self.first_fc_layers[i] = nn.Linear(input_size, self.hidden_layers[0]).to(self.device)
-
-                dropout_layer = self.flatten(lanet_output)
-                dropout_layer = self.dropout(dropout_layer)
-                for j in range(len(self.hidden_layers)):
-                    if j == 0:
-                        dropout_layer = self.first_fc_layers[i](dropout_layer)
-                        dropout_layer = self.relu(dropout_layer)
-                        dropout_layer = self.first_batch_norm_layer(dropout_layer)
-                    else:
-                        dropout_layer = self.next_fc_layers[i][j-1](dropout_layer)
-                        dropout_layer = self.relu(dropout_layer)
-                        dropout_layer = self.next_batch_norm_layers[j-1](dropout_layer)
-                dropout_layer = self.final_fc_layers[i](dropout_layer)
-                dropout_layer = self.final_batch_norm_layer(dropout_layer)
-            dropout_preds.append(dropout_layer)
-        
-        average_dropout_layers = torch.stack(dropout_preds).mean(dim=0)
-        return average_dropout_layers
\ No newline at end of file
+    def classify(self, x, keys=None):
+        lanet_output = self.lanet_model(x, keys).to(self.device)
+        return self.head(lanet_output)
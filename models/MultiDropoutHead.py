@@ -0,0 +1,67 @@
+import math
+from typing import List, Optional
+
+import torch
+from torch import nn
+
+
+class MultiDropoutHead(nn.Module):
+    """
+    Ensemble of dropout_num classification heads with the same architecture, each one with its own dropout mask and weights.
+    The weights of all the heads are stacked, so every layer is evaluated for all the heads at once with a batched matmul,
+    and the predictions of the heads are averaged. The batch norm layers are shared by the heads.
+    """
+
+    def __init__(self, in_features: int, num_classes: int, hidden_layers: List[int], dropout_num: int, dropout_p: float):
+        super(MultiDropoutHead, self).__init__()
+        self.in_features = in_features
+        self.dropout_num = dropout_num
+        self.hidden_layers = hidden_layers
+        self.dropout = nn.Dropout(p=dropout_p)
+        self.relu = nn.ReLU()
+        self.flatten = nn.Flatten()
+
+        layer_sizes = [in_features, *hidden_layers, num_classes]
+        # Only the first layer has a bias, as in the original MSLANet heads
+        self.weights = nn.ParameterList([nn.Parameter(torch.empty(dropout_num, layer_sizes[j], layer_sizes[j+1]))
+                                         for j in range(len(layer_sizes) - 1)])
+        self.first_bias = nn.Parameter(
+            torch.empty(dropout_num, layer_sizes[1]))
+        self.first_batch_norm_layer = nn.BatchNorm1d(layer_sizes[1])
+        self.next_batch_norm_layers = nn.ModuleList(
+            [nn.BatchNorm1d(hidden_layers[j]) for j in range(1, len(hidden_layers))])
+        self.final_batch_norm_layer = nn.BatchNorm1d(
+            num_classes) if len(hidden_layers) > 0 else None
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # Same initialization of nn.Linear, for every head
+        for weight in self.weights:
+            bound = 1 / math.sqrt(weight.shape[1])
+            nn.init.uniform_(weight, -bound, bound)
+        nn.init.uniform_(self.first_bias, -1 / math.sqrt(self.in_features),
+                         1 / math.sqrt(self.in_features))
+
+    def batch_norm(self, x: torch.Tensor, batch_norm_layer: Optional[nn.BatchNorm1d]) -> torch.Tensor:
+        # The (dropout_num, B, C) outputs of the heads are normalized together, as a batch of dropout_num * B samples
+        dropout_num, batch_size, num_features = x.shape
+        return batch_norm_layer(x.reshape(-1, num_features)).view(dropout_num, batch_size, num_features)
+
+    def forward(self, x):
+        x = self.flatten(x)
+        # Every head gets its own dropout mask
+        x = self.dropout(x.unsqueeze(0).expand(
+            self.dropout_num, *x.shape))
+        if len(self.hidden_layers) == 0:
+            x = self.relu(x)
+            x = torch.baddbmm(self.first_bias.unsqueeze(1), x, self.weights[0])
+            x = self.batch_norm(x, self.first_batch_norm_layer)
+            return x.mean(dim=0)
+
+        x = torch.baddbmm(self.first_bias.unsqueeze(1), x, self.weights[0])
+        x = self.batch_norm(self.relu(x), self.first_batch_norm_layer)
+        for weight, batch_norm_layer in zip(self.weights[1:-1], self.next_batch_norm_layers):
+            x = self.batch_norm(self.relu(torch.bmm(x, weight)), batch_norm_layer)
+        x = torch.bmm(x, self.weights[-1])
+        x = self.batch_norm(x, self.final_batch_norm_layer)
+        return x.mean(dim=0)
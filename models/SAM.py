@@ -1,6 +1,7 @@
-from typing import Optional
+from typing import Optional, Tuple
 from torch import nn
 import torch
+import torch.nn.functional as F
 from transformers import SamProcessor, SamModel, SamConfig, SamImageProcessor
 from utils.utils import select_device
 
@@ -12,10 +13,14 @@ class SAM(nn.Module):
     def __init__(self,
                  img_size: int = 128,
                  custom_size: bool = False,
-                 checkpoint_path: Optional[str] = None):
+                 checkpoint_path: Optional[str] = None,
+                 # If True, images and masks always go through the HF SamProcessor (slower, used for parity checks)
+                 use_processor: bool = False):
         super(SAM, self).__init__()
         self.img_size = img_size
         self.custom_size = custom_size
+        # NOTE: the fast path doesn't resize and pad the images, so it is available only with custom_size
+        self.use_processor = use_processor or not custom_size
         config: SamConfig = SamConfig.from_pretrained(
             "facebook/sam-vit-base")
         config.vision_config.image_size = img_size if custom_size else 1024
@@ -35,6 +40,10 @@ class SAM(nn.Module):
             }, do_rescale=False, do_pad=not custom_size)
         self.processor: SamProcessor = SamProcessor(
             image_processor=sam_image_processor)
+        self.register_buffer("pixel_mean", torch.tensor(
+            sam_image_processor.image_mean).view(1, 3, 1, 1), persistent=False)
+        self.register_buffer("pixel_std", torch.tensor(
+            sam_image_processor.image_std).view(1, 3, 1, 1), persistent=False)
 
         incompatible_blocks = [
             "vision_encoder.pos_embed",
@@ -54,10 +63,56 @@ class SAM(nn.Module):
                     continue
                 param.requires_grad_(False)
 
-    def forward(self, images: torch.Tensor, bboxes: Optional[torch.Tensor] = None):
+    def normalize_pixels(self, images: torch.Tensor) -> torch.Tensor:
+        # Same normalization of the SamProcessor (do_rescale=False, no resize and no padding with custom_size)
+        device = self.model.device
+        return (images.to(device, torch.float32) - self.pixel_mean.to(device)) / self.pixel_std.to(device)
+
+    def get_image_embeddings(self, images: torch.Tensor) -> torch.Tensor:
+        """
+        Returns the output of the vision encoder, that can be given to forward as image_embeddings.
+        """
+        if len(images.shape) == 3:
+            images = images.unsqueeze(0)
+        return self.model.get_image_embeddings(self.normalize_pixels(images))
+
+    def forward(self, images: Optional[torch.Tensor] = None, bboxes: Optional[torch.Tensor] = None, output_size: Optional[Tuple[int, int]] = None,
+                image_embeddings: Optional[torch.Tensor] = None):
+        """
+        Returns the (B, 1, H, W) mask logits of the images. If output_size (height, width) is given, the masks are
+        interpolated directly to that size, otherwise they have the size of the input images.
+        If the precomputed image_embeddings are given, the vision encoder is skipped (and images are not needed).
+        """
+        if image_embeddings is not None:
+            device = self.model.device
+            low_res_masks = self.model(image_embeddings=image_embeddings.to(device),
+                                       input_boxes=bboxes.to(device, torch.float32).reshape(
+                                           len(image_embeddings), -1, 4) if bboxes is not None else None,
+                                       multimask_output=False)
+            return F.interpolate(low_res_masks.pred_masks.flatten(0, 1),
+                                 size=output_size if output_size is not None else (
+                                     self.img_size, self.img_size),
+                                 mode="bilinear", align_corners=False)
         if len(images.shape) == 3:
             images = images.unsqueeze(0)
+        if self.use_processor:
+            upscaled_masks = self.forward_with_processor(images, bboxes)
+            if output_size is not None:
+                upscaled_masks = F.interpolate(
+                    upscaled_masks, size=output_size, mode="bilinear", align_corners=False)
+            return upscaled_masks
+
+        device = self.model.device
+        low_res_masks = self.model(pixel_values=self.normalize_pixels(images),
+                                   input_boxes=bboxes.to(device, torch.float32).reshape(
+                                       len(images), -1, 4) if bboxes is not None else None,
+                                   multimask_output=False)
+        # A single interpolation from the low resolution masks to the output size
+        return F.interpolate(low_res_masks.pred_masks.flatten(0, 1),
+                             size=output_size if output_size is not None else images.shape[-2:],
+                             mode="bilinear", align_corners=False)
 
+    def forward_with_processor(self, images: torch.Tensor, bboxes: Optional[torch.Tensor] = None):
         inputs = self.processor(
             images, input_boxes=[bboxes.tolist()] if bboxes is not None else None, return_tensors="pt")
         inputs = {k: v.squeeze(0) for k, v in inputs.items()}
@@ -75,6 +130,7 @@ class SAM(nn.Module):
         if len(images.shape) == 3:
             images = images.unsqueeze(0)
 
+        device = self.model.device
         low_res_masks = self.model(pixel_values=images.to(device),
                                    input_boxes=bboxes.to(
                                        torch.float32).to(device) if bboxes is not None else None,
@@ -0,0 +1,62 @@
+import time
+
+import torch
+
+from config import IMAGE_SIZE
+from models.LANet import LANet
+from utils.utils import select_device
+
+
+def two_pass_forward(lanet: LANet, x: torch.Tensor) -> torch.Tensor:
+    """
+    Previous LANet forward, which runs the ResNet trunk twice and grows the output with a torch.cat per block.
+    """
+    resnet_feature_map = lanet.model_features(x)
+    cat_output = resnet_feature_map
+    for index, cnn_block in enumerate(lanet.cnn_blocks):
+        if index == 0:
+            curr_activation_map = x
+        curr_activation_map = cnn_block(curr_activation_map)
+        avg_pool_feature_map = lanet.adaptive_avg_pool(curr_activation_map)
+        conv1d_feature_map = lanet.conv1x1_layers[index](resnet_feature_map)
+        conv_1d_feature_map = lanet.mixed_sigmoid(conv1d_feature_map)
+        output = avg_pool_feature_map * conv_1d_feature_map
+        cat_output = torch.cat((cat_output, output), dim=1)
+    return cat_output
+
+
+def benchmark(forward_fn, x: torch.Tensor, iterations: int) -> float:
+    forward_fn(x)  # Warmup
+    if x.device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        forward_fn(x)
+    if x.device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iterations
+
+
+def benchmark_lanet(batch_size: int = 16, iterations: int = 10):
+    """
+    Checks that the single pass LANet forward matches the previous one, and compares their speed.
+    """
+    device = select_device()
+    lanet = LANet().to(device).eval()
+    x = torch.rand((batch_size, 3, *IMAGE_SIZE), device=device)
+    with torch.no_grad():
+        reference_output = two_pass_forward(lanet, x)
+        output = lanet(x)
+        max_difference = (output - reference_output).abs().max().item()
+        print(
+            f"--LANet Benchmark-- Output shape: {tuple(output.shape)}, max absolute difference: {max_difference:.2e}")
+        assert torch.allclose(output, reference_output, rtol=1e-4, atol=1e-5)
+
+        two_pass_time = benchmark(
+            lambda images: two_pass_forward(lanet, images), x, iterations)
+        single_pass_time = benchmark(lanet, x, iterations)
+    print(f"--LANet Benchmark-- Two pass forward: {two_pass_time * 1000:.1f} ms/batch, single pass forward: {single_pass_time * 1000:.1f} ms/batch ({two_pass_time / single_pass_time:.2f}x)")
+
+
+if __name__ == "__main__":
+    benchmark_lanet()
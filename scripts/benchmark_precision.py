@@ -0,0 +1,71 @@
+import torch
+
+from config import ARCHITECTURE, BATCH_SIZE, DYNAMIC_SEGMENTATION_STRATEGY, KEEP_BACKGROUND, LR, NORMALIZE, RANDOM_SEED, REG, SEGMENTATION_STRATEGY
+from train_loops.CNN_pretrained import get_model, get_normalization_statistics
+from train_loops.train_loop import train_eval_loop
+from utils.dataloader_utils import get_dataloder_from_strategy
+from utils.precision import autocast_dtype
+from utils.utils import select_device, set_seed
+
+# (precision, channels_last) modes compared by the benchmark
+MODES = [("fp32", False), ("fp32", True), ("bf16", False),
+         ("bf16", True), ("fp16", True)]
+# dtype of the autocast of each precision
+PRECISION_DTYPES = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def benchmark_precision(epochs: int = 2, limit: int = 2000, batch_size: int = BATCH_SIZE, modes=MODES):
+    """
+    Trains the ARCHITECTURE model (from the same seed) in each precision and memory format mode,
+    and compares the training throughput and the final validation recall.
+    The modes that the device runs in another precision (e.g. fp16 on the cpu, which runs in bf16) are skipped. Nothing is saved on disk.
+    """
+    device = select_device()
+    supported_modes = [(precision, channels_last) for precision, channels_last in modes
+                       if autocast_dtype(device, precision) == PRECISION_DTYPES[precision]]
+    for precision, channels_last in modes:
+        if (precision, channels_last) not in supported_modes:
+            print(
+                f"--Precision Benchmark-- Skipping {precision}{' channels_last' if channels_last else ''}, not supported on {device}")
+    dataloader = get_dataloder_from_strategy(
+        strategy=SEGMENTATION_STRATEGY,
+        dynamic_segmentation_strategy=DYNAMIC_SEGMENTATION_STRATEGY,
+        limit=limit,
+        dynamic_load=False,
+        oversample_train=False,
+        normalize=NORMALIZE,
+        normalization_statistics=get_normalization_statistics(),
+        batch_size=batch_size,
+        keep_background=KEEP_BACKGROUND,
+        load_synthetic=False)
+    train_loader = dataloader.get_train_dataloder()
+    val_loader = dataloader.get_val_dataloader()
+
+    results = {}
+    for precision, channels_last in supported_modes:
+        set_seed(RANDOM_SEED)
+        model = get_model(device)
+        optimizer = torch.optim.AdamW(
+            model.parameters(), lr=LR, weight_decay=REG)
+        scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(
+            optimizer, T_max=epochs, eta_min=1e-4)
+        config = {"architecture": f"{ARCHITECTURE}_benchmark", "epochs": epochs,
+                  "use_wandb": False, "multiple_loss": False,
+                  "precision": precision, "channels_last": channels_last}
+        mode_results = train_eval_loop(device, train_loader=train_loader, val_loader=val_loader, model=model,
+                                       config=config, optimizer=optimizer, scheduler=scheduler,
+                                       precision=precision, channels_last=channels_last, save=False)
+        results[(precision, channels_last)] = mode_results
+        print(
+            f"--Precision Benchmark-- {precision}{' channels_last' if channels_last else ''}: {mode_results['training_throughput']:.1f} images/s, validation recall: {mode_results['validation_recall']:.2f}%")
+
+    baseline = results.get(("fp32", False))
+    print(f"--Precision Benchmark-- Summary on {device} ({ARCHITECTURE}, {epochs} epochs)")
+    for (precision, channels_last), mode_results in results.items():
+        speedup = f" ({mode_results['training_throughput'] / baseline['training_throughput']:.2f}x)" if baseline else ""
+        print(f"{precision:>5} {'channels_last' if channels_last else 'contiguous':>13}: {mode_results['training_throughput']:8.1f} images/s{speedup}, validation recall: {mode_results['validation_recall']:.2f}%")
+    return results
+
+
+if __name__ == "__main__":
+    benchmark_precision()
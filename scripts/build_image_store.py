@@ -0,0 +1,24 @@
+import os
+
+import pandas as pd
+from config import AUGMENTED_IMAGES_DIR, DATASET_TRAIN_DIR, IMAGE_STORE_DIR, METADATA_TRAIN_DIR, SYNTHETIC_METADATA_TRAIN_DIR
+from utils.image_store import build_image_store
+
+
+def build():
+    """
+    Decodes all the real and synthetic images once and stores them in the memory-mapped image store,
+    used by the dataloaders when use_image_store=True.
+    """
+    metadata = pd.read_csv(METADATA_TRAIN_DIR)
+    image_paths = [(image_id, os.path.join(DATASET_TRAIN_DIR, image_id + '.jpg'))
+                   for image_id in metadata['image_id']]
+    if os.path.exists(SYNTHETIC_METADATA_TRAIN_DIR):
+        synthetic_metadata = pd.read_csv(SYNTHETIC_METADATA_TRAIN_DIR)
+        image_paths.extend([(image_id, os.path.join(AUGMENTED_IMAGES_DIR, image_id + '.png'))
+                            for image_id in synthetic_metadata['image_id']])
+    build_image_store(image_paths, IMAGE_STORE_DIR)
+
+
+if __name__ == "__main__":
+    build()
@@ -1,12 +1,15 @@
+import math
 import os
+from typing import List, Tuple
 import numpy as np
 import torch
 from tqdm import tqdm
 from PIL import Image
-from config import DATA_DIR, DATASET_TRAIN_DIR, METADATA_TRAIN_DIR
+from config import DATA_DIR, DATASET_TRAIN_DIR, GRADCAM_HIGH_THRESHOLD, GRADCAM_LOW_THRESHOLD, IMAGE_SIZE, METADATA_TRAIN_DIR
 from dataloaders.ImagesAndSegmentationDataLoader import ImagesAndSegmentationDataLoader
-from models.GradCAM import GradCAM
+from models.GradCAM import GradCAM, crops_from_raw_cams
 from shared.constants import IMAGENET_STATISTICS
+from utils.array_store import ArrayStore
 from utils.utils import select_device
 
 
@@ -27,7 +30,17 @@ def generate_gradcam_from_train_dir():
             output_dir, format="PNG")
 
 
-def generate_gradcam_from_dataloader():
+def get_raw_cams_store(data_dir: str, split: str, image_size: Tuple[int, int] = IMAGE_SIZE) -> ArrayStore:
+    # The CAMs have the resolution of the last ResNet layer, which downsamples the images by 32
+    cam_size = (math.ceil(image_size[0] / 32), math.ceil(image_size[1] / 32))
+    return ArrayStore(os.path.join(data_dir, "raw_cams", split), shape=(1, *cam_size))
+
+
+def generate_gradcam_from_dataloader(save_crops: bool = False, flush_every: int = 100):
+    """
+    Saves the images of the dataset along with their raw GradCAMs, from which MSLANetDataLoader derives the crops at any threshold.
+    If save_crops is True, the crops at GRADCAM_LOW_THRESHOLD and GRADCAM_HIGH_THRESHOLD are saved as PNG files too.
+    """
     dataloader = ImagesAndSegmentationDataLoader(
         limit=None,
         load_segmentations=False,
@@ -44,33 +57,40 @@ def generate_gradcam_from_dataloader():
     val_loader = dataloader.get_val_dataloader()
     test_loader = dataloader.get_test_dataloader()
 
-    low_threshold = 70
-    high_threshold = 110
+    low_threshold = GRADCAM_LOW_THRESHOLD
+    high_threshold = GRADCAM_HIGH_THRESHOLD
 
     device = select_device()
-    cam_instance = GradCAM().to(device)
+    cam_instance = GradCAM(device=device)
     data_dir = os.path.join(DATA_DIR, "offline_computed_dataset_no_synthetic")
     os.makedirs(data_dir, exist_ok=True)
 
     augmentation_tracking = {}
 
-    if not os.path.exists(os.path.join(data_dir, "offline_images", "train")):
-        total_images_generated = 0
+    raw_cams_stores = {split: get_raw_cams_store(data_dir, split)
+                       for split in ["train", "val", "test"]}
+    # NOTE: the raw CAMs are flushed only every flush_every batches, so the process is restored from the last flush
+    if save_crops:
+        if not os.path.exists(os.path.join(data_dir, "offline_images", "train")):
+            total_images_generated = 0
+        else:
+            total_images_generated = sum(1 for _ in os.listdir(os.path.join(
+                data_dir, "offline_images", "train")))
     else:
-        total_images_generated = sum(1 for _ in os.listdir(os.path.join(
-            data_dir, "offline_images", "train")))
+        total_images_generated = len(raw_cams_stores["train"])
 
     print(f"Total train images generated: {total_images_generated}")
 
+    thresholds = [low_threshold, high_threshold]
     image_generated_now = 0
     pbar = tqdm(total=len(train_loader),
                 desc="Generating GradCAMs for train")
-    for batch in train_loader:
+    for batch_idx, batch in enumerate(train_loader):
         images, labels, image_ids, is_augmented_list = batch
         pbar.update(1)
+        images_to_generate, image_names = [], []
         for image, label, image_id, is_augmented in zip(images, labels, image_ids, is_augmented_list):
             image_generated_now += 1
-            image = image.to(device)
             if image_id not in augmentation_tracking:
                 augmentation_tracking[image_id] = 0
             if is_augmented:
@@ -88,49 +108,62 @@ def generate_gradcam_from_dataloader():
                 print(
                     f"Restoring with augmentation {augmentation_tracking}")
 
-            if os.path.exists(os.path.join(data_dir, f"gradcam_{low_threshold}", "train", image_id)) and \
-                    os.path.exists(os.path.join(data_dir, f"gradcam_{high_threshold}", "train", image_id)) and \
-                os.path.exists(os.path.join(data_dir, "offline_images", "train", image_id)):
+            if is_generated(data_dir, "train", image_id, thresholds, raw_cams_stores["train"], save_crops):
                 continue
-            save_gradcam(cam_instance, image, image_id, low_threshold,
-                         save_dir=os.path.join(data_dir, f"gradcam_{low_threshold}", "train"))
-            save_gradcam(cam_instance, image, image_id, high_threshold,
-                         save_dir=os.path.join(data_dir, f"gradcam_{high_threshold}", "train"))
-            save_image(image, image_id, save_dir=os.path.join(
-                data_dir, "offline_images", "train"))
+            images_to_generate.append(image)
+            image_names.append(image_id)
+        save_gradcams(cam_instance, images_to_generate, image_names, thresholds,
+                      data_dir=data_dir, split="train", device=device,
+                      raw_cams_store=raw_cams_stores["train"], save_crops=save_crops)
+        if (batch_idx + 1) % flush_every == 0:
+            raw_cams_stores["train"].flush()
+    raw_cams_stores["train"].flush()
     pbar.close()
 
-    for batch in tqdm(val_loader, desc=f"Generating GradCAMs for val"):
-        images, labels, image_ids, is_augmented_list = batch
-        for image, label, image_id, is_augmented in zip(images, labels, image_ids, is_augmented_list):
-            image = image.to(device)
-            image_id = image_id + ".png"
-            if os.path.exists(os.path.join(data_dir, f"gradcam_{low_threshold}", "val", image_id)) and \
-                    os.path.exists(os.path.join(data_dir, f"gradcam_{high_threshold}", "val", image_id)) and \
-                os.path.exists(os.path.join(data_dir, "offline_images", "val", image_id)):
-                continue
-            save_gradcam(cam_instance, image, image_id, low_threshold,
-                         save_dir=os.path.join(data_dir, f"gradcam_{low_threshold}", "val"))
-            save_gradcam(cam_instance, image, image_id, high_threshold,
-                         save_dir=os.path.join(data_dir, f"gradcam_{high_threshold}", "val"))
-            save_image(image, image_id, save_dir=os.path.join(
-                data_dir, "offline_images", "val"))
-
-    for batch in tqdm(test_loader, desc=f"Generating GradCAMs for test"):
-        images, labels, image_ids, is_augmented_list = batch
-        for image, label, image_id, is_augmented in zip(images, labels, image_ids, is_augmented_list):
-            image = image.to(device)
-            image_id = image_id + ".png"
-            if os.path.exists(os.path.join(data_dir, f"gradcam_{low_threshold}", "test", image_id)) and \
-                    os.path.exists(os.path.join(data_dir, f"gradcam_{high_threshold}", "test", image_id)) and \
-                os.path.exists(os.path.join(data_dir, "offline_images", "test", image_id)):
-                continue
-            save_gradcam(cam_instance, image, image_id, low_threshold,
-                         save_dir=os.path.join(data_dir, f"gradcam_{low_threshold}", "test"))
-            save_gradcam(cam_instance, image, image_id, high_threshold,
-                         save_dir=os.path.join(data_dir, f"gradcam_{high_threshold}", "test"))
-            save_image(image, image_id, save_dir=os.path.join(
-                data_dir, "offline_images", "test"))
+    for split, loader in [("val", val_loader), ("test", test_loader)]:
+        for batch in tqdm(loader, desc=f"Generating GradCAMs for {split}"):
+            images, labels, image_ids, is_augmented_list = batch
+            images_to_generate, image_names = [], []
+            for image, image_id in zip(images, image_ids):
+                image_id = image_id + ".png"
+                if is_generated(data_dir, split, image_id, thresholds, raw_cams_stores[split], save_crops):
+                    continue
+                images_to_generate.append(image)
+                image_names.append(image_id)
+            save_gradcams(cam_instance, images_to_generate, image_names, thresholds,
+                          data_dir=data_dir, split=split, device=device,
+                          raw_cams_store=raw_cams_stores[split], save_crops=save_crops)
+        raw_cams_stores[split].flush()
+
+
+def is_generated(data_dir: str, split: str, image_name: str, thresholds: List[int], raw_cams_store: ArrayStore, save_crops: bool = False) -> bool:
+    if save_crops and not all(os.path.exists(os.path.join(data_dir, f"gradcam_{threshold}", split, image_name)) for threshold in thresholds):
+        return False
+    return os.path.splitext(image_name)[0] in raw_cams_store and \
+        os.path.exists(os.path.join(
+            data_dir, "offline_images", split, image_name))
+
+
+def save_gradcams(gradcam_instance: GradCAM, images: List[torch.Tensor], image_names: List[str], thresholds: List[int], data_dir: str, split: str, device: torch.device, raw_cams_store: ArrayStore, save_crops: bool = False):
+    """
+    Computes the raw GradCAMs of the whole batch and stores them (keyed by the image name without extension) along with the images.
+    If save_crops is True, the crops for all the thresholds are derived from the same CAMs and saved as well.
+    """
+    if len(images) == 0:
+        return
+    images = torch.stack(images).to(device)
+    cams = gradcam_instance.compute_raw_cams(images)
+    raw_cams_store.put_batch([os.path.splitext(image_name)[0] for image_name in image_names],
+                             cams.cpu().numpy())
+    if save_crops:
+        crops = crops_from_raw_cams(images, cams, thresholds)
+        for threshold, threshold_crops in zip(thresholds, crops):
+            for cropped_image, image_name in zip(threshold_crops, image_names):
+                save_image(cropped_image, image_name, save_dir=os.path.join(
+                    data_dir, f"gradcam_{threshold}", split))
+    for image, image_name in zip(images, image_names):
+        save_image(image, image_name, save_dir=os.path.join(
+            data_dir, "offline_images", split))
 
 
 def save_image(image: torch.Tensor, image_name: str, save_dir: str):
@@ -141,17 +174,5 @@ def save_image(image: torch.Tensor, image_name: str, save_dir: str):
         output_dir, format="PNG")
 
 
-def save_gradcam(gradcam_instance: GradCAM, image: torch.Tensor, image_name: str, threshold: int, save_dir: str):
-    os.makedirs(save_dir, exist_ok=True)
-    _, cropped_image, _ = gradcam_instance.generate_cam(
-        image=image,
-        threshold=threshold)
-    cropped_image = cropped_image.permute(1, 2, 0)
-
-    image_path = os.path.join(save_dir, image_name)
-    Image.fromarray((cropped_image.cpu().numpy() * 255).astype(np.uint8)).save(
-        image_path, format="PNG")
-
-
 if __name__ == "__main__":
     generate_gradcam_from_dataloader()
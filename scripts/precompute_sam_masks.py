@@ -0,0 +1,25 @@
+from dataloaders.DynamicSegmentationDataLoader import DynamicSegmentationDataLoader
+from shared.constants import IMAGENET_STATISTICS
+from shared.enums import DynamicSegmentationStrategy
+
+
+def precompute_sam_masks():
+    """
+    Fills the SAM mask cache for all the validation and test images, so that DynamicSegmentationDataLoader
+    only reads the masks from disk during training.
+    """
+    dataloder = DynamicSegmentationDataLoader(
+        limit=None,
+        dynamic_load=True,
+        upscale_train=False,
+        segmentation_strategy=DynamicSegmentationStrategy.SAM.value,
+        normalize=False,
+        normalization_statistics=IMAGENET_STATISTICS,
+        use_sam_mask_cache=True
+    )
+    dataloder.precompute_sam_masks(dataloder.val_df)
+    dataloder.precompute_sam_masks(dataloder.test_df)
+
+
+if __name__ == "__main__":
+    precompute_sam_masks()
@@ -0,0 +1,71 @@
+import os
+import pytest
+import torch
+from torch import nn
+from utils.checkpoint import CheckpointManager, checkpoint_path, load_checkpoint, load_model_weights
+
+
+def test_CheckpointManager_rotation_and_resume(tmp_path):
+    torch.manual_seed(42)
+    model = nn.Linear(4, 2)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-3)
+    scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=5)
+    manager = CheckpointManager(str(tmp_path), keep_last=2)
+    for epoch in range(1, 6):
+        model(torch.rand((3, 4))).sum().backward()
+        optimizer.step()
+        scheduler.step()
+        manager.save(epoch, model, optimizer, scheduler,
+                     is_best=epoch == 2, best_accuracy=epoch)
+    manager.close()
+
+    assert sorted(os.listdir(tmp_path)) == ["melanoma_detection_4.pt",
+                                            "melanoma_detection_5.pt", "melanoma_detection_best.pt"]
+    assert torch.load(checkpoint_path(str(tmp_path), is_best=True), weights_only=False)["epoch"] == 2
+
+    # The random state is restored too, so the resumed run draws the same numbers
+    expected_draw = torch.rand(3)
+    resumed_model = nn.Linear(4, 2)
+    resumed_optimizer = torch.optim.AdamW(resumed_model.parameters(), lr=1e-3)
+    checkpoint = load_checkpoint(checkpoint_path(
+        str(tmp_path), 5), resumed_model, resumed_optimizer)
+    assert checkpoint["best_accuracy"] == 5
+    assert torch.equal(torch.rand(3), expected_draw)
+    assert torch.equal(resumed_model.weight, model.weight)
+    assert resumed_optimizer.state_dict()["state"][0]["step"] == 5
+    assert torch.equal(load_model_weights(checkpoint_path(
+        str(tmp_path), 5), base_model=nn.Linear(4, 2))["weight"], model.weight)
+
+
+def test_CheckpointManager_delta(tmp_path):
+    def build_model():
+        # The frozen "pretrained" backbone is the same for every build of the model
+        torch.manual_seed(42)
+        backbone = nn.Sequential(nn.Linear(64, 64), nn.BatchNorm1d(64))
+        for param in backbone.parameters():
+            param.requires_grad = False
+        return nn.Sequential(backbone, nn.Linear(64, 3))
+
+    model = build_model()
+    model(torch.rand((8, 64))).sum().backward()
+    with torch.no_grad():
+        model[1].weight += 1
+    manager = CheckpointManager(str(tmp_path), asynchronous=False, delta=True)
+    manager.save(1, model)
+    manager.close()
+
+    checkpoint = torch.load(checkpoint_path(
+        str(tmp_path), 1), weights_only=False)
+    # The frozen linear layer is not stored, the running statistics of the batch norm are
+    assert set(checkpoint["model"].keys()) == {"0.1.running_mean", "0.1.running_var", "0.1.num_batches_tracked",
+                                               "1.weight", "1.bias"}
+    state_dict = load_model_weights(checkpoint_path(
+        str(tmp_path), 1), base_model=build_model())
+    for name, tensor in model.state_dict().items():
+        assert torch.equal(state_dict[name], tensor)
+
+    other_base = build_model()
+    with torch.no_grad():
+        other_base[0][0].weight += 1
+    with pytest.raises(ValueError):
+        load_model_weights(checkpoint_path(str(tmp_path), 1), base_model=other_base)
@@ -0,0 +1,37 @@
+import torch
+from utils.utils import approximate_bounding_box_to_square, crop_image_from_box, crop_images_from_boxes, get_bounding_boxes_from_segmentation, get_square_bounding_boxes
+
+
+def test_get_square_bounding_boxes():
+    torch.manual_seed(42)
+    masks = torch.zeros((8, 1, 450, 600))
+    for mask in masks:
+        row, col = torch.randint(0, 400, (1,)).item(), torch.randint(0, 550, (1,)).item()
+        height, width = torch.randint(1, 50, (2,)).tolist()
+        mask[:, row:row + height, col:col + width] = 1
+    boxes = get_square_bounding_boxes(masks)
+    for mask, box in zip(masks, boxes):
+        expected = approximate_bounding_box_to_square(
+            get_bounding_boxes_from_segmentation(mask)[0])
+        expected = [expected[0], expected[1], min(expected[2], 450), min(expected[3], 600)]
+        assert box.tolist() == expected
+
+
+def test_get_square_bounding_boxes_empty_mask():
+    boxes = get_square_bounding_boxes(torch.zeros((2, 1, 450, 600)))
+    assert boxes.tolist() == [[0, 0, 450, 600], [0, 0, 450, 600]]
+
+
+def test_crop_images_from_boxes():
+    torch.manual_seed(42)
+    images = torch.rand((4, 3, 450, 600))
+    boxes = torch.tensor([[10, 20, 310, 320], [0, 0, 450, 450],
+                          [100, 200, 150, 250], [50, 60, 274, 284]])
+    cropped_images = crop_images_from_boxes(images, boxes, size=(224, 224))
+    assert cropped_images.shape == (4, 3, 224, 224)
+    # The crop of the same size of the output is an exact slice
+    assert torch.allclose(cropped_images[3], images[3, :, 50:274, 60:284], atol=1e-5)
+    for image, box, cropped_image in zip(images, boxes, cropped_images):
+        expected = torch.from_numpy(crop_image_from_box(
+            image, box.tolist(), size=(224, 224))).permute(2, 0, 1)
+        assert (cropped_image - expected).abs().mean() < 0.05
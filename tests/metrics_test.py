@@ -0,0 +1,38 @@
+import torch
+from sklearn.metrics import accuracy_score, recall_score, roc_auc_score
+from utils.metrics import StreamingMetrics
+
+
+def test_StreamingMetrics_matches_sklearn():
+    torch.manual_seed(42)
+    num_classes = 7
+    metrics = StreamingMetrics(
+        num_classes, device=torch.device("cpu"), keep_scores=True, capacity=8)
+    all_outputs, all_labels = [], []
+    for _ in range(10):
+        outputs = torch.randn((16, num_classes))
+        # Class 6 never appears, neither in the labels nor (almost surely) in the predictions
+        labels = torch.randint(0, num_classes - 1, (16,))
+        outputs[:, 6] -= 100
+        metrics.update(outputs, labels)
+        all_outputs.append(outputs)
+        all_labels.append(labels)
+    outputs, labels = torch.cat(all_outputs), torch.cat(all_labels)
+    preds = torch.argmax(outputs, -1)
+
+    assert abs(metrics.accuracy() - accuracy_score(labels, preds) * 100) < 1e-4
+    assert abs(metrics.recall() - recall_score(labels, preds,
+               average='macro', zero_division=0) * 100) < 1e-4
+    for class_label in range(num_classes - 1):
+        binary_labels, binary_preds = labels == class_label, preds == class_label
+        class_metrics = metrics.class_metrics(class_label, with_auc=True)
+        assert abs(class_metrics["accuracy"] - accuracy_score(
+            binary_labels, binary_preds) * 100) < 1e-4
+        assert abs(class_metrics["sensitivity"] - recall_score(
+            binary_labels, binary_preds, zero_division=0) * 100) < 1e-4
+        assert abs(class_metrics["auc"] - roc_auc_score(
+            binary_labels, outputs[:, class_label]) * 100) < 1e-4
+    assert metrics.class_metrics(6, with_auc=True)["auc"] == 0
+
+    metrics.reset()
+    assert metrics.accuracy() == 0 and metrics.count == 0
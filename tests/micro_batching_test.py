@@ -0,0 +1,70 @@
+import copy
+import torch
+from torch import nn
+from utils.micro_batching import GradientAccumulator, auto_micro_batch_size, set_batch_norm_mode, split_batch
+
+
+def test_GradientAccumulator_matches_full_batch():
+    torch.manual_seed(42)
+    model = nn.Sequential(nn.Linear(8, 16), nn.BatchNorm1d(16),
+                          nn.ReLU(), nn.Linear(16, 3))
+    accumulated_model = copy.deepcopy(model)
+    images, labels = torch.rand((12, 8)), torch.randint(0, 3, (12,))
+    criterion = nn.CrossEntropyLoss()
+
+    # With frozen batch norm, the accumulated gradients are the ones of the full batch
+    model.train()
+    set_batch_norm_mode(model, "frozen")
+    criterion(model(images), labels).backward()
+
+    accumulated_model.train()
+    set_batch_norm_mode(accumulated_model, "frozen")
+    optimizer = torch.optim.SGD(accumulated_model.parameters(), lr=0)
+    accumulator = GradientAccumulator(
+        optimizer, torch.cuda.amp.GradScaler(enabled=False), effective_batch_size=12)
+    for micro_slice, micro_images, _ in split_batch(images, None, 5):
+        accumulator.backward(criterion(accumulated_model(
+            micro_images), labels[micro_slice]), len(micro_images))
+    assert accumulator.num_images == 0
+    for param, accumulated_param in zip(model.parameters(), accumulated_model.parameters()):
+        assert torch.allclose(param.grad, accumulated_param.grad, atol=1e-6)
+
+
+def test_GradientAccumulator_partial_batch():
+    torch.manual_seed(42)
+    model = nn.Linear(8, 3)
+    accumulated_model = copy.deepcopy(model)
+    images, labels = torch.rand((7, 8)), torch.randint(0, 3, (7,))
+    criterion = nn.CrossEntropyLoss()
+    criterion(model(images), labels).backward()
+
+    # The last batch of the epoch is smaller than the effective batch, its gradients are the ones of its mean loss
+    optimizer = torch.optim.SGD(accumulated_model.parameters(), lr=0)
+    accumulator = GradientAccumulator(
+        optimizer, torch.cuda.amp.GradScaler(enabled=False), effective_batch_size=12)
+    for micro_slice, micro_images, _ in split_batch(images, None, 5):
+        accumulator.backward(criterion(accumulated_model(
+            micro_images), labels[micro_slice]), len(micro_images))
+    accumulator.step()
+    assert accumulator.num_images == 0
+    for param, accumulated_param in zip(model.parameters(), accumulated_model.parameters()):
+        assert torch.allclose(param.grad, accumulated_param.grad, atol=1e-6)
+
+
+def test_split_batch_views_and_keys():
+    views = [torch.rand((5, 3, 4, 4)) for _ in range(3)]
+    keys = [[f"{view}_{i}" for i in range(5)] for view in range(3)]
+    micro_batches = list(split_batch(views, keys, 2))
+    assert [len(micro_images[0]) for _, micro_images, _ in micro_batches] == [2, 2, 1]
+    assert micro_batches[-1][2] == [["0_4"], ["1_4"], ["2_4"]]
+
+
+def test_auto_micro_batch_size():
+    model = nn.Sequential(nn.Linear(64, 1024), nn.ReLU(),
+                          nn.BatchNorm1d(1024), nn.Linear(1024, 3)).train()
+    running_mean = model[2].running_mean.clone()
+    # Every image saves a few activations of 1024 floats (4 KB each), so 1 MB doesn't fit 256 images
+    micro_batch_size = auto_micro_batch_size(
+        model, model, torch.rand((256, 64)), max_micro_batch_size=256, memory_budget_gb=1 / 1024)
+    assert 1 < micro_batch_size < 256
+    assert torch.equal(model[2].running_mean, running_mean)
@@ -0,0 +1,29 @@
+import torch
+from models.MultiDropoutHead import MultiDropoutHead
+
+
+def test_MultiDropoutHead_matches_per_head_loop():
+    torch.manual_seed(42)
+    head = MultiDropoutHead(in_features=32, num_classes=7,
+                            hidden_layers=[16, 8], dropout_num=4, dropout_p=0.3).eval()
+    x = torch.rand((5, 2, 4, 4))
+    flat_x = x.flatten(1)
+    head_outputs = []
+    for i in range(head.dropout_num):
+        output = head.first_batch_norm_layer(
+            torch.relu(flat_x @ head.weights[0][i] + head.first_bias[i]))
+        output = head.next_batch_norm_layers[0](
+            torch.relu(output @ head.weights[1][i]))
+        output = head.final_batch_norm_layer(output @ head.weights[2][i])
+        head_outputs.append(output)
+    expected = torch.stack(head_outputs).mean(dim=0)
+    assert torch.allclose(head(x), expected, atol=1e-6)
+
+
+def test_MultiDropoutHead_without_hidden_layers():
+    head = MultiDropoutHead(in_features=32, num_classes=7,
+                            hidden_layers=[], dropout_num=3, dropout_p=0.3)
+    outputs = head(torch.rand((5, 32)))
+    assert outputs.shape == (5, 7)
+    outputs.sum().backward()
+    assert all(param.grad is not None for param in head.parameters())
@@ -0,0 +1,18 @@
+import numpy as np
+from utils.utils import merge_channel_statistics
+
+
+def test_merge_channel_statistics():
+    rng = np.random.default_rng(42)
+    images = [rng.random((n, 3)) for n in (10, 250, 1, 37)]
+    statistics = (0, np.zeros(3), np.zeros(3))
+    for pixels in images:
+        mean = pixels.mean(axis=0)
+        statistics = merge_channel_statistics(
+            statistics, (len(pixels), mean, ((pixels - mean) ** 2).sum(axis=0)))
+    count, mean, m2 = statistics
+
+    all_pixels = np.concatenate(images)
+    assert count == len(all_pixels)
+    assert np.allclose(mean, all_pixels.mean(axis=0))
+    assert np.allclose(np.sqrt(m2 / (count - 1)), all_pixels.std(axis=0, ddof=1))
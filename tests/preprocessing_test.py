@@ -0,0 +1,28 @@
+import torch
+from train_loops.SAM_pretrained import preprocess_images, preprocess_images_pil
+
+PREPROCESS_PARAMS = {
+    'adjust_contrast': 1.5,
+    'adjust_brightness': 1.2,
+    'adjust_saturation': 2,
+    'adjust_gamma': 1.5,
+    'gaussian_blur': 5}
+
+
+def test_preprocess_images_parity():
+    torch.manual_seed(42)
+    images = torch.rand((4, 3, 128, 128))
+    expected = preprocess_images_pil(images, PREPROCESS_PARAMS)
+    preprocessed_images = preprocess_images(images, PREPROCESS_PARAMS)
+    assert preprocessed_images.shape == expected.shape
+    # PIL rounds to uint8 after every operation
+    assert (preprocessed_images - expected).abs().mean() < 2 / 255
+    assert (preprocessed_images - expected).abs().max() < 0.05
+
+
+def test_fused_preprocessing():
+    torch.manual_seed(42)
+    images = torch.rand((4, 3, 128, 128))
+    for params in [PREPROCESS_PARAMS, {**PREPROCESS_PARAMS, 'adjust_brightness': 0.8}, {'adjust_gamma': 0.5}]:
+        assert torch.allclose(preprocess_images(images, params, fused=True),
+                              preprocess_images(images, params), atol=1e-5)
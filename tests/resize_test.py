@@ -0,0 +1,41 @@
+import cv2
+import numpy as np
+import torch
+from utils.utils import resize_images, resize_segmentations
+
+
+def cv2_resize(images: torch.Tensor, new_size, interpolation) -> torch.Tensor:
+    resized_images = [cv2.resize(image.permute(1, 2, 0).numpy(), new_size, interpolation=interpolation)
+                      for image in images]
+    resized_images = [image[:, :, None] if image.ndim == 2 else image
+                      for image in resized_images]
+    return torch.from_numpy(np.stack(resized_images)).permute(0, 3, 1, 2)
+
+
+def test_resize_images_parity():
+    torch.manual_seed(42)
+    images = torch.rand((4, 3, 450, 600))
+    for new_size in [(128, 128), (224, 224), (800, 600)]:
+        for mode, interpolation in [("bicubic", cv2.INTER_CUBIC), ("bilinear", cv2.INTER_LINEAR), ("nearest", cv2.INTER_NEAREST)]:
+            resized_images = resize_images(images, new_size=new_size, mode=mode)
+            expected = cv2_resize(images, new_size, interpolation)
+            assert resized_images.shape == expected.shape == (4, 3, new_size[1], new_size[0])
+            assert (resized_images - expected).abs().mean() < 1e-3, f"{mode} {new_size}"
+
+
+def test_resize_images_area_parity():
+    torch.manual_seed(42)
+    images = torch.rand((2, 3, 450, 600))
+    resized_images = resize_images(images, new_size=(300, 225), mode="auto")
+    expected = cv2_resize(images, (300, 225), cv2.INTER_AREA)
+    assert torch.allclose(resized_images, expected, atol=1e-5)
+
+
+def test_resize_segmentations_parity():
+    torch.manual_seed(42)
+    segmentations = (torch.rand((4, 1, 128, 128)) > 0.5).float()
+    resized_segmentations = resize_segmentations(
+        segmentations, new_size=(600, 450))
+    expected = cv2_resize(segmentations, (600, 450), cv2.INTER_CUBIC)
+    assert resized_segmentations.shape == (4, 1, 450, 600)
+    assert (resized_segmentations - expected).abs().mean() < 1e-3
@@ -0,0 +1,27 @@
+from collections import Counter
+from datasets.ClassBalancedSampler import ClassBalancedSampler
+
+
+def test_ClassBalancedSampler():
+    labels = [0] * 100 + [1] * 30 + [2] * 5
+    sampler = ClassBalancedSampler(labels)
+    assert len(sampler) == 300
+    indices = list(sampler)
+    assert len(indices) == 300
+    # Indices >= len(labels) are augmented draws of the sample at index - len(labels)
+    drawn_labels = Counter(labels[idx % len(labels)] for idx in indices)
+    assert drawn_labels == {0: 100, 1: 100, 2: 100}
+    assert sum(idx < len(labels) for idx in indices) == len(labels)
+    # A new balanced set of indices is drawn at every epoch
+    assert indices != list(sampler)
+
+
+def test_ClassBalancedSampler_downsampling():
+    labels = [0] * 100 + [1] * 30 + [2] * 5
+    sampler = ClassBalancedSampler(labels, balance_downsampling=0.5)
+    assert len(sampler) == 150
+    indices = list(sampler)
+    assert all(idx < len(labels) for idx in indices if labels[idx % len(labels)] == 0)
+
+    sampler = ClassBalancedSampler(labels, epoch_length=40)
+    assert len(list(sampler)) == 40
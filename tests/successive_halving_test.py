@@ -0,0 +1,58 @@
+import itertools
+import os
+import pytest
+from utils.successive_halving import SuccessiveHalving
+
+
+def run_search(search: SuccessiveHalving, budgets: list, stop_after=None):
+    trials = 0
+    while not search.is_finished():
+        for combination, epochs in search.pending():
+            if stop_after is not None and trials == stop_after:
+                return
+            budgets.append(epochs)
+            # The score depends only on the combination, the best one is (0.01, 0.8)
+            search.report(combination, combination[1] - combination[0])
+            trials += 1
+        search.promote()
+
+
+def test_SuccessiveHalving(tmp_path):
+    combinations = list(itertools.product(
+        [0.01, 0.02, 0.03, 0.1], [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8]))
+    state_path = os.path.join(tmp_path, "search.json")
+    budgets = []
+    search = SuccessiveHalving(state_path, combinations,
+                               min_epochs=1, max_epochs=9, eta=3)
+    run_search(search, budgets)
+    assert [len(rung["combinations"]) for rung in search.state["rungs"]] == [32, 10, 3]
+    assert [rung["epochs"] for rung in search.state["rungs"]] == [1, 3, 9]
+    assert search.best() == ((0.01, 0.8), 0.8 - 0.01)
+    # The whole grid for 9 epochs would take 32 * 9 = 288 epochs
+    assert sum(budgets) == 32 * 1 + 10 * 3 + 3 * 9
+
+
+def test_SuccessiveHalving_resume(tmp_path):
+    combinations = list(itertools.product([0.01, 0.02], [0.1, 0.2, 0.3]))
+    state_path = os.path.join(tmp_path, "search.json")
+    budgets = []
+    run_search(SuccessiveHalving(state_path, combinations,
+               min_epochs=1, max_epochs=4, eta=2), budgets, stop_after=4)
+    resumed_search = SuccessiveHalving(
+        state_path, combinations, min_epochs=1, max_epochs=4, eta=2)
+    assert len(resumed_search.pending()) == 2
+    run_search(resumed_search, budgets)
+    assert [rung["epochs"] for rung in resumed_search.state["rungs"]] == [1, 2, 4]
+    assert sum(budgets) == 6 * 1 + 3 * 2 + 1 * 4
+
+
+def test_SuccessiveHalving_changed_parameters(tmp_path):
+    combinations = list(itertools.product([0.01, 0.02], [0.1, 0.2, 0.3]))
+    state_path = os.path.join(tmp_path, "search.json")
+    SuccessiveHalving(state_path, combinations, min_epochs=1, max_epochs=4, eta=2)
+    with pytest.raises(ValueError):
+        SuccessiveHalving(state_path, combinations,
+                          min_epochs=1, max_epochs=8, eta=2)
+    with pytest.raises(ValueError):
+        SuccessiveHalving(state_path, combinations[:3],
+                          min_epochs=1, max_epochs=4, eta=2)
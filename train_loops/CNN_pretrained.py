@@ -1,7 +1,8 @@
 import torch
-from config import ARCHITECTURE, LOAD_SYNTHETIC, PRINT_MODEL_ARCHITECTURE, BALANCE_DOWNSAMPLING, BATCH_SIZE, DYNAMIC_SEGMENTATION_STRATEGY, INPUT_SIZE, KEEP_BACKGROUND, NUM_CLASSES, HIDDEN_SIZE, N_EPOCHS, LR, REG, DATASET_LIMIT, DROPOUT_P, NORMALIZE, PATH_TO_SAVE_RESULTS, RESUME, RESUME_EPOCH, PATH_MODEL_TO_RESUME, RANDOM_SEED, SEGMENTATION_STRATEGY, OVERSAMPLE_TRAIN, USE_MULTIPLE_LOSS, USE_WANDB
+from config import BATCH_NORM_MODE, MICRO_BATCH_SIZE, ARCHITECTURE, LOAD_SYNTHETIC, PRINT_MODEL_ARCHITECTURE, BALANCE_DOWNSAMPLING, BATCH_SIZE, CHANNELS_LAST, DYNAMIC_SEGMENTATION_STRATEGY, INPUT_SIZE, KEEP_BACKGROUND, NUM_CLASSES, HIDDEN_SIZE, N_EPOCHS, LR, REG, DATASET_LIMIT, DROPOUT_P, NORMALIZE, PATH_TO_SAVE_RESULTS, PRECISION, RESUME, RESUME_EPOCH, PATH_MODEL_TO_RESUME, RANDOM_SEED, SEGMENTATION_STRATEGY, OVERSAMPLE_TRAIN, USE_MULTIPLE_LOSS, USE_WANDB
 from models.ResNet50Pretrained import ResNet50Pretrained
 from shared.constants import IMAGENET_STATISTICS, DEFAULT_STATISTICS
+from utils.checkpoint import load_model_weights
 from utils.dataloader_utils import get_dataloder_from_strategy
 from utils.utils import select_device, set_seed
 from train_loops.train_loop import train_eval_loop
@@ -27,8 +28,8 @@ def get_model(device):
         raise ValueError(f"Unknown architechture {ARCHITECTURE}")
 
     if RESUME:
-        model.load_state_dict(torch.load(
-            f"{PATH_TO_SAVE_RESULTS}/{PATH_MODEL_TO_RESUME}/models/melanoma_detection_{RESUME_EPOCH}.pt"))
+        model.load_state_dict(load_model_weights(
+            f"{PATH_TO_SAVE_RESULTS}/{PATH_MODEL_TO_RESUME}/models/melanoma_detection_{RESUME_EPOCH}.pt", base_model=model))
 
     for p in model.parameters():
         p.requires_grad = False
@@ -88,6 +89,10 @@ def main():
         "use_wandb": USE_WANDB,
         "keep_background": KEEP_BACKGROUND,
         "load_synthetic": LOAD_SYNTHETIC,
+        "precision": PRECISION,
+        "channels_last": CHANNELS_LAST,
+        "micro_batch_size": MICRO_BATCH_SIZE,
+        "batch_norm_mode": BATCH_NORM_MODE,
     }
 
     dataloader = get_dataloder_from_strategy(
@@ -109,7 +114,9 @@ def main():
         optimizer, T_max=N_EPOCHS, eta_min=1e-4, verbose=True)
 
     train_eval_loop(device, train_loader=train_loader, val_loader=val_loader, model=model,
-                    config=config, optimizer=optimizer, scheduler=scheduler, resume=RESUME)
+                    config=config, optimizer=optimizer, scheduler=scheduler, resume=RESUME,
+                    precision=PRECISION, channels_last=CHANNELS_LAST,
+                    micro_batch_size=MICRO_BATCH_SIZE, batch_norm_mode=BATCH_NORM_MODE)
 
 
 if __name__ == "__main__":
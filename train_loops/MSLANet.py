@@ -1,5 +1,6 @@
 import torch
-from config import LOAD_SYNTHETIC, PRINT_MODEL_ARCHITECTURE, BATCH_SIZE, DYNAMIC_SEGMENTATION_STRATEGY, KEEP_BACKGROUND, NUM_CLASSES, HIDDEN_SIZE, N_EPOCHS, LR, REG, DATASET_LIMIT, DROPOUT_P, NUM_DROPOUT_LAYERS, NORMALIZE, RESUME, RESUME_EPOCH, RANDOM_SEED, SEGMENTATION_STRATEGY, OVERSAMPLE_TRAIN, USE_WANDB
+from config import BATCH_NORM_MODE, GRADCAM_HIGH_THRESHOLD, GRADCAM_LOW_THRESHOLD, MICRO_BATCH_SIZE, CACHE_LANET_ACTIVATIONS, CHANNELS_LAST, LOAD_SYNTHETIC, MSLANET_GRADCAM_VIEWS, PRINT_MODEL_ARCHITECTURE, BATCH_SIZE, DYNAMIC_SEGMENTATION_STRATEGY, KEEP_BACKGROUND, NUM_CLASSES, HIDDEN_SIZE, N_EPOCHS, LR, REG, DATASET_LIMIT, DROPOUT_P, NUM_DROPOUT_LAYERS, NORMALIZE, PRECISION, RESUME, RESUME_EPOCH, RANDOM_SEED, SEGMENTATION_STRATEGY, OVERSAMPLE_TRAIN, USE_WANDB
+from dataloaders.MSLANetDataLoader import MSLANetDataLoader
 from models.MSLANet import MSLANet
 from train_loops.CNN_pretrained import get_normalization_statistics
 from utils.dataloader_utils import get_dataloder_from_strategy
@@ -7,11 +8,32 @@ from utils.utils import select_device, set_seed
 from train_loops.mslanet_train_loop import train_eval_loop
 
 
+def activation_cache_params(normalization_statistics: tuple) -> dict:
+    """
+    Parameters of the preprocessing of the images fed to LANet, which select the directory of the activation cache (see LANetActivationCache).
+    """
+    params = {
+        "gradcam_views": MSLANET_GRADCAM_VIEWS,
+        "normalize": NORMALIZE,
+        "normalization_statistics": [statistic.view(-1).tolist() for statistic in normalization_statistics] if NORMALIZE else None,
+    }
+    if MSLANET_GRADCAM_VIEWS:
+        params.update({"low_threshold": GRADCAM_LOW_THRESHOLD,
+                      "high_threshold": GRADCAM_HIGH_THRESHOLD})
+    else:
+        params.update({"segmentation_strategy": SEGMENTATION_STRATEGY,
+                       "dynamic_segmentation_strategy": DYNAMIC_SEGMENTATION_STRATEGY,
+                       "keep_background": KEEP_BACKGROUND})
+    return params
+
+
 def main():
     set_seed(RANDOM_SEED)
     device = select_device()
+    normalization_statistics = get_normalization_statistics()
 
-    model = MSLANet(num_classes=NUM_CLASSES, hidden_layers=HIDDEN_SIZE, dropout_num=NUM_DROPOUT_LAYERS, dropout_p=DROPOUT_P).to(device)
+    model = MSLANet(num_classes=NUM_CLASSES, hidden_layers=HIDDEN_SIZE, dropout_num=NUM_DROPOUT_LAYERS, dropout_p=DROPOUT_P,
+                    activation_cache_params=activation_cache_params(normalization_statistics) if CACHE_LANET_ACTIVATIONS else None).to(device)
 
     if PRINT_MODEL_ARCHITECTURE:
         print(f"--Model-- Architecture: {model}")
@@ -32,20 +54,41 @@ def main():
         "use_wandb": USE_WANDB,
         "dropout_layer": NUM_DROPOUT_LAYERS,
         "dropout_p": DROPOUT_P,
+        "precision": PRECISION,
+        "channels_last": CHANNELS_LAST,
+        "micro_batch_size": MICRO_BATCH_SIZE,
+        "batch_norm_mode": BATCH_NORM_MODE,
+        "gradcam_views": MSLANET_GRADCAM_VIEWS,
+        "cache_activations": CACHE_LANET_ACTIVATIONS,
     }
 
-    dataloader = get_dataloder_from_strategy(
-        strategy=SEGMENTATION_STRATEGY,
-        dynamic_segmentation_strategy=DYNAMIC_SEGMENTATION_STRATEGY,
-        limit=DATASET_LIMIT,
-        dynamic_load=False,
-        oversample_train=OVERSAMPLE_TRAIN,
-        normalize=NORMALIZE,
-        normalization_statistics=get_normalization_statistics(),
-        batch_size=BATCH_SIZE,
-        keep_background=KEEP_BACKGROUND,
-        load_synthetic=LOAD_SYNTHETIC
-    )
+    if MSLANET_GRADCAM_VIEWS:
+        # NOTE: the offline GradCAM views exist only for the dataset with the synthetic images, which is already balanced
+        dataloader = MSLANetDataLoader(
+            limit=DATASET_LIMIT,
+            dynamic_load=False,
+            upscale_train=False,
+            normalize=NORMALIZE,
+            normalization_statistics=normalization_statistics,
+            batch_size=BATCH_SIZE,
+            load_synthetic=True,
+            online_gradcam=False,
+            return_activation_keys=CACHE_LANET_ACTIVATIONS
+        )
+    else:
+        dataloader = get_dataloder_from_strategy(
+            strategy=SEGMENTATION_STRATEGY,
+            dynamic_segmentation_strategy=DYNAMIC_SEGMENTATION_STRATEGY,
+            limit=DATASET_LIMIT,
+            dynamic_load=False,
+            oversample_train=OVERSAMPLE_TRAIN,
+            normalize=NORMALIZE,
+            normalization_statistics=normalization_statistics,
+            batch_size=BATCH_SIZE,
+            keep_background=KEEP_BACKGROUND,
+            load_synthetic=LOAD_SYNTHETIC,
+            return_activation_keys=CACHE_LANET_ACTIVATIONS
+        )
     train_loader = dataloader.get_train_dataloder()
     val_loader = dataloader.get_val_dataloader()
 
@@ -54,7 +97,9 @@ def main():
         optimizer, T_max=N_EPOCHS, eta_min=1e-4, verbose=True)
 
     train_eval_loop(device, train_loader=train_loader, val_loader=val_loader, model=model,
-                    config=config, optimizer=optimizer, scheduler=scheduler, resume=RESUME)
+                    config=config, optimizer=optimizer, scheduler=scheduler, resume=RESUME,
+                    precision=PRECISION, channels_last=CHANNELS_LAST,
+                    micro_batch_size=MICRO_BATCH_SIZE, batch_norm_mode=BATCH_NORM_MODE)
 
 
 if __name__ == "__main__":
@@ -1,5 +1,8 @@
-from typing import Dict
+from typing import Dict, Tuple
+import hashlib
+import json
 import torch
+import torch.nn.functional as F
 import numpy as np
 import random
 import os
@@ -11,12 +14,18 @@ from dataloaders.ImagesAndSegmentationDataLoader import ImagesAndSegmentationDat
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 import monai
 
-from utils.utils import resize_images, resize_segmentations
+from config import CACHE_DIR
+from datasets.ArrayStoreDataset import ArrayStoreDataset
+from utils.array_store import ArrayStore
+from utils.utils import hash_module_state, resize_images, resize_segmentations
 
 #### Utility functions ####
 
 
-def preprocess_images(images: torch.Tensor, params: Dict[str, float]):
+def preprocess_images_pil(images: torch.Tensor, params: Dict[str, float]):
+    """
+    Reference implementation of preprocess_images, that processes one PIL image at a time.
+    """
     import torchvision.transforms.functional as TF
     from PIL import Image
     adjust_contrast = params.get("adjust_contrast", None)
@@ -51,6 +60,129 @@ def preprocess_images(images: torch.Tensor, params: Dict[str, float]):
     result = torch.stack(preprocessed_images, dim=0).to(torch.float32)
     return result
 
+
+def preprocess_images(images: torch.Tensor, params: Dict[str, float], fused: bool = False):
+    """
+    Applies the photometric preprocessing in params to the whole (B, C, H, W) batch at once, on the device of the batch.
+    The operations are applied in the same order as preprocess_images_pil, and the result matches it within the uint8 rounding
+    that PIL does after every operation. If fused is True, the precomputed FusedPreprocessing of params is used.
+    """
+    import torchvision.transforms.functional as TF
+    images = quantize_images(images)
+    if fused:
+        return get_fused_preprocessing(params).to(images.device)(images)
+    adjust_contrast = params.get("adjust_contrast", None)
+    adjust_brightness = params.get("adjust_brightness", None)
+    adjust_saturation = params.get("adjust_saturation", None)
+    adjust_gamma = params.get("adjust_gamma", None)
+    adjust_hue = params.get("adjust_hue", None)
+    adjust_sharpness = params.get("adjust_sharpness", None)
+    gaussian_blur = params.get("gaussian_blur", None)
+
+    if adjust_contrast is not None:
+        images = TF.adjust_contrast(images, adjust_contrast)
+    if adjust_brightness is not None:
+        images = TF.adjust_brightness(images, adjust_brightness)
+    if adjust_saturation is not None:
+        images = TF.adjust_saturation(images, adjust_saturation)
+    if adjust_gamma is not None:
+        images = TF.adjust_gamma(images, adjust_gamma)
+    if adjust_hue is not None:
+        images = TF.adjust_hue(images, adjust_hue)
+    if adjust_sharpness is not None:
+        images = TF.adjust_sharpness(images, adjust_sharpness)
+    if gaussian_blur is not None:
+        images = TF.gaussian_blur(images, gaussian_blur)
+    return images
+
+
+def quantize_images(images: torch.Tensor) -> torch.Tensor:
+    # Same quantization of the conversion to a uint8 PIL image done by preprocess_images_pil
+    return (images * 255).clamp(0, 255).floor().to(torch.float32) / 255
+
+
+GRAYSCALE_WEIGHTS = (0.2989, 0.587, 0.114)
+
+
+class FusedPreprocessing(torch.nn.Module):
+    """
+    Precomputed version of preprocess_images for a fixed set of params:
+    - contrast and brightness are merged in a single affine operation (exact when brightness >= 1, since the intermediate clamp has no effect);
+    - saturation is a precomputed 3x3 color matrix;
+    - the gaussian blur kernel is precomputed and applied as a depthwise convolution.
+    """
+
+    def __init__(self, params: Dict[str, float]):
+        super().__init__()
+        self.params = params
+        self.contrast = params.get("adjust_contrast", None)
+        self.brightness = params.get("adjust_brightness", None)
+        self.gamma = params.get("adjust_gamma", None)
+        self.merge_contrast_brightness = self.contrast is not None and self.brightness is not None and self.brightness >= 1
+
+        weights = torch.tensor(GRAYSCALE_WEIGHTS)
+        self.register_buffer("grayscale_weights", weights.view(1, 3, 1, 1))
+        saturation = params.get("adjust_saturation", None)
+        if saturation is not None:
+            # out = saturation * image + (1 - saturation) * grayscale(image)
+            saturation_matrix = saturation * torch.eye(3) + \
+                (1 - saturation) * weights.unsqueeze(0).repeat(3, 1)
+            self.register_buffer("saturation_matrix", saturation_matrix)
+        else:
+            self.saturation_matrix = None
+
+        kernel_size = params.get("gaussian_blur", None)
+        if kernel_size is not None:
+            sigma = kernel_size * 0.15 + 0.35
+            x = torch.linspace(-(kernel_size - 1) / 2,
+                               (kernel_size - 1) / 2, kernel_size)
+            kernel = torch.exp(-0.5 * (x / sigma) ** 2)
+            kernel = kernel / kernel.sum()
+            self.register_buffer("blur_kernel", torch.outer(
+                kernel, kernel).expand(3, 1, kernel_size, kernel_size).contiguous())
+        else:
+            self.blur_kernel = None
+
+    def grayscale(self, images: torch.Tensor) -> torch.Tensor:
+        return (images * self.grayscale_weights).sum(dim=1, keepdim=True)
+
+    def forward(self, images: torch.Tensor) -> torch.Tensor:
+        import torchvision.transforms.functional as TF
+        if self.contrast is not None:
+            mean = self.grayscale(images).mean(dim=(-3, -2, -1), keepdim=True)
+            images = self.contrast * images + (1 - self.contrast) * mean
+            if self.merge_contrast_brightness:
+                images = images * self.brightness
+            images = images.clamp(0, 1)
+        if self.brightness is not None and not self.merge_contrast_brightness:
+            images = (images * self.brightness).clamp(0, 1)
+        if self.saturation_matrix is not None:
+            images = torch.einsum("ij,bjhw->bihw", self.saturation_matrix,
+                                  images).clamp(0, 1)
+        if self.gamma is not None:
+            images = images.pow(self.gamma).clamp(0, 1)
+        if self.params.get("adjust_hue", None) is not None:
+            images = TF.adjust_hue(images, self.params["adjust_hue"])
+        if self.params.get("adjust_sharpness", None) is not None:
+            images = TF.adjust_sharpness(
+                images, self.params["adjust_sharpness"])
+        if self.blur_kernel is not None:
+            padding = self.blur_kernel.shape[-1] // 2
+            images = F.conv2d(F.pad(images, [padding] * 4, mode="reflect"),
+                              self.blur_kernel.to(images.dtype), groups=images.shape[1])
+        return images
+
+
+_fused_preprocessing_cache = {}
+
+
+def get_fused_preprocessing(params: Dict[str, float]) -> FusedPreprocessing:
+    key = tuple(sorted(params.items()))
+    if key not in _fused_preprocessing_cache:
+        _fused_preprocessing_cache[key] = FusedPreprocessing(params)
+    return _fused_preprocessing_cache[key]
+
+
 #######################
 
 
@@ -67,6 +199,8 @@ IMG_SIZE = 128
 THRESHOLD = 0.5
 UPSCALE_TRAIN = False
 PATIENCE = 40
+# If True, the vision encoder is fully frozen: the image embeddings are computed once and stored on disk, and only the mask decoder is trained
+TRAIN_ON_EMBEDDINGS = False
 preprocess_params = {
     'adjust_contrast': 1.5,
     'adjust_brightness': 1.2,
@@ -240,16 +374,6 @@ def train_eval_loop():
     model = get_model().to(device)
     img_size = (model.get_img_size(), model.get_img_size())
 
-    def intersection_over_union(pred, target):
-        pred = torch.sigmoid(pred)
-        pred = (pred > THRESHOLD).float()
-        intersection = (pred * target).sum((1, 2))
-        union = pred.sum((1, 2)) + target.sum((1, 2)) - \
-            intersection
-
-        iou = (intersection + 1e-6) / (union + 1e-6)
-        return iou.mean()
-
     loss_function = monai.losses.DiceCELoss(
         sigmoid=True, squared_pred=True, reduction='mean')
 
@@ -272,14 +396,14 @@ def train_eval_loop():
         for tr_i, (tr_images, _, tr_segmentation) in enumerate(train_loader):
             with torch.no_grad():
                 # tr_images = tr_images.to(torch.float32)
+                # NOTE: resize and preprocessing run on the device, on the whole batch
+                tr_images = tr_images.to(device)
+                tr_segmentation = tr_segmentation.to(device)
                 tr_images = resize_images(tr_images, new_size=img_size)
                 tr_segmentation = resize_segmentations(
                     tr_segmentation, new_size=(img_size))
                 tr_images = preprocess_images(
-                    tr_images, params=preprocess_params)
-
-                tr_images = tr_images.to(device)
-                tr_segmentation = tr_segmentation.to(device)
+                    tr_images, params=preprocess_params, fused=True)
 
             upscaled_masks = model(tr_images, None)
 
@@ -337,14 +461,14 @@ def train_eval_loop():
             loss_sum = 0
             for val_i, (val_images, _, val_segmentations) in tqdm(enumerate(val_loader), f"Evaluation"):
                 # val_images = val_images.to(torch.float32)
+                val_segmentations = val_segmentations.to(device)
+                val_images = val_images.to(device)
                 val_images = resize_images(val_images, new_size=img_size)
                 val_segmentations = resize_segmentations(
                     val_segmentations, new_size=(img_size))
                 val_images = preprocess_images(
-                    val_images, params=preprocess_params)
+                    val_images, params=preprocess_params, fused=True)
                 # print(f"tr_semgnentation shape is {val_segmentations.shape}")
-                val_segmentations = val_segmentations.to(device)
-                val_images = val_images.to(device)
 
                 upscaled_masks = model(val_images, None)
 
@@ -378,6 +502,135 @@ def train_eval_loop():
                 name="eval_results")
 
 
+def get_embedding_stores(model: SAM) -> Tuple[ArrayStore, ArrayStore]:
+    """
+    Returns the stores of the image embeddings and of the resized ground truth masks, keyed by image_id.
+    The stores depend on the encoder weights, the image size and the preprocessing params.
+    """
+    key = json.dumps({
+        "encoder": hash_module_state(model.model.vision_encoder),
+        "img_size": model.get_img_size(),
+        "preprocess_params": preprocess_params}, sort_keys=True)
+    store_dir = os.path.join(CACHE_DIR, "sam_embeddings",
+                             hashlib.sha256(key.encode()).hexdigest()[:16])
+    with torch.no_grad():
+        embedding_shape = model.get_image_embeddings(torch.zeros(
+            (1, 3, model.get_img_size(), model.get_img_size()))).shape[1:]
+    embeddings_store = ArrayStore(os.path.join(
+        store_dir, "embeddings"), shape=embedding_shape)
+    masks_store = ArrayStore(os.path.join(store_dir, "masks"), shape=(
+        1, model.get_img_size(), model.get_img_size()))
+    return embeddings_store, masks_store
+
+
+def precompute_embeddings(model: SAM, dataloader: ImagesAndSegmentationDataLoader, metadata, embeddings_store: ArrayStore, masks_store: ArrayStore):
+    """
+    Computes the image embeddings (and resized masks) of the images in metadata that are not already in the stores.
+    """
+    img_size = (model.get_img_size(), model.get_img_size())
+    metadata = metadata.assign(augmented=False)
+    missing_indices = [idx for idx, image_id in enumerate(metadata['image_id'])
+                       if image_id not in embeddings_store or image_id not in masks_store]
+    model.model.eval()
+    with torch.no_grad():
+        for start in tqdm(range(0, len(missing_indices), BATCH_SIZE), desc="Computing image embeddings"):
+            batch_indices = missing_indices[start:start + BATCH_SIZE]
+            images, segmentations = [], []
+            for idx in batch_indices:
+                image, _, segmentation = dataloader.load_images_and_labels_at_idx(
+                    metadata, idx)
+                images.append(image)
+                segmentations.append(segmentation)
+            images = resize_images(torch.stack(
+                images).to(device), new_size=img_size)
+            segmentations = resize_segmentations(
+                torch.stack(segmentations).to(device), new_size=img_size)
+            images = preprocess_images(
+                images, params=preprocess_params, fused=True)
+            image_ids = metadata['image_id'].iloc[batch_indices].tolist()
+            embeddings_store.put_batch(
+                image_ids, model.get_image_embeddings(images).cpu().numpy())
+            masks_store.put_batch(image_ids, segmentations.cpu().numpy())
+    embeddings_store.flush()
+    masks_store.flush()
+
+
+def train_eval_loop_on_embeddings():
+    dataloader = ImagesAndSegmentationDataLoader(
+        dynamic_load=True,
+        normalize=NORMALIZE,
+        upscale_train=False,
+        batch_size=BATCH_SIZE)
+    model = get_model().to(device)
+    for param in model.model.vision_encoder.parameters():
+        param.requires_grad_(False)
+
+    embeddings_store, masks_store = get_embedding_stores(model)
+    loaders = []
+    for metadata, shuffle in [(dataloader.train_df, True), (dataloader.val_df, False)]:
+        precompute_embeddings(model, dataloader, metadata,
+                              embeddings_store, masks_store)
+        loaders.append(torch.utils.data.DataLoader(ArrayStoreDataset(
+            [embeddings_store, masks_store], metadata['image_id'].tolist()), batch_size=BATCH_SIZE, shuffle=shuffle))
+    train_loader, val_loader = loaders
+
+    loss_function = monai.losses.DiceCELoss(
+        sigmoid=True, squared_pred=True, reduction='mean')
+    optimizer = torch.optim.Adam(model.model.mask_decoder.parameters(), lr=LR)
+    scheduler = ReduceLROnPlateau(
+        optimizer, mode='min', factor=LR_DECAY, patience=PATIENCE, verbose=True)
+
+    best_eval_accuracy = -torch.inf
+    for epoch in range(FROM_EPOCH if RESUME else 0, N_EPOCHS):
+        model.model.train()
+        for tr_embeddings, tr_segmentation in tqdm(train_loader, desc=f"TRAINING | Epoch {epoch}"):
+            tr_embeddings = tr_embeddings.to(device, non_blocking=True)
+            tr_segmentation = tr_segmentation.to(device, non_blocking=True)
+            upscaled_masks = model(image_embeddings=tr_embeddings)
+            loss = loss_function(upscaled_masks, tr_segmentation)
+            if USE_WANDB:
+                wandb.log({"train_loss": loss.item()})
+
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            scheduler.step(loss)
+        save_model(model.model, ARCHITECHTURE, epoch)
+
+        model.model.eval()
+        with torch.no_grad():
+            loss_sum, iou_sum = 0, 0
+            for val_embeddings, val_segmentations in tqdm(val_loader, desc="Evaluation"):
+                val_embeddings = val_embeddings.to(device, non_blocking=True)
+                val_segmentations = val_segmentations.to(
+                    device, non_blocking=True)
+                upscaled_masks = model(image_embeddings=val_embeddings)
+                loss_sum += loss_function(upscaled_masks,
+                                          val_segmentations).item()
+                iou_sum += intersection_over_union(
+                    upscaled_masks, val_segmentations).item()
+            mean_loss, mean_iou = loss_sum / \
+                len(val_loader), iou_sum / len(val_loader)
+            if USE_WANDB:
+                wandb.log({"val_loss": mean_loss, "val_iou": mean_iou})
+            print(
+                f"Validation avg loss at epoch {epoch}: {mean_loss}, avg iou: {mean_iou:.4f}")
+            if mean_iou > best_eval_accuracy:
+                best_eval_accuracy = mean_iou
+                save_model(model.model, f"{ARCHITECHTURE}_best", epoch)
+
+
+def intersection_over_union(pred, target):
+    pred = torch.sigmoid(pred)
+    pred = (pred > THRESHOLD).float()
+    intersection = (pred * target).sum((1, 2))
+    union = pred.sum((1, 2)) + target.sum((1, 2)) - \
+        intersection
+
+    iou = (intersection + 1e-6) / (union + 1e-6)
+    return iou.mean()
+
+
 def get_model():
     model = SAM(custom_size=True, img_size=IMG_SIZE).to(device)
 
@@ -390,4 +643,7 @@ def get_model():
 
 if __name__ == "__main__":
     set_seed(RANDOM_SEED)
-    train_eval_loop()
+    if TRAIN_ON_EMBEDDINGS:
+        train_eval_loop_on_embeddings()
+    else:
+        train_eval_loop()
@@ -5,6 +5,8 @@ from tqdm import tqdm
 import wandb
 from models.MSLANet import MSLANet
 from train_loops.CNN_pretrained import get_normalization_statistics
+from train_loops.mslanet_train_loop import forward_views, unpack_batch
+from utils.checkpoint import load_model_weights
 from utils.utils import save_results, set_seed, select_device
 from utils.dataloader_utils import get_dataloder_from_strategy
 from config import  DYNAMIC_SEGMENTATION_STRATEGY, KEEP_BACKGROUND, LOAD_SYNTHETIC, NUM_DROPOUT_LAYERS, OVERSAMPLE_TRAIN, SAVE_RESULTS, DATASET_LIMIT, NORMALIZE, RANDOM_SEED, PATH_TO_SAVE_RESULTS, NUM_CLASSES, DROPOUT_P, BATCH_SIZE, SEGMENTATION_STRATEGY, USE_WANDB
@@ -19,21 +21,19 @@ def test(test_model, test_loader, device, data_name):
         epoch_test_labels = torch.tensor([]).to(device)
         epoch_test_scores = torch.tensor([]).to(device)
         for _, test_batch in enumerate(tqdm(test_loader, desc="Testing", leave=False)):
-            if len(test_batch) == 3:
-                test_images, test_labels, _ = test_batch
-            else:
-                test_images, test_labels = test_batch
+            test_images, test_labels, test_keys = unpack_batch(test_batch)
 
             #test_image_ori = test_image_ori.to(device)
             #test_image_low = test_image_low.to(device)
             #test_image_high = test_image_high.to(device)
-            test_labels = test_labels.to(device)
+            test_labels = test_labels.to(device, non_blocking=True)
 
             #test_output_ori = test_model(test_image_ori)  # Prediction
             #test_output_low = test_model(test_image_low)  # Prediction
             #test_output_high = test_model(test_image_high)  # Prediction
 
-            test_outputs = test_model(test_images)
+            test_outputs = forward_views(
+                test_model, test_images, device, test_keys)
 
             #test_outputs = (test_output_ori + test_output_low + test_output_high) / 3
 
@@ -103,8 +103,8 @@ def test(test_model, test_loader, device, data_name):
             save_results(data_name, test_results, test=True)
 
 def load_test_model(model, model_path, epoch, device):
-    state_dict = torch.load(
-        f"{PATH_TO_SAVE_RESULTS}/{model_path}/models/melanoma_detection_{epoch}.pt", map_location=torch.device(device))
+    state_dict = load_model_weights(
+        f"{PATH_TO_SAVE_RESULTS}/{model_path}/models/melanoma_detection_{epoch}.pt", map_location=torch.device(device), base_model=model)
     model.load_state_dict(state_dict)
     model.eval()
     return model
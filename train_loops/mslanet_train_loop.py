@@ -1,13 +1,45 @@
-from typing import Any, Dict
-from sklearn.metrics import confusion_matrix, recall_score, accuracy_score, roc_auc_score
-from utils.utils import save_results, save_model, save_configurations
+from typing import Any, Dict, Optional, Union
+from utils.metrics import StreamingMetrics
+from utils.micro_batching import GradientAccumulator, auto_micro_batch_size, set_batch_norm_mode, split_batch
+from utils.precision import autocast, grad_scaler, memory_format
+from utils.checkpoint import CheckpointManager, checkpoint_dir, checkpoint_path, load_checkpoint
+from utils.utils import save_results, save_configurations
 from tqdm import tqdm
 import torch
 import torch.nn as nn
 import wandb
 from datetime import datetime
-import copy
-from config import NUM_CLASSES, SAVE_MODELS, SAVE_RESULTS, PATH_MODEL_TO_RESUME, RESUME_EPOCH, USE_MULTIPLE_LOSS, MULTIPLE_LOSS_BALANCE
+from config import MEMORY_BUDGET_GB, NUM_CLASSES, SAVE_MODELS, SAVE_RESULTS, PATH_MODEL_TO_RESUME, RESUME_EPOCH, USE_MULTIPLE_LOSS, MULTIPLE_LOSS_BALANCE
+
+
+def unpack_batch(batch):
+    """
+    Returns the images, labels and activation cache keys (None if the loader doesn't return them) of a batch.
+    The keys are the last element of the batch, a list of strings (or one list per view with MSLANetDataLoader),
+    while the other extra elements (e.g. the segmentations) are ignored.
+    """
+    images, labels, *rest = batch
+    keys = rest[-1] if rest and isinstance(rest[-1], (list, tuple)) else None
+    return images, labels, keys
+
+
+def forward_views(model, images, device, keys=None, images_memory_format=torch.contiguous_format):
+    """
+    Runs the model on the batch. MSLANetDataLoader batches contain the three views (original image and GradCAM crops)
+    of the images, which MSLANet evaluates in a single pass and fuses, and optionally the activation cache keys of the views.
+    """
+    if not isinstance(images, (list, tuple)):
+        return model(images.to(device, non_blocking=True, memory_format=images_memory_format), keys)
+    return model([view.to(device, non_blocking=True, memory_format=images_memory_format) for view in images], keys)
+
+
+def flush_activation_cache(model):
+    """
+    Makes the LANet activations cached during the epoch visible to the next runs.
+    """
+    activation_cache = getattr(model.lanet_model, "activation_cache", None)
+    if activation_cache is not None:
+        activation_cache.flush()
 
 
 def train_eval_loop(device,
@@ -17,7 +49,17 @@ def train_eval_loop(device,
                     config,
                     optimizer,
                     scheduler,
-                    resume=False):
+                    resume=False,
+                    precision: str = "fp32",
+                    channels_last: bool = False,
+                    micro_batch_size: Optional[Union[int, str]] = None,
+                    effective_batch_size: Optional[int] = None,
+                    batch_norm_mode: str = "micro_batch",
+                    memory_budget_gb: float = MEMORY_BUDGET_GB):
+    """
+    precision, channels_last and the micro-batching parameters are the same as in train_loops.train_loop.train_eval_loop.
+    With the three views of MSLANetDataLoader, each micro-batch contains all the views of its images.
+    """
 
     if config["use_wandb"] and "hparam_tuning" not in config:
         # Start a new run
@@ -28,6 +70,11 @@ def train_eval_loop(device,
         )
 
     criterion = nn.CrossEntropyLoss()  # Loss function
+    precision_context = autocast(device, precision)
+    scaler = grad_scaler(device, precision)
+    images_memory_format = memory_format(channels_last)
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
 
     if resume:
         data_name = PATH_MODEL_TO_RESUME
@@ -36,104 +83,73 @@ def train_eval_loop(device,
         current_datetime = datetime.now()
         current_datetime_str = current_datetime.strftime("%Y-%m-%d_%H-%M-%S")
         data_name = f"{config['architecture']}_{current_datetime_str}"
+        if config.get("hparam_tuning"):
+            # Parallel trials start in the same second, so their folders are distinguished by the hyperparameters
+            data_name = f"{data_name}_reg{config['reg']}_dropout{config['dropout_p']}"
 
         if SAVE_RESULTS:
             # Save configurations in JSON
             save_configurations(data_name, config)
 
     total_step = len(train_loader)
-    best_model = None
     best_accuracy = None
+    checkpoint_manager = CheckpointManager(checkpoint_dir(data_name)) if SAVE_MODELS else None
+    if resume:
+        # Restores the optimizer, scheduler, gradient scaler and random state too, when the checkpoint has them
+        best_accuracy = load_checkpoint(checkpoint_path(checkpoint_dir(PATH_MODEL_TO_RESUME), RESUME_EPOCH), model, optimizer, scheduler, scaler,
+                                        map_location=device).get("best_accuracy")
+    tr_metrics = StreamingMetrics(NUM_CLASSES, device, keep_scores=True)
+    val_metrics = StreamingMetrics(NUM_CLASSES, device, keep_scores=True)
+    accumulator = GradientAccumulator(optimizer, scaler, effective_batch_size)
     for epoch in range(RESUME_EPOCH if resume else 0, config["epochs"]):
         model.train()
-        epoch_tr_preds = torch.tensor([]).to(device)
-        epoch_tr_labels = torch.tensor([]).to(device)
-        epoch_tr_scores = torch.tensor([]).to(device)
+        set_batch_norm_mode(model, batch_norm_mode)
+        tr_metrics.reset()
         for tr_i, tr_batch in enumerate(tqdm(train_loader, desc="Training", leave=False)):
             #(tr_image_ori, tr_image_low, tr_image_high), tr_labels = tr_batch
-            if len(tr_batch) == 3:
-                tr_images, tr_labels, _ = tr_batch
-            else:
-                tr_images, tr_labels = tr_batch
+            tr_images, tr_labels, tr_keys = unpack_batch(tr_batch)
             #tr_image_ori = tr_image_ori.to(device)
             #tr_image_low = tr_image_low.to(device)
             #tr_image_high = tr_image_high.to(device)
-            tr_labels = tr_labels.to(device)
+            tr_labels = tr_labels.to(device, non_blocking=True)
 
             #tr_output_ori = model(tr_image_ori)  # Prediction
             #tr_output_low = model(tr_image_low)  # Prediction
             #tr_output_high = model(tr_image_high)  # Prediction
 
             #tr_outputs = (tr_output_ori + tr_output_low + tr_output_high) / 3
-            tr_outputs = model(tr_images)
-
-            # Multiclassification loss considering all classes
-            tr_epoch_loss = criterion(tr_outputs, tr_labels)
-
-            optimizer.zero_grad()
-            tr_epoch_loss.backward()
-            optimizer.step()
-
-            with torch.no_grad():
-                tr_preds = torch.argmax(tr_outputs, -1).detach()
-                epoch_tr_preds = torch.cat((epoch_tr_preds, tr_preds), 0)
-                epoch_tr_labels = torch.cat(
-                    (epoch_tr_labels, tr_labels), 0)
-                
-                tr_outputs = tr_outputs.t()
-                epoch_tr_scores = torch.cat((epoch_tr_scores, tr_outputs), 1)
-
-                tr_accuracy = accuracy_score(
-                    epoch_tr_labels.cpu().numpy(), epoch_tr_preds.cpu().numpy()) * 100
-                tr_sensitivity = recall_score(
-                    epoch_tr_labels.cpu().numpy(), epoch_tr_preds.cpu().numpy(), average='macro', zero_division=0) * 100
-
-                if (tr_i+1) % 100 == 0:
-                    print('Training -> Epoch [{}/{}], Step [{}/{}], Loss: {:.4f}, Accuracy: {:.4f}%, Sensitivity (Recall): {:.4f}%'
-                            .format(epoch+1, config["epochs"], tr_i+1, total_step, tr_epoch_loss, tr_accuracy, tr_sensitivity))
-
-                tr_classes_metrics = {}
-                for class_label in range(NUM_CLASSES):
-                    # class_indices = epoch_tr_labels == class_label
-                    # class_preds = epoch_tr_preds[class_indices]
-                    # class_labels = epoch_tr_labels[class_indices]
-                    tr_class_labels_binary = torch.zeros_like(
-                        epoch_tr_labels, dtype=torch.long).to(device)
-                    tr_class_labels_binary[(
-                        epoch_tr_labels == class_label)] = 1
-
-                    tr_class_preds_binary = torch.zeros_like(
-                        epoch_tr_preds, dtype=torch.long).to(device)
-                    tr_class_preds_binary[(
-                        epoch_tr_preds == class_label)] = 1
-                    
-                    epoch_tr_scores_class = epoch_tr_scores[class_label]
-
-                    if len(tr_class_preds_binary) > 0:
-                        tr_class_accuracy = accuracy_score(
-                            tr_class_labels_binary.cpu().numpy(), tr_class_preds_binary.cpu().numpy()) * 100
-                        tr_class_sensitivity = recall_score(
-                            tr_class_labels_binary.cpu().numpy(), tr_class_preds_binary.cpu().numpy(), average='binary', pos_label=1, zero_division=0) * 100
-                        tr_class_conf_matrix = confusion_matrix(
-                            tr_class_labels_binary.cpu().numpy(), tr_class_preds_binary.cpu().numpy())
-                        if tr_class_conf_matrix.shape == (2, 2) and (tr_class_conf_matrix[0, 0] + tr_class_conf_matrix[0, 1]) > 0:
-                            tr_class_specificity = tr_class_conf_matrix[0, 0] / (
-                                tr_class_conf_matrix[0, 0] + tr_class_conf_matrix[0, 1]) * 100
-                        else:
-                            tr_class_specificity = 0
-                        if len(set(tr_class_labels_binary.cpu().numpy())) > 1:
-                            tr_class_auc = roc_auc_score(
-                                tr_class_labels_binary.cpu().numpy(), epoch_tr_scores_class.cpu().numpy()) * 100
-                        else:
-                            tr_class_auc = 0
-
-                        tr_class_metrics = {"accuracy": tr_class_accuracy, "sensitivity": tr_class_sensitivity,
-                                            "specificity": tr_class_specificity, "auc": tr_class_auc}
-                        tr_classes_metrics[class_label] = tr_class_metrics
-
-                        if (tr_i+1) % 100 == 0:
-                            print(
-                                f'Class {class_label} - Accuracy: {tr_class_accuracy:.2f}%, Sensitivity (Recall): {tr_class_sensitivity:.2f}%, Specificity: {tr_class_specificity:.2f}%, AUC: {tr_class_auc:.2f}%')
+            if accumulator.effective_batch_size is None:
+                accumulator.effective_batch_size = len(tr_labels)
+            if micro_batch_size == "auto":
+                micro_batch_size = auto_micro_batch_size(model,
+                                                         lambda images: forward_views(
+                                                             model, images, device, None, images_memory_format),
+                                                         tr_images, accumulator.effective_batch_size, memory_budget_gb, precision_context)
+
+            for micro_slice, tr_micro_images, tr_micro_keys in split_batch(tr_images, tr_keys, micro_batch_size or len(tr_labels)):
+                tr_micro_labels = tr_labels[micro_slice]
+                with precision_context:
+                    tr_outputs = forward_views(
+                        model, tr_micro_images, device, tr_micro_keys, images_memory_format)
+
+                    # Multiclassification loss considering all classes
+                    tr_epoch_loss = criterion(tr_outputs, tr_micro_labels)
+
+                accumulator.backward(tr_epoch_loss, len(tr_micro_labels))
+                tr_metrics.update(tr_outputs, tr_micro_labels)
+            if (tr_i+1) % 100 == 0:
+                print('Training -> Epoch [{}/{}], Step [{}/{}], Loss: {:.4f}, Accuracy: {:.4f}%, Sensitivity (Recall): {:.4f}%'
+                        .format(epoch+1, config["epochs"], tr_i+1, total_step, tr_epoch_loss, tr_metrics.accuracy(), tr_metrics.recall()))
+                for class_label, tr_class_metrics in tr_metrics.classes_metrics().items():
+                    print(
+                        f'Class {class_label} - Accuracy: {tr_class_metrics["accuracy"]:.2f}%, Sensitivity (Recall): {tr_class_metrics["sensitivity"]:.2f}%, Specificity: {tr_class_metrics["specificity"]:.2f}%')
+
+        # Step on the gradients accumulated on the last images of the epoch
+        accumulator.step()
+        tr_accuracy = tr_metrics.accuracy()
+        tr_sensitivity = tr_metrics.recall()
+        # The AUC needs the scores of the whole epoch, so it is computed only once at the end of the epoch
+        tr_classes_metrics = tr_metrics.classes_metrics(with_auc=True)
 
         if config["use_wandb"]:
             wandb.log({"Training Loss": tr_epoch_loss.item()})
@@ -143,26 +159,23 @@ def train_eval_loop(device,
 
         model.eval()
         with torch.no_grad():
-            epoch_val_preds = torch.tensor([]).to(device)
-            epoch_val_labels = torch.tensor([]).to(device)
-            epoch_val_scores = torch.tensor([]).to(device)
+            val_metrics.reset()
             for _, val_batch in enumerate(tqdm(val_loader, desc="Validation", leave=False)):
                 #(val_image_ori, val_image_low, val_image_high), val_labels = val_batch
-                if len(val_batch) == 3:
-                    val_images, val_labels, _ = val_batch
-                else:
-                    val_images, val_labels = val_batch
+                val_images, val_labels, val_keys = unpack_batch(val_batch)
 
                 #val_image_ori = val_image_ori.to(device)
                 #val_image_low = val_image_low.to(device)
                 #val_image_high = val_image_high.to(device)
-                val_labels = val_labels.to(device)
+                val_labels = val_labels.to(device, non_blocking=True)
 
                 #val_output_ori = model(val_image_ori)  # Prediction original image
                 #val_output_low = model(val_image_low)  # Prediction gradcam 70
                 #val_output_high = model(val_image_high)  # Prediction gradcam 110
 
-                val_outputs = model(val_images)
+                with precision_context:
+                    val_outputs = forward_views(
+                        model, val_images, device, val_keys, images_memory_format)
 
                 #val_outputs = (val_output_ori + val_output_low + val_output_high) / 3
 
@@ -171,58 +184,18 @@ def train_eval_loop(device,
                     val_outputs, val_labels)
                 val_epoch_loss = val_epoch_loss_multiclass
 
-                val_preds = torch.argmax(val_outputs, -1).detach()
-                epoch_val_preds = torch.cat(
-                    (epoch_val_preds, val_preds), 0)
-                epoch_val_labels = torch.cat(
-                    (epoch_val_labels, val_labels), 0)
-                
-                val_outputs = val_outputs.t()
-                epoch_val_scores = torch.cat((epoch_val_scores, val_outputs), 1)
+                val_metrics.update(val_outputs, val_labels)
+            flush_activation_cache(model)
 
-            val_accuracy = accuracy_score(
-                epoch_val_labels.cpu().numpy(), epoch_val_preds.cpu().numpy()) * 100
-            val_sensitivity = recall_score(
-                epoch_val_labels.cpu().numpy(), epoch_val_preds.cpu().numpy(), average='macro', zero_division=0) * 100
+            val_accuracy = val_metrics.accuracy()
+            val_sensitivity = val_metrics.recall()
 
             print('Validation -> Epoch [{}/{}], Loss: {:.4f}, Accuracy: {:.4f}%, Sensitivity (Recall): {:.4f}%'
                   .format(epoch+1, config["epochs"], val_epoch_loss, val_accuracy, val_sensitivity))
 
-            val_classes_metrics = {}
-            for class_label in range(NUM_CLASSES):
-                val_class_labels_binary = torch.zeros_like(
-                    epoch_val_labels, dtype=torch.long).to(device)
-                val_class_labels_binary[(epoch_val_labels == class_label)] = 1
-
-                val_class_preds_binary = torch.zeros_like(
-                    epoch_val_preds, dtype=torch.long).to(device)
-                val_class_preds_binary[(epoch_val_preds == class_label)] = 1
-
-                epoch_val_scores_class = epoch_val_scores[class_label]
-
-                if len(val_class_preds_binary) > 0:
-                    val_class_accuracy = accuracy_score(
-                        val_class_labels_binary.cpu().numpy(), val_class_preds_binary.cpu().numpy()) * 100
-                    val_class_sensitivity = recall_score(
-                        val_class_labels_binary.cpu().numpy(), val_class_preds_binary.cpu().numpy(), average='binary', pos_label=1, zero_division=0) * 100
-                    val_class_conf_matrix = confusion_matrix(
-                        val_class_labels_binary.cpu().numpy(), val_class_preds_binary.cpu().numpy())
-                    if val_class_conf_matrix.shape == (2, 2) and (val_class_conf_matrix[0, 0] + val_class_conf_matrix[0, 1]) > 0:
-                        val_class_specificity = val_class_conf_matrix[0, 0] / (
-                            val_class_conf_matrix[0, 0] + val_class_conf_matrix[0, 1]) * 100
-                    else:
-                        val_class_specificity = 0
-                    if len(set(val_class_labels_binary.cpu().numpy())) > 1:
-                        val_class_auc = roc_auc_score(
-                            val_class_labels_binary.cpu().numpy(), epoch_val_scores_class.cpu().numpy()) * 100
-                    else:
-                        val_class_auc = 0
-
-                    val_class_metrics = {"accuracy": val_class_accuracy, "sensitivity": val_class_sensitivity,
-                                         "specificity": val_class_specificity, "auc": val_class_auc}
-                    val_classes_metrics[class_label] = val_class_metrics
-
-                    print(f'Class {class_label} - Accuracy: {val_class_accuracy:.2f}%, Sensitivity (Recall): {val_class_sensitivity:.2f}%, Specificity: {val_class_specificity:.2f}%, AUC: {val_class_auc:.2f}%')
+            val_classes_metrics = val_metrics.classes_metrics(with_auc=True)
+            for class_label, val_class_metrics in val_classes_metrics.items():
+                print(f'Class {class_label} - Accuracy: {val_class_metrics["accuracy"]:.2f}%, Sensitivity (Recall): {val_class_metrics["sensitivity"]:.2f}%, Specificity: {val_class_metrics["specificity"]:.2f}%, AUC: {val_class_metrics["auc"]:.2f}%')
 
             if config["use_wandb"]:
                 wandb.log({"Validation Loss": val_epoch_loss.item()})
@@ -230,9 +203,9 @@ def train_eval_loop(device,
                 wandb.log({"Validation Sensitivity": val_sensitivity})
                 wandb.log({"Validation Classes Metrics": val_classes_metrics})
 
-            if best_accuracy is None or val_accuracy < best_accuracy:
+            is_best = best_accuracy is None or val_accuracy < best_accuracy
+            if is_best:
                 best_accuracy = val_accuracy
-                best_model = copy.deepcopy(model)
             current_results = {
                 'epoch': epoch+1,
                 'validation_loss': val_epoch_loss.item(),
@@ -247,6 +220,9 @@ def train_eval_loop(device,
             if SAVE_RESULTS:
                 save_results(data_name, current_results)
             if SAVE_MODELS:
-                save_model(data_name, model, epoch)
-            if epoch == config["epochs"]-1 and SAVE_MODELS:
-                save_model(data_name, best_model, epoch=None, is_best=True)
+                # The state is copied to the cpu here and written to disk in the background
+                checkpoint_manager.save(epoch+1, model, optimizer, scheduler, scaler,
+                                        is_best=is_best, best_accuracy=best_accuracy)
+
+    if checkpoint_manager is not None:
+        checkpoint_manager.close()
@@ -4,6 +4,7 @@ import os
 import json
 from sklearn.metrics import recall_score, accuracy_score
 from tqdm import tqdm
+from utils.checkpoint import load_model_weights
 from utils.utils import save_results, set_seed, select_device
 from utils.dataloader_utils import get_dataloder_from_strategy
 from config import USE_MULTIPLE_LOSS, MULTIPLE_LOSS_BALANCE, SAVE_RESULTS, DATASET_LIMIT, NORMALIZE, RANDOM_SEED, PATH_TO_SAVE_RESULTS, NUM_CLASSES, HIDDEN_SIZE, INPUT_SIZE, IMAGE_SIZE, PATCH_SIZE, EMB_SIZE, N_HEADS, N_LAYERS, DROPOUT_P, SEGMENTATION_STRATEGY, DYNAMIC_SEGMENTATION_STRATEGY, BATCH_SIZE
@@ -24,8 +25,8 @@ def test(test_model, test_loader, device, data_name):
         epoch_test_preds = torch.tensor([]).to(device)
         epoch_test_labels = torch.tensor([]).to(device)
         for _, (test_images, test_labels) in enumerate(tqdm(test_loader, desc="Test")):
-            test_images = test_images.to(device)
-            test_labels = test_labels.to(device)
+            test_images = test_images.to(device, non_blocking=True)
+            test_labels = test_labels.to(device, non_blocking=True)
 
             test_outputs = test_model(test_images)
             test_preds = torch.argmax(test_outputs, -1).detach()
@@ -133,8 +134,8 @@ def get_model(model_path, device):
 
 
 def load_test_model(model, model_path, epoch):
-    state_dict = torch.load(
-        f"{PATH_TO_SAVE_RESULTS}/{model_path}/models/melanoma_detection_{epoch}.pt",  map_location=torch.device('mps'))
+    state_dict = load_model_weights(
+        f"{PATH_TO_SAVE_RESULTS}/{model_path}/models/melanoma_detection_{epoch}.pt",  map_location=torch.device('mps'), base_model=model)
     model.load_state_dict(state_dict)
     model.eval()
     return model
@@ -1,13 +1,16 @@
-from typing import Any, Dict
-from sklearn.metrics import recall_score, accuracy_score
-from utils.utils import save_results, save_model, save_configurations
+from typing import Any, Dict, Optional, Union
+from utils.metrics import StreamingMetrics
+from utils.micro_batching import GradientAccumulator, auto_micro_batch_size, set_batch_norm_mode, split_batch
+from utils.precision import autocast, grad_scaler, memory_format
+from utils.checkpoint import CheckpointManager, checkpoint_dir, checkpoint_path, load_checkpoint
+from utils.utils import save_results, save_configurations
 from tqdm import tqdm
 import torch
 import torch.nn as nn
 import wandb
 from datetime import datetime
-import copy
-from config import SAVE_MODELS, SAVE_RESULTS, PATH_MODEL_TO_RESUME, RESUME_EPOCH, USE_MULTIPLE_LOSS, MULTIPLE_LOSS_BALANCE
+import time
+from config import MEMORY_BUDGET_GB, NUM_CLASSES, SAVE_MODELS, SAVE_RESULTS, PATH_MODEL_TO_RESUME, RESUME_EPOCH, USE_MULTIPLE_LOSS, MULTIPLE_LOSS_BALANCE
 
 
 def train_eval_loop(device,
@@ -17,7 +20,26 @@ def train_eval_loop(device,
                     config,
                     optimizer,
                     scheduler,
-                    resume=False):
+                    resume=False,
+                    precision: str = "fp32",
+                    channels_last: bool = False,
+                    micro_batch_size: Optional[Union[int, str]] = None,
+                    effective_batch_size: Optional[int] = None,
+                    batch_norm_mode: str = "micro_batch",
+                    memory_budget_gb: float = MEMORY_BUDGET_GB,
+                    save: bool = True):
+    """
+    precision is "fp32", "bf16" or "fp16" (see utils.precision): the forward pass and the loss run under autocast,
+    and with fp16 on the gpu the loss is scaled to avoid the underflow of the gradients.
+    With channels_last, the model and the images are converted to the NHWC memory format, which is faster for the convolutions of the CNN models.
+
+    The batches of the train loader are split into micro-batches of micro_batch_size images (None = the whole batch, "auto" = the largest
+    micro-batch whose activations fit in memory_budget_gb), whose gradients are accumulated until effective_batch_size images
+    (None = the size of the loader batches) have been seen. batch_norm_mode is how the batch norm layers are trained on the micro-batches
+    (see utils.micro_batching.set_batch_norm_mode).
+
+    With save=False (e.g. for the benchmarks) nothing is saved on disk, otherwise SAVE_RESULTS and SAVE_MODELS apply.
+    """
 
     if config["use_wandb"] and "hparam_tuning" not in config:
         # Start a new run
@@ -28,6 +50,11 @@ def train_eval_loop(device,
         )
 
     criterion = nn.CrossEntropyLoss() # Loss function
+    precision_context = autocast(device, precision)
+    scaler = grad_scaler(device, precision)
+    images_memory_format = memory_format(channels_last)
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
 
     if resume:
         data_name = PATH_MODEL_TO_RESUME
@@ -36,70 +63,90 @@ def train_eval_loop(device,
         current_datetime = datetime.now()
         current_datetime_str = current_datetime.strftime("%Y-%m-%d_%H-%M-%S")
         data_name = f"{config['architecture']}_{current_datetime_str}"
+        if config.get("hparam_tuning"):
+            # Parallel trials start in the same second, so their folders are distinguished by the hyperparameters
+            data_name = f"{data_name}_reg{config['reg']}_dropout{config['dropout_p']}"
 
-        if SAVE_RESULTS:
+        if SAVE_RESULTS and save:
             # Save configurations in JSON
             save_configurations(data_name, config)
 
     total_step = len(train_loader)
-    best_model = None
     best_accuracy = None
+    checkpoint_manager = CheckpointManager(checkpoint_dir(data_name)) if SAVE_MODELS and save else None
+    if resume:
+        # Restores the optimizer, scheduler, gradient scaler and random state too, when the checkpoint has them
+        best_accuracy = load_checkpoint(checkpoint_path(checkpoint_dir(PATH_MODEL_TO_RESUME), RESUME_EPOCH), model, optimizer, scheduler, scaler,
+                                        map_location=device).get("best_accuracy")
+    tr_metrics = StreamingMetrics(NUM_CLASSES, device)
+    val_metrics = StreamingMetrics(NUM_CLASSES, device)
+    accumulator = GradientAccumulator(optimizer, scaler, effective_batch_size)
     for epoch in range(RESUME_EPOCH if resume else 0, config["epochs"]):
         model.train()
-        epoch_tr_preds = torch.tensor([]).to(device)
-        epoch_tr_labels = torch.tensor([]).to(device)
+        set_batch_norm_mode(model, batch_norm_mode)
+        tr_metrics.reset()
+        tr_start = time.perf_counter()
+        tr_num_images = 0
         for tr_i, tr_batch in enumerate(tqdm(train_loader, desc="Training", leave=False)):
             if len(tr_batch) == 3:
                 tr_images, tr_labels, _ = tr_batch
             else:
                 tr_images, tr_labels = tr_batch
-            tr_images = tr_images.to(device)
-            tr_labels = tr_labels.to(device)
-
-            tr_outputs = model(tr_images)  # Prediction
-
-            # First loss: Multiclassification loss considering all classes
-            tr_epoch_loss_multiclass = criterion(
-                tr_outputs, tr_labels)
-            tr_epoch_loss = tr_epoch_loss_multiclass
-
-            if USE_MULTIPLE_LOSS:
-                tr_labels_binary = torch.zeros_like(
-                    tr_labels, dtype=torch.long).to(device)
-                # Set ground-truth to 1 for classes 2, 3, and 4 (the malignant classes)
-                tr_labels_binary[(tr_labels == 2) | (
-                    tr_labels == 3) | (tr_labels == 4)] = 1
-
-                # Second loss: Binary loss considering only benign/malignant classes
-                tr_outputs_binary = torch.zeros_like(
-                    tr_outputs[:, :2]).to(device)
-                tr_outputs_binary[:, 1] = torch.sum(
-                    tr_outputs[:, [2, 3, 4]], dim=1)
-                tr_outputs_binary[:, 0] = 1 - tr_outputs_binary[:, 1]
-
-                tr_epoch_loss_binary = criterion(
-                    tr_outputs_binary, tr_labels_binary)
-
-                # Sum of the losses (with importance factor)
-                tr_epoch_loss = (tr_epoch_loss * MULTIPLE_LOSS_BALANCE) + (tr_epoch_loss_binary * (1 - MULTIPLE_LOSS_BALANCE))
-
-            optimizer.zero_grad()
-            tr_epoch_loss.backward()
-            optimizer.step()
-
-            with torch.no_grad():
-                tr_preds = torch.argmax(tr_outputs, -1).detach()
-                epoch_tr_preds = torch.cat((epoch_tr_preds, tr_preds), 0)
-                epoch_tr_labels = torch.cat((epoch_tr_labels, tr_labels), 0)
-
-                tr_accuracy = accuracy_score(
-                epoch_tr_labels.cpu().numpy(), epoch_tr_preds.cpu().numpy()) * 100
-                tr_recall = recall_score(
-                    epoch_tr_labels.cpu().numpy(), epoch_tr_preds.cpu().numpy(), average='macro', zero_division=0) * 100
-
-                if (tr_i+1) % 5 == 0:
-                    print('Training -> Epoch [{}/{}], Step [{}/{}], Loss: {:.4f}, Accuracy: {:.4f}%, Recall: {:.4f}%'
-                            .format(epoch+1, config["epochs"], tr_i+1, total_step, tr_epoch_loss, tr_accuracy, tr_recall))
+            tr_images = tr_images.to(
+                device, non_blocking=True, memory_format=images_memory_format)
+            tr_labels = tr_labels.to(device, non_blocking=True)
+            if accumulator.effective_batch_size is None:
+                accumulator.effective_batch_size = len(tr_labels)
+            if micro_batch_size == "auto":
+                micro_batch_size = auto_micro_batch_size(model, model, tr_images, accumulator.effective_batch_size,
+                                                         memory_budget_gb, precision_context)
+
+            for micro_slice, tr_micro_images, _ in split_batch(tr_images, None, micro_batch_size or len(tr_labels)):
+                tr_micro_labels = tr_labels[micro_slice]
+                with precision_context:
+                    tr_outputs = model(tr_micro_images)  # Prediction
+
+                    # First loss: Multiclassification loss considering all classes
+                    tr_epoch_loss_multiclass = criterion(
+                        tr_outputs, tr_micro_labels)
+                # The binary loss below is computed in fp32
+                tr_outputs = tr_outputs.float()
+                tr_epoch_loss = tr_epoch_loss_multiclass.float()
+
+                if USE_MULTIPLE_LOSS:
+                    tr_labels_binary = torch.zeros_like(
+                        tr_micro_labels, dtype=torch.long).to(device)
+                    # Set ground-truth to 1 for classes 2, 3, and 4 (the malignant classes)
+                    tr_labels_binary[(tr_micro_labels == 2) | (
+                        tr_micro_labels == 3) | (tr_micro_labels == 4)] = 1
+
+                    # Second loss: Binary loss considering only benign/malignant classes
+                    tr_outputs_binary = torch.zeros_like(
+                        tr_outputs[:, :2]).to(device)
+                    tr_outputs_binary[:, 1] = torch.sum(
+                        tr_outputs[:, [2, 3, 4]], dim=1)
+                    tr_outputs_binary[:, 0] = 1 - tr_outputs_binary[:, 1]
+
+                    tr_epoch_loss_binary = criterion(
+                        tr_outputs_binary, tr_labels_binary)
+
+                    # Sum of the losses (with importance factor)
+                    tr_epoch_loss = (tr_epoch_loss * MULTIPLE_LOSS_BALANCE) + (tr_epoch_loss_binary * (1 - MULTIPLE_LOSS_BALANCE))
+
+                accumulator.backward(tr_epoch_loss, len(tr_micro_labels))
+
+                tr_num_images += len(tr_micro_labels)
+                tr_metrics.update(tr_outputs, tr_micro_labels)
+            if (tr_i+1) % 5 == 0:
+                print('Training -> Epoch [{}/{}], Step [{}/{}], Loss: {:.4f}, Accuracy: {:.4f}%, Recall: {:.4f}%'
+                        .format(epoch+1, config["epochs"], tr_i+1, total_step, tr_epoch_loss, tr_metrics.accuracy(), tr_metrics.recall()))
+
+        # Step on the gradients accumulated on the last images of the epoch
+        accumulator.step()
+        # Images per second of the training epoch (including the data loading)
+        tr_throughput = tr_num_images / (time.perf_counter() - tr_start)
+        tr_accuracy = tr_metrics.accuracy()
+        tr_recall = tr_metrics.recall()
 
         if config["use_wandb"]:
             wandb.log({"Training Loss": tr_epoch_loss.item()})
@@ -108,20 +155,20 @@ def train_eval_loop(device,
 
         model.eval()
         with torch.no_grad():
-            epoch_val_preds = torch.tensor([]).to(device)
-            epoch_val_labels = torch.tensor([]).to(device)
+            val_metrics.reset()
             for val_i, val_batch in enumerate(val_loader):
                 if len(val_batch) == 3:
                     val_images, val_labels, _ = val_batch
                 else:
                     val_images, val_labels = val_batch
-                val_images = val_images.to(device)
-                val_labels = val_labels.to(device)
+                val_images = val_images.to(
+                    device, non_blocking=True, memory_format=images_memory_format)
+                val_labels = val_labels.to(device, non_blocking=True)
 
-                val_outputs = model(val_images).to(device)
-                val_preds = torch.argmax(val_outputs, -1).detach()
-                epoch_val_preds = torch.cat((epoch_val_preds, val_preds), 0)
-                epoch_val_labels = torch.cat((epoch_val_labels, val_labels), 0)
+                with precision_context:
+                    val_outputs = model(val_images).to(device)
+                val_outputs = val_outputs.float()
+                val_metrics.update(val_outputs, val_labels)
 
                 # First loss: Multiclassification loss considering all classes
                 val_epoch_loss_multiclass = criterion(
@@ -148,10 +195,8 @@ def train_eval_loop(device,
                     # Sum of the losses
                     val_epoch_loss += val_epoch_loss_binary
 
-            val_accuracy = accuracy_score(
-                epoch_val_labels.cpu().numpy(), epoch_val_preds.cpu().numpy()) * 100
-            val_recall = recall_score(epoch_val_labels.cpu().numpy(
-            ), epoch_val_preds.cpu().numpy(), average='macro', zero_division=0) * 100
+            val_accuracy = val_metrics.accuracy()
+            val_recall = val_metrics.recall()
             if config["use_wandb"]:
                 wandb.log({"Validation Loss": val_epoch_loss.item()})
                 wandb.log({"Validation Accuracy": val_accuracy})
@@ -159,9 +204,9 @@ def train_eval_loop(device,
             print('Validation -> Epoch [{}/{}], Loss: {:.4f}, Accuracy: {:.4f}%, Recall: {:.4f}%'
                   .format(epoch+1, config["epochs"], val_epoch_loss, val_accuracy, val_recall))
 
-            if best_accuracy is None or val_accuracy < best_accuracy:
+            is_best = best_accuracy is None or val_accuracy < best_accuracy
+            if is_best:
                 best_accuracy = val_accuracy
-                best_model = copy.deepcopy(model)
             current_results = {
                 'epoch': epoch+1,
                 'validation_loss': val_epoch_loss.item(),
@@ -169,13 +214,20 @@ def train_eval_loop(device,
                 'validation_accuracy': val_accuracy,
                 'training_accuracy': tr_accuracy,
                 'validation_recall': val_recall,
-                'training_recall': tr_recall
+                'training_recall': tr_recall,
+                'training_throughput': tr_throughput
             }
-            if SAVE_RESULTS:
+            if SAVE_RESULTS and save:
                 save_results(data_name, current_results)
-            if SAVE_MODELS:
-                save_model(data_name, model, epoch)
-            if epoch == config["epochs"]-1 and SAVE_MODELS:
-                save_model(data_name, best_model, epoch=None, is_best=True)
+            if checkpoint_manager is not None:
+                # The state is copied to the cpu here and written to disk in the background
+                checkpoint_manager.save(epoch+1, model, optimizer, scheduler, scaler,
+                                        is_best=is_best, best_accuracy=best_accuracy)
 
         #scheduler.step()
+
+    if checkpoint_manager is not None:
+        checkpoint_manager.close()
+
+    # The results of the last epoch are returned, e.g. to rank the hyperparameter combinations
+    return current_results
@@ -0,0 +1,113 @@
+import json
+import os
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+INDEX_FILE_NAME = "index.json"
+DATA_FILE_NAME = "data.npy"
+
+
+class ArrayStore:
+    """
+    On-disk store of fixed-shape arrays keyed by string, kept in a single memory-mapped .npy file.
+    The index maps every key to its row in the file. Rows are appended (the file grows when the capacity is reached),
+    and the index is written atomically by flush(), so a row is visible only after it has been completely written.
+    Only one process at a time must write in the store, while any number of processes can read from it.
+    The shape of the arrays can be omitted when opening an existing store.
+    """
+
+    def __init__(self, store_dir: str, shape: Optional[Tuple[int, ...]] = None, dtype=np.float32, capacity: int = 1024):
+        self.store_dir = store_dir
+        self.shape = tuple(shape) if shape is not None else None
+        self.dtype = np.dtype(dtype)
+        os.makedirs(store_dir, exist_ok=True)
+        index_path = os.path.join(store_dir, INDEX_FILE_NAME)
+        if os.path.exists(index_path):
+            with open(index_path, "r") as f:
+                self.index: Dict[str, int] = json.load(f)
+        else:
+            self.index = {}
+        self._capacity = capacity
+        self._data = None
+        self._mode = "r"
+
+    @property
+    def data(self) -> np.memmap:
+        # NOTE: the file is mapped lazily, so that each dataloader worker maps it on its own after being forked/spawned.
+        if self._data is None:
+            data_path = os.path.join(self.store_dir, DATA_FILE_NAME)
+            if not os.path.exists(data_path):
+                if self.shape is None:
+                    raise FileNotFoundError(
+                        f"Array store not found in {self.store_dir}")
+                self._data = np.lib.format.open_memmap(
+                    data_path, mode="w+", dtype=self.dtype, shape=(self._capacity, *self.shape))
+                self._mode = "r+"
+            else:
+                self._data = np.load(data_path, mmap_mode=self._mode)
+                if self.shape is None:
+                    self.shape = self._data.shape[1:]
+            assert self._data.shape[1:] == self.shape and self._data.dtype == self.dtype, \
+                f"The store in {self.store_dir} contains {self._data.dtype} arrays of shape {self._data.shape[1:]}, expected {self.dtype} arrays of shape {self.shape}"
+        return self._data
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_data"] = None
+        return state
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def keys(self) -> List[str]:
+        return list(self.index.keys())
+
+    def get(self, key: str) -> np.ndarray:
+        return self.data[self.index[key]]
+
+    def get_batch(self, keys: Iterable[str]) -> np.ndarray:
+        return self.data[[self.index[key] for key in keys]]
+
+    def _writable_data(self, rows: int) -> np.memmap:
+        if self._mode != "r+":
+            self._data = None
+            self._mode = "r+"
+        data = self.data
+        if rows <= len(data):
+            return data
+        # Grow the file, doubling its capacity
+        capacity = max(rows, 2 * len(data))
+        data_path = os.path.join(self.store_dir, DATA_FILE_NAME)
+        grown_data = np.lib.format.open_memmap(
+            data_path + ".tmp", mode="w+", dtype=self.dtype, shape=(capacity, *self.shape))
+        grown_data[:len(self.index)] = data[:len(self.index)]
+        grown_data.flush()
+        del data, grown_data
+        self._data = None
+        os.replace(data_path + ".tmp", data_path)
+        return self.data
+
+    def put_batch(self, keys: List[str], arrays: np.ndarray):
+        """
+        Writes the arrays of the keys (existing keys are overwritten). Call flush() to make them visible to the readers.
+        """
+        new_keys = [key for key in dict.fromkeys(keys) if key not in self.index]
+        data = self._writable_data(len(self.index) + len(new_keys))
+        for key in new_keys:
+            self.index[key] = len(self.index)
+        data[[self.index[key] for key in keys]] = arrays
+
+    def put(self, key: str, array: np.ndarray):
+        self.put_batch([key], array[None])
+
+    def flush(self):
+        if self._data is not None and self._mode == "r+":
+            self._data.flush()
+        index_path = os.path.join(self.store_dir, INDEX_FILE_NAME)
+        with open(index_path + ".tmp", "w") as f:
+            json.dump(self.index, f)
+        os.replace(index_path + ".tmp", index_path)
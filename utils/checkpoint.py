@@ -0,0 +1,232 @@
+import glob
+import os
+import random
+import re
+import shutil
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import torch
+
+from config import DELTA_CHECKPOINTS, KEEP_LAST_CHECKPOINTS, PATH_TO_SAVE_RESULTS
+from utils.utils import hash_module_state
+
+
+def checkpoint_dir(data_name: str) -> str:
+    return f"{PATH_TO_SAVE_RESULTS}/{data_name}/models"
+
+
+def checkpoint_path(directory: str, epoch: Optional[int] = None, is_best: bool = False) -> str:
+    """
+    Path of the checkpoint saved after the given number of epochs (or of the best one), with the same names used by save_model.
+    """
+    name = "best" if is_best else str(epoch)
+    return os.path.join(directory, f"melanoma_detection_{name}.pt")
+
+
+def _to_cpu(obj):
+    """
+    Recursively copies the tensors of a state (e.g. the optimizer state_dict) to the cpu, so the training can keep updating the originals.
+    """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: _to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(value) for value in obj)
+    return obj
+
+
+def rng_state() -> Dict[str, Any]:
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state: Dict[str, Any]):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def delta_state_names(model) -> List[str]:
+    """
+    Names of the state_dict entries that can change while training: the trainable parameters and all the buffers
+    (e.g. the batch norm running statistics, which are updated also in a frozen backbone).
+    The other entries are the frozen pretrained base. Shared modules (e.g. classifier and model.fc) are matched by tensor.
+    """
+    changing = {parameter.data_ptr() for parameter in model.parameters() if parameter.requires_grad} | \
+        {buffer.data_ptr() for buffer in model.buffers()}
+    return [name for name, tensor in model.state_dict().items() if tensor.data_ptr() in changing]
+
+
+def base_state(model, delta_names: List[str]) -> Dict[str, str]:
+    """
+    Identifies the pretrained base of a delta checkpoint: the model class and the hash of its frozen entries.
+    """
+    return {"architecture": type(model).__name__,
+            "hash": hash_module_state(model, exclude_prefixes=tuple(delta_names))}
+
+
+def reconstitute_state_dict(checkpoint: Dict[str, Any], base_model) -> Dict[str, torch.Tensor]:
+    """
+    Returns the full state_dict of a delta checkpoint, applying its entries to the state of base_model,
+    which must be a freshly built model with the same pretrained base (checked with its hash).
+    """
+    delta = checkpoint["model"]
+    base = base_state(base_model, list(delta.keys()))
+    if base != checkpoint["base"]:
+        raise ValueError(
+            f"The delta checkpoint derives from {checkpoint['base']}, but the base model is {base}")
+    state_dict = dict(base_model.state_dict())
+    state_dict.update(delta)
+    return state_dict
+
+
+def is_full_checkpoint(checkpoint) -> bool:
+    return isinstance(checkpoint, dict) and "model" in checkpoint and "epoch" in checkpoint
+
+
+def load_model_weights(path: str, map_location=None, base_model=None) -> Dict[str, torch.Tensor]:
+    """
+    Returns the model state_dict of a checkpoint, both of the checkpoints of CheckpointManager and of the plain state_dicts saved by save_model.
+    The delta checkpoints are reconstituted on the state of base_model (see reconstitute_state_dict), which they require.
+    NOTE: the checkpoints contain the (numpy and python) random state, so they are loaded with weights_only=False: load only trusted files.
+    """
+    checkpoint = torch.load(path, map_location=map_location, weights_only=False)
+    if not is_full_checkpoint(checkpoint):
+        return checkpoint
+    if checkpoint.get("base") is None:
+        return checkpoint["model"]
+    if base_model is None:
+        raise ValueError(
+            f"{path} is a delta checkpoint, it can be loaded only on its base model")
+    return reconstitute_state_dict(checkpoint, base_model)
+
+
+def load_checkpoint(path: str, model, optimizer=None, scheduler=None, scaler=None, map_location=None) -> Dict[str, Any]:
+    """
+    Restores the model and, when the checkpoint has them, the optimizer, scheduler, gradient scaler and random number generators.
+    Returns the checkpoint (e.g. to read its epoch and best score). Plain state_dicts restore only the weights.
+    """
+    checkpoint = torch.load(path, map_location=map_location, weights_only=False)
+    if not is_full_checkpoint(checkpoint):
+        print(
+            f"--Checkpoint-- {path} contains only the model weights, the optimizer, scheduler and random state are not restored")
+        model.load_state_dict(checkpoint)
+        return {}
+    if checkpoint.get("base") is not None:
+        model.load_state_dict(reconstitute_state_dict(checkpoint, model))
+    else:
+        model.load_state_dict(checkpoint["model"])
+    for name, stateful in [("optimizer", optimizer), ("scheduler", scheduler), ("scaler", scaler)]:
+        if stateful is not None and checkpoint.get(name) is not None:
+            stateful.load_state_dict(checkpoint[name])
+    if checkpoint.get("rng") is not None:
+        set_rng_state(checkpoint["rng"])
+    print(
+        f"--Checkpoint-- Resumed from {path} (epoch {checkpoint['epoch']})")
+    return checkpoint
+
+
+class CheckpointManager:
+    """
+    Saves the resumable state of the training (model, optimizer, scheduler, gradient scaler, random state) in a directory (see checkpoint_dir).
+    The tensors are copied to the cpu on the training thread, then serialized by a background thread, so the training doesn't wait for the disk.
+    Every file is written to a temporary path and atomically renamed, so an interrupted save never leaves a truncated checkpoint.
+    Only the last keep_last epoch checkpoints are kept, plus the best one.
+    With delta, the checkpoints store only the trainable parameters and the buffers (see delta_state_names) with the hash of the frozen
+    pretrained base, which is the same for all the runs of an architecture, e.g. only the classifier of the frozen CNN backbones.
+    """
+
+    def __init__(self, directory: str, keep_last: int = KEEP_LAST_CHECKPOINTS, asynchronous: bool = True, delta: bool = DELTA_CHECKPOINTS):
+        self.directory = directory
+        self.delta = delta
+        self.delta_names = None
+        self.base = None
+        os.makedirs(self.directory, exist_ok=True)
+        self.keep_last = keep_last
+        # A single writer, so the checkpoints are written (and rotated) in order
+        self.executor = ThreadPoolExecutor(
+            max_workers=1) if asynchronous else None
+        self.pending: Optional[Future] = None
+
+    def snapshot(self, epoch: int, model, optimizer=None, scheduler=None, scaler=None, **extra) -> Dict[str, Any]:
+        model_state = model.state_dict()
+        if self.delta:
+            if self.base is None:
+                # The frozen base doesn't change while training, so it is hashed only once
+                self.delta_names = delta_state_names(model)
+                self.base = base_state(model, self.delta_names)
+            model_state = {name: model_state[name]
+                           for name in self.delta_names}
+        return {
+            "epoch": epoch,
+            "model": _to_cpu(model_state),
+            "base": self.base,
+            "optimizer": _to_cpu(optimizer.state_dict()) if optimizer is not None else None,
+            "scheduler": scheduler.state_dict() if scheduler is not None else None,
+            "scaler": scaler.state_dict() if scaler is not None else None,
+            "rng": rng_state(),
+            **extra,
+        }
+
+    def save(self, epoch: int, model, optimizer=None, scheduler=None, scaler=None, is_best: bool = False, **extra):
+        """
+        Saves the state after epoch epochs (1-based, as the file names), also as the best checkpoint if is_best.
+        The extra values (e.g. the best score) are stored in the checkpoint.
+        """
+        checkpoint = self.snapshot(
+            epoch, model, optimizer, scheduler, scaler, **extra)
+        # At most one checkpoint is kept in memory waiting for the disk
+        self.wait()
+        if self.executor is None:
+            self.write(checkpoint, is_best)
+        else:
+            self.pending = self.executor.submit(
+                self.write, checkpoint, is_best)
+
+    def write(self, checkpoint: Dict[str, Any], is_best: bool):
+        path = checkpoint_path(self.directory, checkpoint["epoch"])
+        tmp_path = f"{path}.tmp"
+        torch.save(checkpoint, tmp_path)
+        os.replace(tmp_path, path)
+        if is_best:
+            best_path = checkpoint_path(self.directory, is_best=True)
+            best_tmp_path = f"{best_path}.tmp"
+            if os.path.exists(best_tmp_path):
+                os.remove(best_tmp_path)
+            try:
+                # The best checkpoint shares the data of the epoch one, which can be rotated away without affecting it
+                os.link(path, best_tmp_path)
+            except OSError:
+                shutil.copyfile(path, best_tmp_path)
+            os.replace(best_tmp_path, best_path)
+        self.rotate()
+
+    def rotate(self):
+        epochs = sorted(int(match.group(1)) for match in (re.search(r"melanoma_detection_(\d+)\.pt$", path)
+                                                          for path in glob.glob(os.path.join(self.directory, "melanoma_detection_*.pt"))) if match)
+        for epoch in epochs[:max(len(epochs) - self.keep_last, 0)]:
+            os.remove(checkpoint_path(self.directory, epoch))
+
+    def wait(self):
+        """
+        Waits for the checkpoint being written, raising its error if the write failed.
+        """
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def close(self):
+        self.wait()
+        if self.executor is not None:
+            self.executor.shutdown()
@@ -1,5 +1,5 @@
 from typing import Optional
-from config import BATCH_SIZE, DATASET_LIMIT, KEEP_BACKGROUND, LOAD_SYNTHETIC, NORMALIZE
+from config import BATCH_SIZE, DATASET_LIMIT, KEEP_BACKGROUND, LOAD_SYNTHETIC, NORMALIZE, NUM_WORKERS, USE_IMAGE_STORE
 from dataloaders.DataLoader import DataLoader
 from dataloaders.DynamicSegmentationDataLoader import DynamicSegmentationDataLoader
 from dataloaders.ImagesAndSegmentationDataLoader import ImagesAndSegmentationDataLoader
@@ -16,7 +16,10 @@ def get_dataloder_from_strategy(strategy: SegmentationStrategy,
                                 normalization_statistics: tuple = None,
                                 batch_size: int = BATCH_SIZE,
                                 keep_background: Optional[bool] = KEEP_BACKGROUND,
-                                load_synthetic: bool = LOAD_SYNTHETIC) -> DataLoader:
+                                load_synthetic: bool = LOAD_SYNTHETIC,
+                                use_image_store: bool = USE_IMAGE_STORE,
+                                num_workers: int = NUM_WORKERS,
+                                return_activation_keys: bool = False) -> DataLoader:
 
     if strategy == SegmentationStrategy.DYNAMIC_SEGMENTATION.value:
         dataloader = DynamicSegmentationDataLoader(
@@ -29,6 +32,9 @@ def get_dataloder_from_strategy(strategy: SegmentationStrategy,
             batch_size=batch_size,
             keep_background=keep_background,
             load_synthetic=load_synthetic,
+            use_image_store=use_image_store,
+            num_workers=num_workers,
+            return_activation_keys=return_activation_keys,
         )
     elif strategy == SegmentationStrategy.SEGMENTATION.value:
         dataloader = SegmentedImagesDataLoader(
@@ -39,7 +45,8 @@ def get_dataloder_from_strategy(strategy: SegmentationStrategy,
             normalization_statistics=normalization_statistics,
             batch_size=batch_size,
             keep_background=keep_background,
-
+            num_workers=num_workers,
+            return_activation_keys=return_activation_keys,
         )
     elif strategy == SegmentationStrategy.NO_SEGMENTATION.value:
         dataloader = ImagesAndSegmentationDataLoader(
@@ -50,6 +57,9 @@ def get_dataloder_from_strategy(strategy: SegmentationStrategy,
             normalization_statistics=normalization_statistics,
             batch_size=batch_size,
             load_synthetic=load_synthetic,
+            use_image_store=use_image_store,
+            num_workers=num_workers,
+            return_activation_keys=return_activation_keys,
         )
     else:
         raise NotImplementedError(
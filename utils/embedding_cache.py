@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+import random
+from collections import Counter
+from typing import List, Optional, Tuple
+
+import pandas as pd
+import torch
+from torch import nn
+from torch.utils.data import Dataset, Subset
+from tqdm import tqdm
+
+from config import BATCH_SIZE, CACHE_DIR
+from utils.array_store import ArrayStore
+from utils.utils import hash_module_state
+
+
+def embedding_cache_dir(model: nn.Module, params: dict, cache_dir: str = os.path.join(CACHE_DIR, "embeddings")) -> str:
+    """
+    Returns the directory of the embeddings of the backbone of the model, which depends on the backbone weights
+    and on the data parameters (e.g. segmentation strategy and dataset limit), so changing either of them never returns stale embeddings.
+    """
+    backbone_hash = hash_module_state(
+        model, exclude_prefixes=("classifier", "model.fc", "model.classifier"))
+    params_hash = hashlib.sha256(json.dumps(
+        params, sort_keys=True, default=str).encode()).hexdigest()
+    return os.path.join(cache_dir, f"{backbone_hash[:16]}_{params_hash[:16]}")
+
+
+def compute_embeddings(model: nn.Module, dataloader: torch.utils.data.DataLoader, indices: List[int], keys: List[str], store_dir: str, device: torch.device, batch_size: int = BATCH_SIZE) -> ArrayStore:
+    """
+    Stores the penultimate embeddings (the input of model.classifier) of the samples at the indices of the dataset of the dataloader.
+    The samples already in the store are skipped, so an interrupted run is resumed. The backbone runs in eval mode.
+    """
+    store = ArrayStore(store_dir) if os.path.exists(
+        os.path.join(store_dir, "data.npy")) else None
+    missing = [(idx, key) for idx, key in zip(indices, keys)
+               if store is None or key not in store]
+    if len(missing) == 0:
+        return store
+
+    embeddings = []
+    hook = model.classifier.register_forward_pre_hook(
+        lambda module, inputs: embeddings.append(inputs[0].detach().flatten(1)))
+    loader = torch.utils.data.DataLoader(Subset(dataloader.dataset, [idx for idx, _ in missing]),
+                                         batch_size=batch_size,
+                                         shuffle=False,
+                                         collate_fn=dataloader.collate_fn)
+    model.eval()
+    try:
+        start = 0
+        with torch.no_grad():
+            for batch in tqdm(loader, desc=f"Computing embeddings in {store_dir}"):
+                model(batch[0].to(device))
+                batch_embeddings = embeddings.pop().cpu().numpy()
+                if store is None:
+                    store = ArrayStore(
+                        store_dir, shape=batch_embeddings.shape[1:], capacity=len(missing))
+                batch_keys = [key for _, key in missing[start:start +
+                                                        len(batch_embeddings)]]
+                store.put_batch(batch_keys, batch_embeddings)
+                start += len(batch_embeddings)
+    finally:
+        hook.remove()
+        # The embeddings computed before an interruption are kept, so the next run resumes from them
+        if store is not None:
+            store.flush()
+    return store
+
+
+def sample_keys(metadata: pd.DataFrame) -> List[str]:
+    """
+    Returns the cache keys of the rows of the metadata: the image id, followed by the number of the copy for the augmented rows
+    (the oversampled copies of the same image, each one with its own augmentation).
+    """
+    keys, copies = [], Counter()
+    for image_id, augmented in zip(metadata['image_id'], metadata['augmented']):
+        if augmented:
+            copies[image_id] += 1
+            keys.append(f"{image_id}:augmented_{copies[image_id]}")
+        else:
+            keys.append(image_id)
+    return keys
+
+
+class CachedEmbeddingDataset(Dataset):
+    """
+    Dataset of the cached embeddings of the samples of an image dataset, with the same indices and labels.
+    keys are the cache keys of the first num_original_samples samples.
+    As for the balanced sampler, the indices from num_original_samples on are augmented draws of the sample at index - num_original_samples:
+    they return one of the num_augmented cached augmented embeddings of the sample, chosen at random.
+    """
+
+    def __init__(self, store: ArrayStore, labels: torch.Tensor, keys: List[str], num_original_samples: int, num_augmented: int = 0):
+        self.store = store
+        self.labels = labels
+        self.keys = keys
+        self.num_original_samples = num_original_samples
+        self.num_augmented = num_augmented
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        if idx < self.num_original_samples or self.num_augmented == 0:
+            key = self.keys[idx % self.num_original_samples]
+        else:
+            key = f"{self.keys[idx - self.num_original_samples]}:sampled_{random.randrange(self.num_augmented)}"
+        return torch.from_numpy(self.store.get(key).copy()), self.labels[idx]
+
+
+def build_embedding_dataloader(model: nn.Module, dataloader: torch.utils.data.DataLoader, store_dir: str, device: torch.device, num_augmented: int = 0) -> torch.utils.data.DataLoader:
+    """
+    Computes (once) the embeddings of the dataset of the dataloader, and returns a dataloader of the cached embeddings
+    that draws the same indices. If the dataset is balanced by a sampler, num_augmented augmented embeddings are cached for each sample.
+    The embeddings are keyed by the image ids (see sample_keys), so they don't depend on the order of the samples.
+    """
+    dataset = dataloader.dataset
+    num_original_samples = dataset.num_original_samples
+    labels = torch.tensor(
+        dataset.metadata['label'].values, dtype=torch.long)
+    sampler = getattr(dataset, "sampler", None)
+    if sampler is None:
+        # Without the sampler, the augmented rows (if any) are regular samples, each one with its own fixed augmentation
+        num_augmented = 0
+        num_original_samples = len(dataset)
+    indices = list(range(num_original_samples))
+    original_keys = sample_keys(dataset.metadata.iloc[:num_original_samples])
+    keys = list(original_keys)
+    for k in range(num_augmented):
+        indices += [num_original_samples +
+                    idx for idx in range(num_original_samples)]
+        keys += [f"{key}:sampled_{k}" for key in original_keys]
+    store = compute_embeddings(
+        model, dataloader, indices, keys, store_dir, device)
+    embedding_dataset = CachedEmbeddingDataset(
+        store, labels, original_keys, num_original_samples, num_augmented)
+    return torch.utils.data.DataLoader(embedding_dataset,
+                                       batch_size=dataloader.batch_size,
+                                       shuffle=sampler is None and isinstance(
+                                           dataloader.sampler, torch.utils.data.RandomSampler),
+                                       sampler=sampler)
+
+
+def build_embedding_dataloaders(model: nn.Module, loaders: List[Tuple[str, torch.utils.data.DataLoader]], params: dict, device: torch.device, num_augmented: int = 0, cache_dir: Optional[str] = None) -> List[torch.utils.data.DataLoader]:
+    """
+    Builds the embedding dataloaders of the (split name, dataloader) pairs, so that the classifier head can be trained
+    on the cached embeddings of the frozen backbone instead of running the backbone at every epoch.
+    """
+    cache_dir = embedding_cache_dir(
+        model, params) if cache_dir is None else cache_dir
+    print(f"--Embedding Cache-- Using the embeddings in {cache_dir}")
+    return [build_embedding_dataloader(model, loader, os.path.join(cache_dir, split), device,
+                                       num_augmented=num_augmented if split == "train" else 0)
+            for split, loader in loaders]
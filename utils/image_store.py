@@ -0,0 +1,102 @@
+import json
+import os
+from typing import Dict, Iterable, Tuple
+
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+INDEX_FILE_NAME = "index.json"
+DATA_FILE_NAME = "images.bin"
+
+
+class ImageStore:
+    """
+    Read-only store of pre-decoded uint8 images (H, W, C) kept in a single memory-mapped file.
+    The index maps every image_id to the offset and shape of the image inside the file, so an image
+    can be read as a numpy view of the mapped file, without decoding the original JPEG/PNG again.
+    """
+
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        index_path = os.path.join(store_dir, INDEX_FILE_NAME)
+        if not os.path.exists(index_path):
+            raise FileNotFoundError(
+                f"Image store not found in {store_dir}. Build it with `python -m scripts.build_image_store`")
+        with open(index_path, "r") as f:
+            self.index: Dict[str, Tuple[int, Tuple[int, int, int]]] = {
+                image_id: (entry["offset"], tuple(entry["shape"])) for image_id, entry in json.load(f).items()}
+        self._data = None
+
+    @property
+    def data(self) -> np.memmap:
+        # NOTE: the file is mapped lazily, so that each dataloader worker maps it on its own after being forked/spawned.
+        if self._data is None:
+            self._data = np.memmap(os.path.join(
+                self.store_dir, DATA_FILE_NAME), dtype=np.uint8, mode="r")
+        return self._data
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_data"] = None
+        return state
+
+    def __contains__(self, image_id: str) -> bool:
+        return image_id in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def get_array(self, image_id: str) -> np.ndarray:
+        """
+        Returns the (H, W, C) uint8 image as a view of the memory-mapped file (no copy is performed).
+        """
+        offset, shape = self.index[image_id]
+        size = shape[0] * shape[1] * shape[2]
+        return self.data[offset:offset + size].reshape(shape)
+
+    def get_image(self, image_id: str) -> Image.Image:
+        array = self.get_array(image_id)
+        if array.shape[2] == 1:
+            return Image.fromarray(array[:, :, 0])
+        return Image.fromarray(array)
+
+
+def build_image_store(image_paths: Iterable[Tuple[str, str]], store_dir: str):
+    """
+    Decodes all the images once and writes them in a single uint8 file, along with the offset index.
+    image_paths is an iterable of (image_id, image_path) pairs.
+    """
+    image_paths = list(image_paths)
+    os.makedirs(store_dir, exist_ok=True)
+
+    # First pass: read only the headers to know the size of the file to allocate
+    index = {}
+    offset = 0
+    for image_id, image_path in tqdm(image_paths, desc="Indexing images"):
+        with Image.open(image_path) as image:
+            width, height = image.size
+            channels = 1 if image.mode in ("L", "1") else 3
+        shape = (height, width, channels)
+        index[image_id] = {"offset": offset, "shape": shape}
+        offset += height * width * channels
+
+    data = np.memmap(os.path.join(store_dir, DATA_FILE_NAME),
+                     dtype=np.uint8, mode="w+", shape=(offset,))
+
+    # Second pass: decode and write every image at its offset
+    for image_id, image_path in tqdm(image_paths, desc="Decoding images"):
+        entry = index[image_id]
+        with Image.open(image_path) as image:
+            image = image.convert("L" if entry["shape"][2] == 1 else "RGB")
+            array = np.asarray(image, dtype=np.uint8).reshape(entry["shape"])
+        data[entry["offset"]:entry["offset"] + array.size] = array.reshape(-1)
+    data.flush()
+    del data
+
+    # The index is written last, so that a partially written store is never considered valid
+    index_path = os.path.join(store_dir, INDEX_FILE_NAME)
+    with open(index_path + ".tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(index_path + ".tmp", index_path)
+    print(f"--Image Store-- Stored {len(index)} images ({offset / 1e9:.2f} GB) in {store_dir}")
@@ -0,0 +1,45 @@
+import hashlib
+import json
+import os
+from typing import List, Tuple
+
+import numpy as np
+import torch
+from torch import nn
+
+from config import CACHE_DIR
+from utils.array_store import ArrayStore
+from utils.utils import hash_module_state
+
+
+class LANetActivationCache:
+    """
+    On-disk cache of the activations of the frozen LANet backbone: the final feature map and the pooled activation maps
+    of the CNN blocks, concatenated along the channels and stored as float16 in a memory-mapped ArrayStore.
+    The store directory depends on the backbone weights and on the preprocessing parameters (e.g. image size, segmentation and normalization),
+    so changing any of them never returns stale activations.
+    Entries are keyed by the image path (and by the view, with the GradCAM views of MSLANetDataLoader) they have been computed on.
+    """
+
+    def __init__(self, backbone: nn.Module, activation_shape: Tuple[int, int, int], params: dict, cache_dir: str = os.path.join(CACHE_DIR, "lanet_activations")):
+        backbone_hash = hash_module_state(backbone)
+        params_hash = hashlib.sha256(json.dumps(
+            params, sort_keys=True).encode()).hexdigest()
+        self.store = ArrayStore(os.path.join(cache_dir, f"{backbone_hash[:16]}_{params_hash[:16]}"),
+                                shape=activation_shape, dtype=np.float16)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.store
+
+    def get_batch(self, keys: List[str], device: torch.device) -> torch.Tensor:
+        return torch.from_numpy(self.store.get_batch(keys)).to(device, torch.float32)
+
+    def put_batch(self, keys: List[str], activations: torch.Tensor):
+        """
+        Stores the activations of the keys. They are visible to the next runs only after flush().
+        """
+        self.store.put_batch(keys, activations.detach().cpu().to(
+            torch.float16).numpy())
+
+    def flush(self):
+        self.store.flush()
@@ -0,0 +1,103 @@
+from typing import Dict
+
+import torch
+from sklearn.metrics import roc_auc_score
+
+
+class StreamingMetrics:
+    """
+    Incremental classification metrics of an epoch. Every step updates a confusion matrix kept on the device,
+    so the running accuracy, recall and per-class metrics cost O(1) per step instead of re-scoring all the predictions of the epoch.
+    The scores and labels (needed only for the AUC) are written into preallocated buffers, and the AUC is computed once per epoch.
+    All the metrics are percentages, as in the training loops.
+    """
+
+    def __init__(self, num_classes: int, device: torch.device, keep_scores: bool = False, capacity: int = 1024):
+        self.num_classes = num_classes
+        self.device = device
+        self.keep_scores = keep_scores
+        self.confusion_matrix = torch.zeros(
+            (num_classes, num_classes), dtype=torch.long, device=device)
+        self.scores = torch.empty(
+            (capacity, num_classes), device=device) if keep_scores else None
+        self.labels = torch.empty(
+            capacity, dtype=torch.long, device=device) if keep_scores else None
+        self.count = 0
+
+    def reset(self):
+        self.confusion_matrix.zero_()
+        self.count = 0
+
+    @torch.no_grad()
+    def update(self, outputs: torch.Tensor, labels: torch.Tensor):
+        outputs = outputs.detach().to(self.device)
+        labels = labels.to(self.device)
+        preds = torch.argmax(outputs, -1)
+        # Rows are the true labels, columns the predictions
+        self.confusion_matrix += torch.bincount(labels * self.num_classes + preds,
+                                                minlength=self.num_classes ** 2).view(self.num_classes, self.num_classes)
+        if self.keep_scores:
+            end = self.count + len(labels)
+            if end > len(self.scores):
+                # Grow the buffers, doubling their capacity
+                capacity = max(end, 2 * len(self.scores))
+                self.scores = torch.cat(
+                    (self.scores[:self.count], self.scores.new_empty((capacity - self.count, self.num_classes))))
+                self.labels = torch.cat(
+                    (self.labels[:self.count], self.labels.new_empty(capacity - self.count)))
+            self.scores[self.count:end] = outputs.float()
+            self.labels[self.count:end] = labels
+        self.count += len(labels)
+
+    def accuracy(self) -> float:
+        total = self.confusion_matrix.sum()
+        if total == 0:
+            return 0.0
+        return (self.confusion_matrix.trace() / total).item() * 100
+
+    def recall(self) -> float:
+        """
+        Macro recall over the classes that appear in the labels or in the predictions (as sklearn's recall_score with zero_division=0).
+        """
+        true_positives = self.confusion_matrix.diag()
+        support = self.confusion_matrix.sum(dim=1)
+        present = (support + self.confusion_matrix.sum(dim=0)) > 0
+        if not present.any():
+            return 0.0
+        recalls = torch.where(support > 0, true_positives /
+                              support.clamp(min=1), torch.zeros_like(true_positives, dtype=torch.float))
+        return recalls[present].mean().item() * 100
+
+    def class_metrics(self, class_label: int, with_auc: bool = False) -> Dict[str, float]:
+        """
+        One-vs-rest accuracy, sensitivity and specificity of the class (and its AUC, which needs keep_scores=True).
+        """
+        total = self.confusion_matrix.sum().item()
+        true_positives = self.confusion_matrix[class_label, class_label].item()
+        false_negatives = self.confusion_matrix[class_label].sum().item() - \
+            true_positives
+        false_positives = self.confusion_matrix[:, class_label].sum().item() - \
+            true_positives
+        true_negatives = total - true_positives - false_negatives - false_positives
+        metrics = {
+            "accuracy": (true_positives + true_negatives) / total * 100 if total > 0 else 0,
+            "sensitivity": true_positives / (true_positives + false_negatives) * 100 if true_positives + false_negatives > 0 else 0,
+            "specificity": true_negatives / (true_negatives + false_positives) * 100 if true_negatives + false_positives > 0 else 0,
+        }
+        if with_auc:
+            metrics["auc"] = self.auc(class_label)
+        return metrics
+
+    def auc(self, class_label: int) -> float:
+        """
+        One-vs-rest ROC AUC of the class over the whole epoch, 0 if only one of the two classes appears in the labels.
+        """
+        if not self.keep_scores:
+            raise ValueError("The AUC requires keep_scores=True")
+        binary_labels = (self.labels[:self.count] == class_label).cpu().numpy()
+        if binary_labels.all() or not binary_labels.any():
+            return 0
+        return roc_auc_score(binary_labels, self.scores[:self.count, class_label].cpu().numpy()) * 100
+
+    def classes_metrics(self, with_auc: bool = False) -> Dict[int, Dict[str, float]]:
+        return {class_label: self.class_metrics(class_label, with_auc) for class_label in range(self.num_classes)}
@@ -0,0 +1,133 @@
+from contextlib import nullcontext
+from typing import Iterator, Optional, Tuple
+
+import torch
+from torch import nn
+
+BATCH_NORM_MODES = ["micro_batch", "frozen"]
+
+
+def split_batch(images, keys: Optional[list], micro_batch_size: int) -> Iterator[Tuple[slice, object, Optional[list]]]:
+    """
+    Splits a batch into micro-batches of at most micro_batch_size images, yielding (slice, images, keys).
+    images is either a batch of images or a list with the batches of the views (as the MSLANetDataLoader batches),
+    and keys the optional activation cache keys, with one list per view in the second case.
+    """
+    batch_size = len(images[0]) if isinstance(
+        images, (list, tuple)) else len(images)
+    for start in range(0, batch_size, micro_batch_size):
+        micro_slice = slice(start, start + micro_batch_size)
+        if isinstance(images, (list, tuple)):
+            micro_images = [view[micro_slice] for view in images]
+            micro_keys = [view_keys[micro_slice]
+                          for view_keys in keys] if keys is not None else None
+        else:
+            micro_images = images[micro_slice]
+            micro_keys = keys[micro_slice] if keys is not None else None
+        yield micro_slice, micro_images, micro_keys
+
+
+def set_batch_norm_mode(model: nn.Module, batch_norm_mode: str):
+    """
+    Sets the batch norm layers of a model in training mode. With gradient accumulation, the batch norm statistics are computed
+    on the micro-batches, so they are noisier than the ones of the effective batch:
+    - "micro_batch" keeps the standard behaviour, normalizing each micro-batch with its own statistics;
+    - "frozen" puts the batch norm layers in eval mode, so they normalize with their running statistics (which are not updated anymore),
+    and the accumulated gradients are exactly the ones of the effective batch.
+    """
+    if batch_norm_mode not in BATCH_NORM_MODES:
+        raise ValueError(
+            f"Batch norm mode {batch_norm_mode} not implemented, use one of {BATCH_NORM_MODES}")
+    if batch_norm_mode == "frozen":
+        for module in model.modules():
+            if isinstance(module, nn.modules.batchnorm._BatchNorm):
+                module.eval()
+
+
+def _saved_tensors_bytes(forward_fn, inputs) -> int:
+    """
+    Bytes of the tensors saved by autograd for the backward pass during the forward pass, i.e. the activation memory of the batch.
+    """
+    saved = {}
+
+    def pack(tensor):
+        saved[(tensor.data_ptr(), tensor.dtype, tuple(tensor.shape))
+              ] = tensor.element_size() * tensor.nelement()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        forward_fn(inputs)
+    return sum(saved.values())
+
+
+def auto_micro_batch_size(model: nn.Module, forward_fn, images, max_micro_batch_size: int, memory_budget_gb: float,
+                          precision_context=None, safety_factor: float = 0.8) -> int:
+    """
+    Picks the largest micro-batch whose activations fit in the memory budget. The activation memory is measured with the saved tensors
+    of two forward passes on 2 and 4 images of the batch (batch norm needs more than one image in training mode),
+    which give the memory per image and the fixed one.
+    The batch norm running statistics are restored after the measure.
+    """
+    buffers = {name: buffer.clone() for name, buffer in model.named_buffers()}
+    precision_context = precision_context or nullcontext()
+
+    def first_images(n: int):
+        if isinstance(images, (list, tuple)):
+            return [view[:n] for view in images]
+        return images[:n]
+
+    with precision_context:
+        two_images_bytes = _saved_tensors_bytes(forward_fn, first_images(2))
+        four_images_bytes = _saved_tensors_bytes(forward_fn, first_images(4))
+    with torch.no_grad():
+        for name, buffer in model.named_buffers():
+            buffer.copy_(buffers[name])
+
+    bytes_per_image = max((four_images_bytes - two_images_bytes) // 2, 1)
+    fixed_bytes = max(two_images_bytes - 2 * bytes_per_image, 0)
+    budget_bytes = memory_budget_gb * 1024 ** 3 * safety_factor
+    micro_batch_size = int((budget_bytes - fixed_bytes) // bytes_per_image)
+    micro_batch_size = max(1, min(micro_batch_size, max_micro_batch_size))
+    print(
+        f"--Micro Batching-- {bytes_per_image / 1024 ** 2:.1f} MB of activations per image, using micro-batches of {micro_batch_size} images (budget: {memory_budget_gb} GB)")
+    return micro_batch_size
+
+
+class GradientAccumulator:
+    """
+    Accumulates the gradients of the micro-batches until effective_batch_size images have been seen, then steps the optimizer.
+    Each micro-batch loss is weighted by its share of the effective batch, so the accumulated gradient is the one of the mean loss of the effective batch.
+    """
+
+    def __init__(self, optimizer, scaler, effective_batch_size: int):
+        self.optimizer = optimizer
+        self.scaler = scaler
+        self.effective_batch_size = effective_batch_size
+        self.num_images = 0
+
+    def backward(self, loss: torch.Tensor, micro_batch_size: int):
+        if self.num_images == 0:
+            self.optimizer.zero_grad()
+        self.scaler.scale(
+            loss * (micro_batch_size / self.effective_batch_size)).backward()
+        self.num_images += micro_batch_size
+        if self.num_images >= self.effective_batch_size:
+            self.step()
+
+    def step(self):
+        """
+        Steps the optimizer with the accumulated gradients. At the end of the epoch it is called on the remaining (smaller) batch,
+        whose gradients are rescaled to the mean loss of its images, since its losses were weighted by their share of effective_batch_size.
+        """
+        if self.num_images == 0:
+            return
+        if self.num_images < self.effective_batch_size:
+            scale = self.effective_batch_size / self.num_images
+            for group in self.optimizer.param_groups:
+                for param in group["params"]:
+                    if param.grad is not None:
+                        param.grad.mul_(scale)
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+        self.num_images = 0
+
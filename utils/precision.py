@@ -0,0 +1,52 @@
+from contextlib import nullcontext
+from typing import Optional
+
+import torch
+
+PRECISIONS = ["fp32", "bf16", "fp16"]
+
+
+def autocast_dtype(device: torch.device, precision: str) -> Optional[torch.dtype]:
+    """
+    Returns the dtype used by autocast for the precision on the device, or None if the model must run in fp32.
+    On the cpu only bf16 is supported, so fp16 falls back to bf16. Devices without autocast (e.g. DirectML) always run in fp32.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(
+            f"Precision {precision} not implemented, use one of {PRECISIONS}")
+    if precision == "fp32":
+        return None
+    if device.type == "cpu":
+        return torch.bfloat16
+    if device.type == "cuda":
+        if precision == "bf16" and not torch.cuda.is_bf16_supported():
+            print("--Precision-- bf16 is not supported by the gpu, using fp16")
+            return torch.float16
+        return torch.bfloat16 if precision == "bf16" else torch.float16
+    print(
+        f"--Precision-- Autocast is not supported on {device.type}, using fp32")
+    return None
+
+
+def autocast(device: torch.device, precision: str):
+    """
+    Context manager running the forward pass (and the loss) in the given precision.
+    """
+    dtype = autocast_dtype(device, precision)
+    if dtype is None:
+        return nullcontext()
+    return torch.autocast(device_type=device.type, dtype=dtype)
+
+
+def grad_scaler(device: torch.device, precision: str) -> torch.cuda.amp.GradScaler:
+    """
+    Returns the gradient scaler of the training loop. The loss is scaled only with fp16 on the gpu, where the small gradients would underflow,
+    otherwise the scaler is disabled and scale/step/update fall back to the plain backward and optimizer step.
+    """
+    enabled = device.type == "cuda" and autocast_dtype(
+        device, precision) == torch.float16
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
+def memory_format(channels_last: bool) -> torch.memory_format:
+    return torch.channels_last if channels_last else torch.contiguous_format
@@ -0,0 +1,68 @@
+import hashlib
+import json
+import os
+from typing import Optional
+
+import numpy as np
+import torch
+from PIL import Image
+
+from config import CACHE_DIR
+
+
+def hash_file(path: str, chunk_size: int = 1 << 20) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class SAMMaskCache:
+    """
+    Content-addressed on-disk cache of the binary masks predicted by SAM.
+    Masks are stored as PNG files in a directory that depends on the SAM checkpoint and on the segmentation parameters,
+    so changing either of them never returns stale masks. Inside the directory, masks are keyed by the hash of the image file.
+    """
+
+    def __init__(self, checkpoint_path: str, params: dict, cache_dir: str = os.path.join(CACHE_DIR, "sam_masks")):
+        checkpoint_hash = hash_file(checkpoint_path)
+        params_hash = hashlib.sha256(json.dumps(
+            params, sort_keys=True).encode()).hexdigest()
+        self.cache_dir = os.path.join(
+            cache_dir, f"{checkpoint_hash[:16]}_{params_hash[:16]}")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Image hashes are memoized by path, so that the image file is read only once per process
+        self.image_hashes = {}
+
+    def image_hash(self, image_path: str) -> str:
+        if image_path not in self.image_hashes:
+            self.image_hashes[image_path] = hash_file(image_path)
+        return self.image_hashes[image_path]
+
+    def _mask_path(self, image_path: str) -> str:
+        return os.path.join(self.cache_dir, f"{self.image_hash(image_path)}.png")
+
+    def __contains__(self, image_path: str) -> bool:
+        return os.path.exists(self._mask_path(image_path))
+
+    def get(self, image_path: str) -> Optional[torch.Tensor]:
+        """
+        Returns the cached (1, H, W) float binary mask of the image, or None if it is not cached.
+        """
+        mask_path = self._mask_path(image_path)
+        if not os.path.exists(mask_path):
+            return None
+        with Image.open(mask_path) as mask:
+            mask = np.array(mask, dtype=np.uint8)
+        return torch.from_numpy(mask > 0).float().unsqueeze(0)
+
+    def put(self, image_path: str, mask: torch.Tensor):
+        """
+        Stores the binary mask of the image. The file is written atomically, so concurrent workers never read a partial mask.
+        """
+        mask_path = self._mask_path(image_path)
+        mask = (mask.detach().squeeze().cpu().numpy() > 0).astype(np.uint8) * 255
+        tmp_path = f"{mask_path}.{os.getpid()}.tmp"
+        Image.fromarray(mask).save(tmp_path, format="PNG")
+        os.replace(tmp_path, mask_path)
@@ -0,0 +1,98 @@
+import json
+import os
+from typing import List, Optional, Tuple
+
+
+class SuccessiveHalving:
+    """
+    Successive halving search over a list of hyperparameter combinations, with its state persisted in a JSON file.
+    Every rung trains the surviving combinations for a budget of epochs (min_epochs, min_epochs * eta, ... up to max_epochs),
+    and only the top 1/eta of them by score (e.g. validation recall) are promoted to the next rung.
+    The state is written atomically after every trial, so an interrupted search resumes from the trials that haven't ended.
+    """
+
+    def __init__(self, state_path: str, combinations: List[tuple], min_epochs: int, max_epochs: int, eta: int = 3):
+        if eta < 2:
+            raise ValueError("eta must be at least 2")
+        self.state_path = state_path
+        if os.path.exists(state_path):
+            with open(state_path, "r") as f:
+                self.state = json.load(f)
+            first_rung = self.state["rungs"][0]
+            if (self.state["eta"], self.state["max_epochs"], first_rung["epochs"], first_rung["combinations"]) != \
+                    (eta, max_epochs, min(min_epochs, max_epochs), [list(combination) for combination in combinations]):
+                raise ValueError(
+                    f"The search in {state_path} has been started with different combinations, epochs or eta, use --force-reset to start a new search")
+            print(
+                f"--Successive Halving-- Resuming the search from {state_path} at rung {len(self.state['rungs']) - 1}")
+        else:
+            self.state = {
+                "eta": eta,
+                "max_epochs": max_epochs,
+                "rungs": [{"epochs": min(min_epochs, max_epochs),
+                           "combinations": [list(combination) for combination in combinations],
+                           "scores": {}}]
+            }
+            self.save()
+
+    @staticmethod
+    def key(combination) -> str:
+        return json.dumps(list(combination))
+
+    @property
+    def current_rung(self) -> dict:
+        return self.state["rungs"][-1]
+
+    def save(self):
+        os.makedirs(os.path.dirname(
+            os.path.abspath(self.state_path)), exist_ok=True)
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f, indent=4)
+        os.replace(tmp_path, self.state_path)
+
+    def pending(self) -> List[Tuple[tuple, int]]:
+        """
+        Returns the (combination, epochs) trials of the current rung that haven't been run yet.
+        """
+        rung = self.current_rung
+        return [(tuple(combination), rung["epochs"]) for combination in rung["combinations"]
+                if self.key(combination) not in rung["scores"]]
+
+    def report(self, combination: tuple, score: float):
+        self.current_rung["scores"][self.key(combination)] = score
+        self.save()
+
+    def is_finished(self) -> bool:
+        rung = self.current_rung
+        return len(self.pending()) == 0 and \
+            (len(rung["combinations"]) <= 1 or rung["epochs"] >= self.state["max_epochs"])
+
+    def promote(self):
+        """
+        Promotes the top 1/eta combinations of the completed current rung to a new rung with eta times the epochs.
+        """
+        if len(self.pending()) > 0 or self.is_finished():
+            return
+        rung = self.current_rung
+        ranking = sorted(rung["combinations"],
+                         key=lambda combination: rung["scores"][self.key(combination)], reverse=True)
+        promoted = ranking[:max(1, len(ranking) // self.state["eta"])]
+        epochs = min(rung["epochs"] * self.state["eta"],
+                     self.state["max_epochs"])
+        print(
+            f"--Successive Halving-- Promoting {len(promoted)}/{len(ranking)} combinations to {epochs} epochs")
+        self.state["rungs"].append(
+            {"epochs": epochs, "combinations": promoted, "scores": {}})
+        self.save()
+
+    def best(self) -> Optional[Tuple[tuple, float]]:
+        """
+        Returns the best combination (and its score) of the last rung with scores.
+        """
+        for rung in reversed(self.state["rungs"]):
+            if len(rung["scores"]) > 0:
+                key, score = max(rung["scores"].items(),
+                                 key=lambda item: item[1])
+                return tuple(json.loads(key)), score
+        return None
@@ -0,0 +1,57 @@
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+from typing import Dict, List
+
+
+class TrialLedger:
+    """
+    JSON file with the hyperparameter combinations already tried for each architecture, shared by the sweeps.
+    Every update re-reads the file while holding an exclusive lock and replaces it atomically,
+    so concurrent sweeps never lose each other's trials, and a crash never leaves a truncated file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    @contextmanager
+    def locked(self):
+        with open(f"{self.path}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self) -> Dict[str, List[list]]:
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, "r") as f:
+            return json.load(f)
+
+    def _write(self, combinations_tried: Dict[str, List[list]]):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(combinations_tried, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def tried(self, architecture: str) -> List[list]:
+        with self.locked():
+            return self._read().get(architecture, [])
+
+    def add(self, architecture: str, combination: tuple):
+        with self.locked():
+            combinations_tried = self._read()
+            combinations_tried.setdefault(
+                architecture, []).append(list(combination))
+            self._write(combinations_tried)
+
+    def reset(self, architecture: str):
+        with self.locked():
+            combinations_tried = self._read()
+            combinations_tried[architecture] = []
+            self._write(combinations_tried)
@@ -1,15 +1,18 @@
-from typing import Tuple
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+from typing import List, Optional, Tuple
 import numpy as np
 import torch
+import torch.nn.functional as F
 import cv2
 from PIL import Image
 from tqdm import tqdm
 import os
 import pandas as pd
-from torchvision import transforms
+from torchvision.ops import roi_align
 import json
 import random
-from config import IMAGE_SIZE, USE_DML, PATH_TO_SAVE_RESULTS, USE_MPS
+from config import CACHE_DIR, IMAGE_SIZE, USE_DML, PATH_TO_SAVE_RESULTS, USE_MPS
 
 if USE_DML:
     import torch_directml
@@ -178,33 +181,191 @@ def crop_image_from_box(image, box, size):
     return resized_image
 
 
-def resize_images(images, new_size=(800, 800)):
-    interpolation = get_resize_interpolation(images, new_size)
-    return torch.stack([torch.from_numpy(cv2.resize(
-        image.permute(1, 2, 0).cpu().numpy(), new_size, interpolation=interpolation)) for image in images]).permute(0, 3, 1, 2)
-
-
-def resize_segmentations(segmentation, new_size=(800, 800)):
-    interpolation = get_resize_interpolation(segmentation, new_size)
-    return torch.stack([torch.from_numpy(cv2.resize(
-        image.permute(1, 2, 0).cpu().numpy(), new_size, interpolation=interpolation)) for image in segmentation]).unsqueeze(0).permute(1, 0, 2, 3)
-
-
-def calculate_normalization_statistics(df: pd.DataFrame) -> Tuple[torch.Tensor, torch.Tensor]:
-    images_for_normalization = []
-
-    for _, img in tqdm(df.iterrows(), desc=f'Calculating normalization statistics'):
-        if not os.path.exists(img['image_path']):
+def get_square_bounding_boxes(segmentations: torch.Tensor, max_size: int = 1000) -> torch.Tensor:
+    """
+    Batched version of get_bounding_boxes_from_segmentation followed by approximate_bounding_box_to_square.
+    Given (B, 1, H, W) or (B, H, W) binary masks, returns the (B, 4) square boxes [min_row, min_col, max_row, max_col]
+    (max excluded, as used by crop_image_from_box), clipped to the image. The box of an empty mask is the whole image.
+    """
+    height, width = segmentations.shape[-2:]
+    masks = segmentations.reshape(-1, height, width) == 1
+    rows_mask, cols_mask = masks.any(dim=2), masks.any(dim=1)
+    rows = torch.arange(height, device=masks.device)
+    cols = torch.arange(width, device=masks.device)
+    min_row = torch.where(rows_mask, rows, height).min(dim=1).values
+    max_row = torch.where(rows_mask, rows, -1).max(dim=1).values
+    min_col = torch.where(cols_mask, cols, width).min(dim=1).values
+    max_col = torch.where(cols_mask, cols, -1).max(dim=1).values
+
+    center_row = (min_row + max_row) // 2
+    center_col = (min_col + max_col) // 2
+    half_side = torch.maximum(max_row - min_row, max_col - min_col) // 2
+    boxes = torch.stack([
+        (center_row - half_side).clamp(min=0),
+        (center_col - half_side).clamp(min=0),
+        (center_row + half_side).clamp(max=min(max_size, height)),
+        (center_col + half_side).clamp(max=min(max_size, width))], dim=1)
+    # Boxes must contain at least a pixel
+    boxes[:, 2] = torch.maximum(boxes[:, 2], boxes[:, 0] + 1)
+    boxes[:, 3] = torch.maximum(boxes[:, 3], boxes[:, 1] + 1)
+
+    empty = ~rows_mask.any(dim=1)
+    boxes[empty] = torch.tensor(
+        [0, 0, height, width], device=boxes.device, dtype=boxes.dtype)
+    return boxes
+
+
+def crop_images_from_boxes(images: torch.Tensor, boxes: torch.Tensor, size: Tuple[int, int]) -> torch.Tensor:
+    """
+    Batched version of crop_image_from_box: crops the (B, C, H, W) images with the (B, 4) boxes [min_row, min_col, max_row, max_col]
+    and resizes the crops to size (height, width) with a single roi_align, on the device of the images.
+    roi_align averages sampling_ratio x sampling_ratio bilinear samples per output pixel (adaptive when -1), which
+    approximates the area interpolation when downsampling.
+    """
+    batch_indices = torch.arange(
+        len(images), device=images.device, dtype=images.dtype).unsqueeze(1)
+    # roi_align expects (batch_index, x1, y1, x2, y2) boxes
+    rois = torch.cat(
+        [batch_indices, boxes[:, [1, 0, 3, 2]].to(images.dtype)], dim=1)
+    return roi_align(images, rois, output_size=size, spatial_scale=1.0, sampling_ratio=-1, aligned=True)
+
+
+def crop_to_background(images: torch.Tensor, segmentations: torch.Tensor, size: Optional[Tuple[int, int]] = IMAGE_SIZE) -> torch.Tensor:
+    """
+    Crops every image of the batch to the square box around its segmentation mask, resizing the crops to size.
+    If size is None, the crops are not resized (so they can be stacked only if they have the same shape).
+    """
+    if images.ndim == 3:
+        images = images.unsqueeze(0)
+    boxes = get_square_bounding_boxes(segmentations.to(images.device))
+    if size is None:
+        return torch.stack([image[:, box[0]:box[2], box[1]:box[3]] for image, box in zip(images, boxes.tolist())])
+    return crop_images_from_boxes(images.float(), boxes, size)
+
+
+def resize_batch(images: torch.Tensor, new_size=(800, 800), mode: str = "bicubic", antialias: bool = False) -> torch.Tensor:
+    """
+    Resizes a (B, C, H, W) batch with a single F.interpolate call, on the device of the batch.
+    new_size is (width, height), as in cv2.resize. Supported modes are "bicubic", "bilinear", "area", "nearest"
+    (same sampling as cv2.INTER_CUBIC, INTER_LINEAR, INTER_AREA and INTER_NEAREST) and "auto", that uses "area" when
+    downsampling and "bicubic" otherwise. antialias is applied only to bilinear and bicubic downsampling.
+    """
+    size = (new_size[1], new_size[0])
+    if mode == "auto":
+        mode = "area" if size[0] <= images.shape[-2] and size[1] <= images.shape[-1] else "bicubic"
+    dtype = images.dtype
+    if not dtype.is_floating_point:
+        images = images.float()
+    if mode in ("bilinear", "bicubic"):
+        resized_images = F.interpolate(
+            images, size=size, mode=mode, align_corners=False, antialias=antialias)
+    else:
+        resized_images = F.interpolate(images, size=size, mode=mode)
+    if not dtype.is_floating_point:
+        info = torch.iinfo(dtype)
+        resized_images = resized_images.round().clamp(info.min, info.max)
+    return resized_images.to(dtype)
+
+
+# NOTE: the previous cv2 implementation chose the interpolation with get_resize_interpolation, comparing the (C, H, W) shape with the
+# (width, height) size, which always selected cv2.INTER_CUBIC. Bicubic is kept as the default to keep the inputs SAM has been trained on.
+def resize_images(images, new_size=(800, 800), mode: str = "bicubic", antialias: bool = False):
+    return resize_batch(images, new_size=new_size, mode=mode, antialias=antialias)
+
+
+def resize_segmentations(segmentation, new_size=(800, 800), mode: str = "bicubic", antialias: bool = False):
+    return resize_batch(segmentation, new_size=new_size, mode=mode, antialias=antialias)
+
+
+def merge_channel_statistics(a: Tuple[int, np.ndarray, np.ndarray], b: Tuple[int, np.ndarray, np.ndarray]) -> Tuple[int, np.ndarray, np.ndarray]:
+    """
+    Merges two partial (count, per channel mean, per channel sum of squared deviations) statistics (Chan et al. parallel variance).
+    """
+    count_a, mean_a, m2_a = a
+    count_b, mean_b, m2_b = b
+    count = count_a + count_b
+    if count == 0:
+        return a
+    delta = mean_b - mean_a
+    mean = mean_a + delta * count_b / count
+    m2 = m2_a + m2_b + delta ** 2 * count_a * count_b / count
+    return count, mean, m2
+
+
+def _channel_statistics_of_images(image_paths: List[str]) -> Tuple[int, np.ndarray, np.ndarray]:
+    statistics = (0, np.zeros(3), np.zeros(3))
+    for image_path in image_paths:
+        with Image.open(image_path) as image:
+            pixels = np.asarray(image.convert("RGB"),
+                                dtype=np.float64).reshape(-1, 3) / 255
+        mean = pixels.mean(axis=0)
+        m2 = ((pixels - mean) ** 2).sum(axis=0)
+        statistics = merge_channel_statistics(
+            statistics, (len(pixels), mean, m2))
+    return statistics
+
+
+def _normalization_statistics_cache_path(image_paths: List[str]) -> str:
+    # The key changes if any image is added, removed or modified
+    key = hashlib.sha256()
+    for image_path in sorted(image_paths):
+        stat = os.stat(image_path)
+        key.update(
+            f"{image_path}|{stat.st_mtime_ns}|{stat.st_size}\n".encode())
+    return os.path.join(CACHE_DIR, "normalization_statistics", f"{key.hexdigest()}.json")
+
+
+def hash_module_state(module: torch.nn.Module, exclude_prefixes: Tuple[str, ...] = ()) -> str:
+    """
+    Hashes the state dict of the module (skipping the entries whose name starts with one of exclude_prefixes),
+    used to key the caches of the activations of frozen modules.
+    """
+    sha = hashlib.sha256()
+    for name, tensor in module.state_dict().items():
+        if name.startswith(exclude_prefixes):
             continue
-        image = transforms.ToTensor()(Image.open(img['image_path']))
-        images_for_normalization.append(image)
-
-    images_for_normalization = torch.stack(images_for_normalization)
-    mean = torch.tensor([torch.mean(images_for_normalization[:, channel, :, :])
-                        for channel in range(3)]).reshape(3, 1, 1)
-    std = torch.tensor([torch.std(images_for_normalization[:, channel, :, :])
-                       for channel in range(3)]).reshape(3, 1, 1)
-
+        sha.update(name.encode())
+        sha.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return sha.hexdigest()
+
+
+def calculate_normalization_statistics(df: pd.DataFrame, num_workers: Optional[int] = None, use_cache: bool = True) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Computes the per channel mean and (unbiased) standard deviation of the images in the dataframe, streaming the images
+    in chunks over a pool of num_workers processes (None = number of cpus), so that the images are never all in memory.
+    The result is cached on disk, keyed by the image paths and their modification times.
+    """
+    image_paths = [image_path for image_path in df['image_path'].unique()
+                   if os.path.exists(image_path)]
+    cache_path = _normalization_statistics_cache_path(image_paths)
+    if use_cache and os.path.exists(cache_path):
+        with open(cache_path, "r") as f:
+            cached = json.load(f)
+        print(
+            f"--Normalization-- Loaded cached statistics from {cache_path}")
+        return tuple((torch.tensor(cached["mean"]).reshape(3, 1, 1), torch.tensor(cached["std"]).reshape(3, 1, 1)))
+
+    num_workers = num_workers or os.cpu_count() or 1
+    chunk_size = 64
+    chunks = [image_paths[i:i + chunk_size]
+              for i in range(0, len(image_paths), chunk_size)]
+    statistics = (0, np.zeros(3), np.zeros(3))
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        for chunk_statistics in tqdm(executor.map(_channel_statistics_of_images, chunks), total=len(chunks), desc=f'Calculating normalization statistics'):
+            statistics = merge_channel_statistics(
+                statistics, chunk_statistics)
+    count, mean, m2 = statistics
+    std = np.sqrt(m2 / (count - 1))
+
+    if use_cache:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path + ".tmp", "w") as f:
+            json.dump({"mean": mean.tolist(), "std": std.tolist(),
+                      "num_images": len(image_paths)}, f)
+        os.replace(cache_path + ".tmp", cache_path)
+
+    mean = torch.tensor(mean, dtype=torch.float32).reshape(3, 1, 1)
+    std = torch.tensor(std, dtype=torch.float32).reshape(3, 1, 1)
     return tuple((mean, std))
 
 
@@ -259,6 +420,13 @@ def save_model(data_name, model, epoch=None, is_best=False):
                    f'{path}/melanoma_detection_{epoch+1}.pt')
 
 
+def seed_worker(worker_id):
+    # Each dataloader worker gets a different (but reproducible) seed, derived from the base seed of the DataLoader
+    worker_seed = torch.initial_seed() % 2**32
+    np.random.seed(worker_seed)
+    random.seed(worker_seed)
+
+
 def set_seed(seed):
     np.random.seed(seed)
     random.seed(seed)